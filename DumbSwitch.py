@@ -9,12 +9,40 @@ from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 #from ofproto import OF 1.3 
 from ryu.ofproto import ofproto_v1_3
-#from packet library we import packet, ethernet and ether types
-#packet helps us parse incoming packets into protocol packets
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
+#from packet library we import ether types
 from ryu.lib.packet import ether_types
+#eth_header reads the mac addresses and ethertype straight from the raw bytes
+import eth_header
+#bounded mac learning table with lru eviction and aging
+import mac_table
+#queues messages per switch and writes them out together
+import msg_batcher
+#rate limits packet ins per switch (and optionally meters the table-miss flow)
+import packet_in_guard
+#sends only the static flows a (re)connecting switch does not have yet
+import reconcile
+#keeps track of the learned flows on every switch, their timeouts and eviction
+import flow_inventory
+#polls flow/port/group statistics and keeps a short history of them
+import stats_collector
+#packet in counters/latencies and sent message counts, served over http
+import metrics
+#per packet log lines are sampled and written in the background
+import packet_log
+#takes the switches of this process from the front-end when the controller is sharded
+import sharding
+#writes the learned macs to disk and puts them back after a restart of the controller
+import snapshot
 
+#two table learning pipeline: table 0 knows which source macs were seen on which port and sends
+#everything else to the controller, table 1 forwards on the destination mac only and floods unknown
+#destinations. The controller sees every host once per switch and each switch needs about 2 flows
+#per host instead of one flow per (in_port, src mac, dst mac)
+multi_table = False
+
+#table ids of the two table pipeline
+SRC_TABLE = 0
+DST_TABLE = 1
 
 class SimpleSwitch13(app_manager.RyuApp):
     #making an array of supported OF versions that is only 1.3
@@ -23,8 +51,40 @@ class SimpleSwitch13(app_manager.RyuApp):
 
     def __init__(self, *args, **kwargs):
         super(SimpleSwitch13, self).__init__(*args, **kwargs)
-        #creating a dictionary that maps a mac address to a port 
-        self.mac_to_port = {}
+        #creating a table per switch that maps a mac address to a port 
+        self.mac_to_port = mac_table.MacTables(backend=mac_table.backend)
+        #all messages to the switches go out through the batcher
+        self.batcher = msg_batcher.MessageBatcher(logger=self.logger)
+        #admission control in front of the packet in handler
+        self.packet_in_guard = packet_in_guard.PacketInGuard(
+            self._packet_in_handler, self.logger, batcher=self.batcher)
+        #learned flows per switch and table, evicted when a table fills up
+        #(the two table pipeline hears about the learned flows that are gone)
+        self.flow_inventory = flow_inventory.FlowInventory(
+            self.batcher, self.logger,
+            on_removed=self._learned_flow_removed)
+        #diffs the static flows against what the switch still has after a reconnect
+        self.reconciler = reconcile.Reconciler(self.batcher, self.logger,
+                                               self.mac_to_port,
+                                               self.flow_inventory)
+        #usage statistics of every switch, polled in the background
+        self.stats_collector = stats_collector.StatsCollector(self.batcher,
+                                                              self.logger)
+        #how long each kind of forwarding decision takes, and what gets sent to the switches
+        self.packet_in_metrics = metrics.PacketInMetrics(self.name)
+        self.packet_in_metrics.add_batcher(self.batcher)
+        metrics.start_server(self.logger)
+        #in a sharded controller the switches come from the front-end
+        sharding.start_worker(self.logger)
+        #logging of the per packet lines, sampled so it does not slow down the handler
+        self.packet_log = packet_log.PacketLog(self.logger)
+        #snapshots of the learned macs and flows, read back when the switches connect after a restart
+        self.snapshots = snapshot.Snapshots(self.name, self.mac_to_port, self.flow_inventory, self.logger)
+        self.snapshots.start()
+
+    #called by ryu-manager on shutdown, take a last snapshot
+    def close(self):
+        self.snapshots.close()
 
 
     #Following function will handle switch features which will be dispatched by config dispatcher
@@ -36,47 +96,200 @@ class SimpleSwitch13(app_manager.RyuApp):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
+        #keep the static flows back until we know which ones the switch is missing,
+        #the learned flows still on the switch come back from its flow dump
+        self.flow_inventory.reset(datapath.id)
+        #the macs this switch had in the snapshot, its flow dump corrects them
+        self.snapshots.restore(datapath.id)
+        self.batcher.hold(datapath)
+
         # install table-miss flow entry
         #
-        # We specify NO BUFFER to max_len of the output action due to
-        # OVS bug. At this moment, if we specify a lesser number, e.g.,
-        # 128, OVS will send Packet-In with invalid buffer_id and
-        # truncated packet data. In that case, we cannot output packets
-        # correctly.  The bug has been fixed in OVS v2.1.0.
+        # max_len is NO BUFFER unless a miss_send_len is configured for
+        # the switch (see packet_in_guard.py). Before OVS v2.1.0 a lesser
+        # number, e.g., 128, made OVS send Packet-In with invalid
+        # buffer_id and truncated packet data, so only configure it for
+        # switches that buffer correctly.
 
 
         #create a match that will match all incoming switch features packet
         match = parser.OFPMatch()
-        #send the features to the controller AND do not buffer them 
-        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
-        self.add_flow(datapath, 0, match, actions)
+        #send the whole packet to the controller, or only its headers if the switch buffers the rest
+        max_len = self.packet_in_guard.install_miss_send_len(datapath, self.batcher)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, max_len)]
+        #meter the packets sent to the controller if a meter is configured for this switch
+        meter_id = self.packet_in_guard.install_meter(datapath, self.batcher)
+        self.add_flow(datapath, 0, match, actions, meter_id=meter_id)
+
+        if multi_table:
+            #in the destination table anything unknown is flooded by the switch itself
+            actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+            self.add_flow(datapath, 0, match, actions, table_id=DST_TABLE)
+
+        #dump the flows of the switch and send only the differences
+        self.reconciler.reconcile(datapath, self.batcher.take_held(datapath))
+        #start polling the statistics of the switch
+        self.stats_collector.add_datapath(datapath)
+
+    #Flow dumps requested by the reconciler, the eviction of the flow inventory or the stats collector
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, ev):
+        if self.reconciler.flow_stats_reply(ev.msg):
+            return
+        if self.flow_inventory.flow_stats_reply(ev.msg):
+            return
+        self.stats_collector.flow_stats_reply(ev.msg)
+
+    #Port and group counters polled by the stats collector
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def _port_stats_reply_handler(self, ev):
+        self.stats_collector.port_stats_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPGroupStatsReply, MAIN_DISPATCHER)
+    def _group_stats_reply_handler(self, ev):
+        self.stats_collector.group_stats_reply(ev.msg)
+
+    #A learned flow timed out or was deleted
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        self.flow_inventory.flow_removed(ev.msg)
 
+    #The switch has applied everything queued before a barrier (the table-miss meter)
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):
+        if self.batcher.barrier_reply(ev.msg):
+            self.logger.debug("barrier reply from dpid: %s", ev.msg.datapath.id)
 
-    #Adding the flow in the switch
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+    #The table 0 and table 1 entries of a host only work together: without the table 1 entry
+    #frames to the host are flooded forever while table 0 keeps it from being learned again.
+    #Only the table 0 entry times out, when it is gone the host is forgotten and learned anew
+    def _learned_flow_removed(self, datapath, table_id, fields):
+        if not multi_table:
+            return
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+        fields = dict(fields)
+
+        if table_id == SRC_TABLE:
+            src = fields['eth_src']
+            #the entry of the old port of a host that moved, it is learned on the new one already
+            port = self.mac_to_port.get(dpid, src)
+            if port is not None and port != fields['in_port']:
+                return
+            self.mac_to_port.evict(dpid, src)
+            self.delete_flow(datapath, DST_TABLE, 1,
+                             parser.OFPMatch(eth_dst=src))
+        elif table_id == DST_TABLE:
+            #table 1 entries are only in the inventory when they were found on the switch after
+            #a reconnect, the table 0 entries of the host go along
+            src = fields['eth_dst']
+            self.mac_to_port.evict(dpid, src)
+            self.delete_flow(datapath, SRC_TABLE, 1,
+                             parser.OFPMatch(eth_src=src), strict=False)
+
+
+    #Adding the flow in the switch (to table_id, continuing in goto_table if given),
+    #learned flows get timeouts and are tracked by the flow inventory
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 meter_id=None, table_id=0, goto_table=None, learned=False):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         #OFPInstructionActions apply the actions passed to the function to the switch
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                              actions)]
-        if buffer_id:
+        #police the packets through the meter first, if there is one
+        if meter_id is not None:
+            inst.insert(0, parser.OFPInstructionMeter(meter_id))
+        #continue the pipeline in another table
+        if goto_table is not None:
+            inst.append(parser.OFPInstructionGotoTable(goto_table))
+        #release the buffered packet through the new flow (buffer id 0 is a valid buffer)
+        if buffer_id is not None:
             mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
                                     priority=priority, match=match,
-                                    instructions=inst)
+                                    instructions=inst, table_id=table_id)
         else:
             mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst)
-        datapath.send_msg(mod)
+                                    match=match, instructions=inst,
+                                    table_id=table_id)
+        if learned:
+            self.flow_inventory.track(datapath, mod)
+        self.batcher.send_msg(datapath, mod)
+
+    #Removing exactly the flow with this match and priority from a table (or, not strict,
+    #every flow of the table whose match includes this one)
+    def delete_flow(self, datapath, table_id, priority, match, strict=True):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        command = ofproto.OFPFC_DELETE_STRICT
+        if not strict:
+            command = ofproto.OFPFC_DELETE
+        mod = parser.OFPFlowMod(datapath=datapath, table_id=table_id,
+                                command=command,
+                                priority=priority, out_port=ofproto.OFPP_ANY,
+                                out_group=ofproto.OFPG_ANY, match=match)
+        self.batcher.send_msg(datapath, mod)
+
+    #Learning for the two table pipeline, only called for sources the switch does not know yet
+    def learn_two_table(self, msg, in_port, src, dst):
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+
+        old_port = self.mac_to_port.learn(dpid, src, in_port)
+        #the host moved, its source entry on the old port is stale
+        if old_port is not None and old_port != in_port:
+            self.delete_flow(datapath, SRC_TABLE, 1,
+                             parser.OFPMatch(in_port=old_port, eth_src=src))
+
+        #forward frames for the host to its port (replaces the old port after a move),
+        #no timeout: it is removed along with the table 0 entry
+        self.add_flow(datapath, 1, parser.OFPMatch(eth_dst=src),
+                      [parser.OFPActionOutput(in_port)], table_id=DST_TABLE)
+
+        #the source is known on this port now so it skips the controller from now on,
+        #a buffered packet is released into the pipeline by this flow mod
+        match = parser.OFPMatch(in_port=in_port, eth_src=src)
+        if msg.buffer_id != ofproto.OFP_NO_BUFFER:
+            self.add_flow(datapath, 1, match, [], msg.buffer_id,
+                          table_id=SRC_TABLE, goto_table=DST_TABLE,
+                          learned=True)
+            return
+        self.add_flow(datapath, 1, match, [],
+                      table_id=SRC_TABLE, goto_table=DST_TABLE, learned=True)
+
+        #send this packet out ourselves
+        out_port = self.mac_to_port.get(dpid, dst)
+        if out_port is None:
+            out_port = ofproto.OFPP_FLOOD
+        actions = [parser.OFPActionOutput(out_port)]
+        out = packet_in_guard.packet_out(msg, in_port, actions)
+        if out is not None:
+            self.batcher.send_msg(datapath, out)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
-        # If you hit this you might want to increase
-        # the "miss_send_length" of your switch
-        if ev.msg.msg_len < ev.msg.total_len:
+        #drop or defer the packet in if this switch is over its rate
+        if not self.packet_in_guard.admit(ev):
+            return
+        #time the handler and count its decision
+        start = metrics.clock()
+        outcome = self.handle_packet_in(ev)
+        self.packet_in_metrics.record(ev.msg.datapath.id, outcome,
+                                      metrics.clock() - start)
+
+    #The actual packet in handling, returns the decision taken (flood, unicast, ...)
+    def handle_packet_in(self, ev):
+        # A truncated packet is only forwarded if the switch buffered it.
+        # If you hit this you might want to increase the "miss_send_length"
+        # of your switch or check that it buffers packets.
+        if (ev.msg.buffer_id == ev.msg.datapath.ofproto.OFP_NO_BUFFER and
+                packet_in_guard.truncated(ev.msg)):
             self.logger.debug("packet truncated: only %s of %s bytes",
-                              ev.msg.msg_len, ev.msg.total_len)
+                              len(ev.msg.data), ev.msg.total_len)
 
         #save the msg received in event in a variable
         msg = ev.msg
@@ -88,29 +301,37 @@ class SimpleSwitch13(app_manager.RyuApp):
         parser = datapath.ofproto_parser
         #set the incoming port of the packet
         in_port = msg.match['in_port']
-        #Change the raw data bytes and parses it as a packet 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        #decode only the ethernet header from the raw data bytes
+        eth = eth_header.decode(msg.data)
+        #drop anything too short to hold an ethernet header
+        if eth is None:
+            self.release(msg, in_port)
+            return 'invalid'
 
         #we need to ignore lldp packets 
         if eth.ethertype == ether_types.ETH_TYPE_LLDP:
             # ignore lldp packet
-            return
-        dst = eth.dst
-        src = eth.src
+            self.release(msg, in_port)
+            return 'lldp'
+        dst = eth.dst_str
+        src = eth.src_str
 
         #get the switch id or datapath id
         dpid = datapath.id
-        self.mac_to_port.setdefault(dpid, {})
 
-        self.logger.info("packet in dpid: ", dpid, " MAC src: ", src, " MAC dst: ", dst," Packet in-port: " in_port)
+        self.packet_log.info("packet in dpid: %s MAC src: %s MAC dst: %s Packet in-port: %s", dpid, src, dst, in_port)
+
+        #in the two table pipeline only unknown sources come here
+        if multi_table:
+            self.learn_two_table(msg, in_port, src, dst)
+            return 'learn'
 
         # learn a mac address to avoid FLOOD next time.
-        self.mac_to_port[dpid][src] = in_port
+        self.mac_to_port.learn(dpid, src, in_port)
 
-        if dst in self.mac_to_port[dpid]:
-            out_port = self.mac_to_port[dpid][dst]
-        else:
+        #get returns None if the mac was never learned or has aged out
+        out_port = self.mac_to_port.get(dpid, dst)
+        if out_port is None:
             out_port = ofproto.OFPP_FLOOD
 
         actions = [parser.OFPActionOutput(out_port)]
@@ -121,14 +342,21 @@ class SimpleSwitch13(app_manager.RyuApp):
             # verify if we have a valid buffer_id, if yes avoid to send both
             # flow_mod & packet_out
             if msg.buffer_id != ofproto.OFP_NO_BUFFER:
-                self.add_flow(datapath, 1, match, actions, msg.buffer_id)
-                return
+                self.add_flow(datapath, 1, match, actions, msg.buffer_id,
+                              learned=True)
+                return 'unicast'
             else:
-                self.add_flow(datapath, 1, match, actions)
-        data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
-            data = msg.data
-
-        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
-                                  in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
\ No newline at end of file
+                self.add_flow(datapath, 1, match, actions, learned=True)
+        #a buffered packet is released by its buffer id, without sending the data back
+        out = packet_in_guard.packet_out(msg, in_port, actions)
+        if out is not None:
+            self.batcher.send_msg(datapath, out)
+        if out_port == ofproto.OFPP_FLOOD:
+            return 'flood'
+        return 'unicast'
+
+    #drop a packet the switch buffered instead of leaving it in the buffer until it times out
+    def release(self, msg, in_port):
+        out = packet_in_guard.packet_out(msg, in_port, [])
+        if out is not None:
+            self.batcher.send_msg(msg.datapath, out)
@@ -1,11 +1,9 @@
+#library to read the vlan configuration file path from the environment
+import os
 #library to match vlan headers
 from ryu.lib.packet import vlan
 #app manager that registers our application to Ryu
 from ryu.base import app_manager
-#library to parse packet to use later
-from ryu.lib.packet import packet
-#library to match ethernet headers
-from ryu.lib.packet import ethernet
 #library to get openflow events (FlowMod, PacketIn)
 from ryu.controller import ofp_event
 #library to use OpenFlow 1.3
@@ -14,7 +12,41 @@ from ryu.ofproto import ofproto_v1_3
 from ryu.lib.packet import ether_types
 #handler library that handles the events and forwards the packets to our application functions 
 from ryu.controller.handler import set_ev_cls, CONFIG_DISPATCHER, MAIN_DISPATCHER
-
+#fast path decoder for the ethernet headers of a packet in
+import eth_header
+#bounded mac learning table with lru eviction and aging
+import mac_table
+#queues messages per switch and writes them out together
+import msg_batcher
+#rate limits packet ins per switch (and optionally meters the table-miss flow)
+import packet_in_guard
+#vlan configuration model, loaded from a file and reloaded when it changes
+import vlan_config
+#diffs the static flows and groups against what a reconnecting switch still has
+import reconcile
+#learned flows per switch with timeouts, evicted when a table fills up
+import flow_inventory
+#polls flow/port/group statistics (including the vlan groups) and keeps a short history of them
+import stats_collector
+#packet in counters/latencies per forwarding decision and sent message counts, served over http
+import metrics
+#sampled logging of the per packet log lines, written in the background
+import packet_log
+#takes the switches of this process from the front-end when the controller is sharded over several processes
+import sharding
+#lldp link discovery and the per vlan spanning trees the flooding follows
+import topology
+#answers arp requests for hosts whose address it has already seen
+import arp_proxy
+#caches the forwarding decision per switch, input port, vlan tag and destination
+import decision_cache
+#writes the learned macs to disk and puts them back after a restart of the controller
+import snapshot
+
+
+#JSON/YAML file with the vlan configuration (see vlan_config.py). When it is set the file is used instead
+#of the three dictionaries below and changes to it are applied to the switches without a restart
+vlan_config_file = os.environ.get('VLAN_CONFIG_FILE')
 
 #retrieve a port vlan, a: b: [c], where "a"=dpid, "b"= port no, "c"=vlan id
 port_to_vlan = {
@@ -40,6 +72,28 @@ vlan_to_group = {
     20: 20
 }
 
+#install the static vlan policy (per vlan broadcast flooding, cross vlan drops) proactively instead of
+#learning it from packet ins, so the controller only sees unicast to unknown destinations
+proactive_mode = False
+
+#priority of the proactive rules, above the catch all rule that sends packets to the controller
+PROACTIVE_PRIORITY = 2
+
+#priority of the reactive flood rules (in_port + unknown eth_dst to the vlan group), above the catch all rule
+FLOOD_PRIORITY = 2
+#flood rules are removed after this many seconds, so the next packet to that destination comes back to the
+#controller and gets a unicast rule once the destination has been learned
+FLOOD_TIMEOUT = 5
+
+#priority of the learned rules (in_port, eth_src, eth_dst), above every flood rule so they are never shadowed
+LEARNED_PRIORITY = 3
+
+#answer arp requests for known hosts from the controller instead of flooding them through the vlan group
+proxy_arp = False
+
+#priority of the rule sending arp requests to the controller in proxy arp mode, above the flooding rules
+ARP_PROXY_PRIORITY = 4
+
 class VLANSwitch(app_manager.RyuApp):
 
     #define the openflow versions we are going to use
@@ -51,8 +105,133 @@ class VLANSwitch(app_manager.RyuApp):
         super(VLANSwitch, self).__init__()
         #save the all the switches in a dictionary
         self.datapaths = dict()
-        #dictionary that stores mac addresses in the format, a: b: c, where "a"=dpid, "b": mac address, "c"=port no
-        self.mac_to_port = dict()
+        #the forwarding decisions, a decision is dropped as soon as its destination changes port
+        self.decisions = decision_cache.DecisionCache()
+        #table that stores mac addresses per switch, where "a"=dpid, "b": mac address, "c"=port no
+        self.mac_to_port = mac_table.MacTables(on_change=self.decisions.mac_changed, backend=mac_table.backend)
+        #all messages to the switches go out through the batcher
+        self.batcher = msg_batcher.MessageBatcher(logger=self.logger)
+        #admission control in front of the packet in handler
+        self.packet_in_guard = packet_in_guard.PacketInGuard(self._packet_in_handler, self.logger, batcher=self.batcher)
+        #on a (re)connect only the flows and groups the switch is missing are sent
+        #learned flows installed on every switch
+        self.flow_inventory = flow_inventory.FlowInventory(self.batcher, self.logger)
+        self.reconciler = reconcile.Reconciler(self.batcher, self.logger, self.mac_to_port, self.flow_inventory)
+        #usage statistics of every switch, per vlan through the vlan group tables
+        self.stats_collector = stats_collector.StatsCollector(self.batcher, self.logger, lambda: self.vlan_to_group)
+        #metrics of the packet in handler and of the messages sent to the switches
+        self.packet_in_metrics = metrics.PacketInMetrics(self.name)
+        self.packet_in_metrics.add_batcher(self.batcher)
+        self.packet_in_metrics.add_decision_cache(self.decisions)
+        metrics.start_server(self.logger)
+        #in a sharded controller the switches come from the front-end
+        sharding.start_worker(self.logger)
+        #the per packet log lines go through here so they never hold up the handler
+        self.packet_log = packet_log.PacketLog(self.logger)
+        #links between the switches, found with lldp (or configured), and the ports each vlan must not flood to
+        self.topology = topology.Topology()
+        self.link_discovery = topology.LinkDiscovery(self.batcher, self.topology, self.logger, self.topology_changed)
+        self.blocked = {}
+        #ip -> mac bindings per vlan, learned from the arp packets we see
+        self.arp_proxy = arp_proxy.ArpProxy()
+        #snapshots of the learned macs and flows, read back when the switches connect after a restart
+        self.snapshots = snapshot.Snapshots(self.name, self.mac_to_port, self.flow_inventory, self.logger)
+        self.snapshots.start()
+
+        #load the vlan configuration, from the file if there is one otherwise from the dictionaries above
+        if vlan_config_file:
+            config = vlan_config.load(vlan_config_file)
+        else:
+            config = vlan_config.VlanConfig.from_port_to_vlan(port_to_vlan, vlan_to_group)
+        self.set_vlan_config(config)
+
+        #watch the file for changes (or SIGHUP) and apply them to the connected switches
+        if vlan_config_file:
+            self.config_watcher = vlan_config.VlanConfigWatcher(vlan_config_file, self.reload_vlan_config, self.logger)
+            self.config_watcher.start()
+
+    #called by ryu-manager on shutdown, take a last snapshot
+    def close(self):
+        self.snapshots.close()
+
+    def set_vlan_config(self, config):
+        #the vlan of a port is port_to_vlan[dpid][port][0], there is no tagging of trunk and native ports
+        config.check_access_only()
+        self.vlan_config = config
+        #same shapes as the module dictionaries: port_to_vlan[dpid][port] = [vid],
+        #vlan_members[dpid][vid] = [ports], vlan_to_group[vid] = group id
+        self.port_to_vlan = config.port_to_vlan
+        self.vlan_members = config.vlan_members
+        self.vlan_to_group = config.vlan_to_group
+        self.topology.set_links(config.links)
+        self.blocked = self.flood_trees()
+        #the cached decisions were taken with the old vlans and groups
+        self.decisions.clear()
+
+    def flood_trees(self):
+        #spanning tree of every vlan over the links whose both ends are members of it, vlan id -> blocked ports
+        vlans = set()
+        for members in self.vlan_members.values():
+            vlans.update(members)
+        return dict((vid, self.topology.blocked(lambda dpid, port, vid=vid: vid in self.port_to_vlan.get(dpid, {}).get(port, ())))
+                    for vid in vlans)
+
+    def topology_changed(self, added, removed):
+        """
+        Links came or went. Only the group tables of the vlans whose spanning tree changed on a switch
+        are modified, and on both ends of a link that is gone the flows and hosts learned through it
+        are removed.
+        """
+        blocked = self.flood_trees()
+        changes = topology.blocked_changes(self.blocked, blocked)
+        self.blocked = blocked
+
+        for dpid, vlans in changes.items():
+            datapath = self.datapaths.get(dpid)
+            if datapath is None:
+                continue
+            self.logger.info("Flood tree changed on dpid: %s vlans: %s", dpid, sorted(vlans))
+            for vid in sorted(vlans):
+                if vid in self.vlan_members.get(dpid, {}):
+                    self.group_mod(datapath, datapath.ofproto.OFPGC_MODIFY, vid)
+            self.batcher.barrier(datapath)
+
+        for dpid, port, peer_dpid, peer_port in removed:
+            for end_dpid, end_port in ((dpid, port), (peer_dpid, peer_port)):
+                datapath = self.datapaths.get(end_dpid)
+                if datapath is not None:
+                    self.reset_port(datapath, end_port)
+
+    def reload_vlan_config(self, config):
+        """
+        Apply a new vlan configuration. Only the switches, ports and vlans that actually changed are
+        touched: the group tables of changed vlans are modified (or added/deleted), and for every port
+        whose vlan changed the flows in and out of it and the hosts learned on it are removed, so they
+        are learned again under the new vlan. Everything else keeps its flows and learned macs.
+        """
+        #a configuration with trunk or native ports is refused, the running one stays
+        try:
+            config.check_access_only()
+        except vlan_config.VlanConfigError as e:
+            self.logger.error("not reloading vlan configuration: %s", e)
+            return
+        changed_ports, changed_vlans = vlan_config.diff(self.vlan_config, config)
+        old_config = self.vlan_config
+        old_blocked = self.blocked
+        self.set_vlan_config(config)
+        #configured links may have changed the flood trees as well
+        for dpid, vlans in topology.blocked_changes(old_blocked, self.blocked).items():
+            changed_vlans.setdefault(dpid, set()).update(vlans)
+
+        for dpid, datapath in self.datapaths.items():
+            ports = changed_ports.get(dpid, set())
+            vlans = changed_vlans.get(dpid, set())
+            if not ports and not vlans:
+                continue
+            self.logger.info("Updating dpid: %s ports: %s vlans: %s", dpid, sorted(ports), sorted(vlans))
+            self.update_group_tables(datapath, old_config, vlans)
+            for port in ports:
+                self.reset_port(datapath, port)
 
 
     
@@ -67,62 +246,183 @@ class VLANSwitch(app_manager.RyuApp):
         group table id to prevent the individual flooding of ports. 
         """
         of_proto = datapath.ofproto
-        parser = datapath.ofproto_parser
 
         #create a separate bucket for each vlan
-        for eachKey in vlan_members[datapath.id]:
-            buckets = []
-            #add ports in the same vlan to be flooded in the bucket
-            for eachPort in vlan_members[datapath.id][eachKey]:
-                actions = [parser.OFPActionOutput(eachPort)]
-                buckets.append( parser.OFPBucket(actions=actions) )
-            
+        for eachKey in self.vlan_members.get(datapath.id, {}):
             self.logger.info("GT for dpid: %s", datapath.id)
-            #make a group table using ofpgc_add and tell the group table to flood to all ports not just one 
-            #using ofpgt_all
-            req = parser.OFPGroupMod( datapath, of_proto.OFPGC_ADD, of_proto.OFPGT_ALL, eachKey, buckets )
-            datapath.send_msg(req)
+            #make a group table using ofpgc_add
+            self.group_mod(datapath, of_proto.OFPGC_ADD, eachKey)
+
+        #the group mods go out in one write, the barrier makes sure the switch has applied all of them
+        #before any flow that points at a group is processed
+        self.batcher.barrier(datapath)
+
 
+    def group_mod(self, datapath, command, vid):
+        of_proto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        buckets = []
+        blocked = self.blocked.get(vid, ())
+        #add ports in the same vlan to be flooded in the bucket, except the links off the vlan's spanning tree
+        for eachPort in self.vlan_members[datapath.id].get(vid, []):
+            if (datapath.id, eachPort) in blocked:
+                continue
+            actions = [parser.OFPActionOutput(eachPort)]
+            buckets.append( parser.OFPBucket(actions=actions) )
+
+        #tell the group table to flood to all ports not just one using ofpgt_all
+        req = parser.OFPGroupMod( datapath, command, of_proto.OFPGT_ALL, self.vlan_to_group[vid], buckets )
+        self.batcher.send_msg(datapath, req)
+
+    def update_group_tables(self, datapath, old_config, vlans):
+        #bring the group tables of the changed vlans in line with the new configuration
+        of_proto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
 
-    #add flows to the switch
-    def add_flow(self, datapath, match, priority, actions, buffer_id=None):
+        old_members = old_config.vlan_members.get(dpid, {})
+        new_members = self.vlan_members.get(dpid, {})
+        for vid in sorted(vlans):
+            old_group = old_config.vlan_to_group.get(vid) if vid in old_members else None
+            new_group = self.vlan_to_group.get(vid) if vid in new_members else None
+
+            if old_group is not None and old_group != new_group:
+                #vlan (or its group id) is gone: drop the flows that still point at the group, then the group
+                self.delete_flows(datapath, parser.OFPMatch(), out_group=old_group)
+                req = parser.OFPGroupMod(datapath, of_proto.OFPGC_DELETE, of_proto.OFPGT_ALL, old_group, [])
+                self.batcher.send_msg(datapath, req)
+            if new_group is not None:
+                command = of_proto.OFPGC_MODIFY if old_group == new_group else of_proto.OFPGC_ADD
+                self.group_mod(datapath, command, vid)
+
+        #groups have to be in place before flows use them again
+        self.batcher.barrier(datapath)
+
+    def reset_port(self, datapath, port):
+        #forget everything learned through a port whose vlan changed
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+
+        self.delete_flows(datapath, parser.OFPMatch(in_port=port))
+        self.delete_flows(datapath, parser.OFPMatch(), out_port=port)
+        for eth_mac in self.mac_to_port.evict_port(dpid, port):
+            self.delete_flows(datapath, parser.OFPMatch(eth_dst=eth_mac))
+
+        if proactive_mode and port in self.port_to_vlan.get(dpid, {}):
+            self.install_port_policy(datapath, port)
+
+    #add flows to the switch, learned flows get timeouts and are recorded in the flow inventory (hard_timeout
+    #overrides the one of the inventory)
+    def add_flow(self, datapath, match, priority, actions, buffer_id=None, meter_id=None, learned=False,
+                 hard_timeout=None):
         of_protocol = datapath.ofproto
         of_protcol_parser = datapath.ofproto_parser
 
         #create an instruction to send to the switch
         instruction = [of_protcol_parser.OFPInstructionActions(of_protocol.OFPIT_APPLY_ACTIONS,actions)]
+        #police the packets through the meter first, if there is one
+        if meter_id is not None:
+            instruction.insert(0, of_protcol_parser.OFPInstructionMeter(meter_id))
 
-        if buffer_id:
-            mod = of_protcol_parser.OFPFLowMod(datapath=datapath, match=match, priority=priority, instructions=instruction,buffer_id=buffer_id)
+        #the flow also forwards the packet the switch buffered (buffer id 0 is a valid buffer)
+        if buffer_id is not None:
+            mod = of_protcol_parser.OFPFlowMod(datapath=datapath, match=match, priority=priority, instructions=instruction,buffer_id=buffer_id)
         else:
             mod = of_protcol_parser.OFPFlowMod(datapath=datapath, match=match, priority=priority, instructions=instruction)
 
-        datapath.send_msg(mod)
+        if learned:
+            self.flow_inventory.track(datapath, mod)
+        if hard_timeout is not None:
+            mod.hard_timeout = hard_timeout
+        self.batcher.send_msg(datapath, mod)
 
-    #function to flood the packets to the same vlan
-    def flood(self, datapath, dpid, in_port):
+    #delete the flows matching match (and outputting to out_port/out_group if given) from the switch
+    def delete_flows(self, datapath, match, out_port=None, out_group=None):
+        of_proto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        if out_port is None:
+            out_port = of_proto.OFPP_ANY
+        if out_group is None:
+            out_group = of_proto.OFPG_ANY
+        mod = parser.OFPFlowMod(datapath=datapath, command=of_proto.OFPFC_DELETE, out_port=out_port,
+                                out_group=out_group, match=match)
+        self.batcher.send_msg(datapath, mod)
+
+    def install_vlan_policy(self, datapath):
+        """
+        Proactive mode: install the flooding part of the vlan policy as soon as the switch connects.
+        Every broadcast/multicast frame (group bit of eth_dst set) arriving on a port is sent to the
+        group table of the vlan of that port, so the switch floods it inside the vlan by itself and
+        ARP requests, DHCP etc. never reach the controller.
+        """
+        for in_port in self.port_to_vlan.get(datapath.id, {}):
+            self.install_port_policy(datapath, in_port)
+
+    def install_port_policy(self, datapath, in_port):
+        #proactive flooding of broadcast/multicast frames from one port, plus the cross vlan drops towards
+        #the hosts already known on the switch
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+        vid = self.port_to_vlan[dpid][in_port][0]
+
+        match = parser.OFPMatch(in_port=in_port, eth_dst=('01:00:00:00:00:00', '01:00:00:00:00:00'))
+        actions = [parser.OFPActionGroup(group_id=self.vlan_to_group[vid])]
+        self.add_flow(datapath, match, PROACTIVE_PRIORITY, actions)
+
+        for eth_mac, mac_port in self.mac_to_port.items(dpid):
+            if mac_port in self.port_to_vlan[dpid] and self.port_to_vlan[dpid][mac_port][0] != vid:
+                self.add_flow(datapath, parser.OFPMatch(in_port=in_port, eth_dst=eth_mac), PROACTIVE_PRIORITY, [],
+                              learned=True)
+
+    def install_cross_vlan_drops(self, datapath, eth_mac, mac_port):
+        """
+        Proactive mode: once a host is learned on mac_port, drop frames sent to it from every port that
+        is not a member of its vlan. These drops are installed once per host instead of once per
+        (src, dst) pair after a packet in.
+        """
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+        vid = self.port_to_vlan[dpid][mac_port][0]
+
+        for port in self.port_to_vlan[dpid]:
+            if vid not in self.port_to_vlan[dpid][port]:
+                match = parser.OFPMatch(in_port=port, eth_dst=eth_mac)
+                #empty action list drops the packet
+                self.add_flow(datapath, match, PROACTIVE_PRIORITY, [], learned=True)
+
+    #function to flood the packets to an unknown destination to the same vlan, for a few seconds only
+    def flood(self, datapath, dpid, in_port, eth_dst):
         of_proto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         #get the source port vlan id
-        vid_src = port_to_vlan[dpid][in_port][0]
+        vid_src = self.port_to_vlan[dpid][in_port][0]
         #use the vlan id to get the group table id
-        grp_id = vlan_to_group[vid_src]
+        grp_id = self.vlan_to_group[vid_src]
 
         #instead of sending individual actions set the action to group table
         actions = [parser.OFPActionGroup(group_id=grp_id)]
-        #create a match using the input port
-        match = parser.OFPMatch(in_port=in_port)
+        #match the input port and the destination, other destinations from the same port still come to us
+        match = parser.OFPMatch(in_port=in_port, eth_dst=eth_dst)
 
-        #add flow to the switch
-        self.add_flow(datapath,match,1,actions)
+        #add flow to the switch, below the learned flows and expiring quickly
+        self.add_flow(datapath,match,FLOOD_PRIORITY,actions,learned=True,hard_timeout=FLOOD_TIMEOUT)
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def _switch_features_handler(self, event):
         print("Received switch features!")
-        self.make_group_tables(event.msg.datapath)
-
         datapath = event.msg.datapath
+
+        #hold back everything below, the reconciler compares it with the flows and groups on the switch
+        #(and puts the learned flows it finds back into the inventory)
+        self.flow_inventory.reset(datapath.id)
+        #the macs this switch had in the snapshot, its flow dump corrects them
+        self.snapshots.restore(datapath.id)
+        self.batcher.hold(datapath)
+        self.make_group_tables(datapath)
+
         of_proto = datapath.ofproto
         parser = datapath.ofproto_parser
 
@@ -130,14 +430,99 @@ class VLANSwitch(app_manager.RyuApp):
         self.datapaths[datapath.id] = datapath
 
         match = parser.OFPMatch()
-        #send the features received of the switch to the controller
-        actions = [parser.OFPActionOutput(of_proto.OFPP_CONTROLLER)]
-
-        self.add_flow(datapath,match,1,actions)
+        #send the packets the switch has no flow for to the controller, only their headers if a miss_send_len
+        #is configured for the switch (it buffers the rest, see packet_in_guard.py)
+        max_len = self.packet_in_guard.install_miss_send_len(datapath, self.batcher)
+        actions = [parser.OFPActionOutput(of_proto.OFPP_CONTROLLER, max_len)]
+
+        #meter the packets sent to the controller if a meter is configured for this switch
+        meter_id = self.packet_in_guard.install_meter(datapath, self.batcher)
+        self.add_flow(datapath,match,1,actions,meter_id=meter_id)
+
+        if proactive_mode:
+            self.install_vlan_policy(datapath)
+
+        #arp requests come to us even from ports that are flooded by the switch, through the same meter
+        if proxy_arp:
+            match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP, arp_op=arp_proxy.ARP_REQUEST)
+            actions = [parser.OFPActionOutput(of_proto.OFPP_CONTROLLER, of_proto.OFPCML_NO_BUFFER)]
+            self.add_flow(datapath, match, ARP_PROXY_PRIORITY, actions, meter_id=meter_id)
+
+        #lldp probes always come back to the controller, even from ports with a learned flood flow
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_LLDP)
+        actions = [parser.OFPActionOutput(of_proto.OFPP_CONTROLLER, of_proto.OFPCML_NO_BUFFER)]
+        self.add_flow(datapath, match, topology.LLDP_PRIORITY, actions)
+
+        #dump the switch and send only the corrections
+        self.reconciler.reconcile(datapath, self.batcher.take_held(datapath))
+        #poll the statistics of the switch from now on
+        self.stats_collector.add_datapath(datapath)
+        #and probe its ports for links to other switches
+        self.link_discovery.add_datapath(datapath)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, event):
+        #part of the flow dump of a reconnecting switch, of a table that is getting full or of the statistics
+        if self.reconciler.flow_stats_reply(event.msg):
+            return
+        if self.flow_inventory.flow_stats_reply(event.msg):
+            return
+        self.stats_collector.flow_stats_reply(event.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def _port_stats_reply_handler(self, event):
+        #port counters polled by the stats collector
+        self.stats_collector.port_stats_reply(event.msg)
+
+    @set_ev_cls(ofp_event.EventOFPGroupStatsReply, MAIN_DISPATCHER)
+    def _group_stats_reply_handler(self, event):
+        #group counters (the traffic flooded per vlan) polled by the stats collector
+        self.stats_collector.group_stats_reply(event.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPortDescStatsReply, MAIN_DISPATCHER)
+    def _port_desc_reply_handler(self, event):
+        #the ports of a new switch, probed by the link discovery
+        self.link_discovery.port_desc_reply(event.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, event):
+        #a port went up or down, its link goes with it
+        self.link_discovery.port_status(event.msg)
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, event):
+        #a learned flow timed out or was deleted
+        self.flow_inventory.flow_removed(event.msg)
+
+    @set_ev_cls(ofp_event.EventOFPGroupDescStatsReply, MAIN_DISPATCHER)
+    def _group_desc_reply_handler(self, event):
+        #part of the group dump of a reconnecting switch
+        self.reconciler.group_desc_reply(event.msg)
     
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, event):
+        #the switch has processed everything we queued before the barrier
+        if self.batcher.barrier_reply(event.msg):
+            self.logger.debug("Barrier reply from dpid: %s", event.msg.datapath.id)
+
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, event):
+        #drop or defer the packet in if this switch is over its rate
+        if not self.packet_in_guard.admit(event):
+            return
 
+        #time the handling and count the decision it took
+        start = metrics.clock()
+        outcome = self.handle_packet_in(event)
+        self.packet_in_metrics.record(event.msg.datapath.id, outcome, metrics.clock() - start)
+
+    def handle_packet_in(self, event):
+        """
+        Learn the source and forward the packet. Returns the decision taken: "flood" (through the vlan
+        group), "unicast" (same vlan), "cross_vlan_drop", "arp_reply" (answered by the arp proxy), "lldp"
+        (a link discovery probe), "blocked" (arrived on a link off the spanning tree of its vlan) or
+        "unconfigured" (arrived on a port that is in no vlan).
+        """
         msg = event.msg
         datapath = msg.datapath
         of_protocol = datapath.ofproto
@@ -145,74 +530,128 @@ class VLANSwitch(app_manager.RyuApp):
         #get the input port of the packet
         in_port = msg.match['in_port']
 
-        #parse the raw data (or bits) into a packet
-        pkt = packet.Packet(msg.data)
-        #extract only the ethernet headers from the packet (leave ip,tcp headers)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        #decode only the ethernet headers straight from the raw data (leave ip,tcp headers)
+        eth = eth_header.decode(msg.data)
+        #ignore anything too short to carry an ethernet header
+        if eth is None:
+            self.release(msg, in_port)
+            return 'invalid'
+
+        #our lldp probes tell which ports connect the switches
+        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+            self.link_discovery.packet_in(msg)
+            self.release(msg, in_port)
+            return 'lldp'
 
         #get the source and destionation mac addresses
-        eth_src = eth.src
-        eth_dst = eth.dst
+        eth_src = eth.src_str
+        eth_dst = eth.dst_str
 
         #get the switch it and store against the [dpid][mac_src] its port
         dpid = datapath.id
-        self.mac_to_port.setdefault(dpid, {})
-        self.mac_to_port[dpid][eth_src] = in_port
-
-        #variable will be set if we need to flood
-        to_flood = 0
-        #initially actions and the ports to flood will be empty
-        actions = []
-        ports_to_flood = []
-        #get the source port vlan id by providing dpid and input port
-        src_vid = port_to_vlan[dpid][in_port][0]
-
-
-        #if we know the output port for the destionation then we dont need to flood 
-        if eth_dst in self.mac_to_port[dpid]:
-            out_ports = self.mac_to_port[dpid][eth_dst]
-        else:
-            #if we dont know the output port we need to flood
-            to_flood = 1
-            self.flood(datapath,dpid,in_port)
-
-        #if we dont need to flood then do the following 
-        if to_flood != 1:
-            
-            #get the source and destination port vlan id
-            src_vid = port_to_vlan[dpid][in_port][0]
-            dst_vid = port_to_vlan[dpid][out_ports][0]
-
-            #if both are in same vlan than proceed foward
-            if src_vid == dst_vid:
-                self.logger.info("Adding flow: %s (src_mac) --> %s (dst_mac)", eth_src, eth_dst)
-                match = of_protocol_parser.OFPMatch(in_port=in_port, eth_src=eth_src, eth_dst=eth_dst)
-
-                #means there is a buffer id
-                if msg.buffer_id != of_protocol.OFP_NO_BUFFER:
-                    self.add_flow(datapath, match, 1, actions, msg.buffer_id)
-                else:
-                    self.add_flow(datapath,match,1,actions)
+        #a port without a vlan belongs to no broadcast domain, drop what comes in on it
+        in_vlans = self.port_to_vlan.get(dpid, {}).get(in_port)
+        if not in_vlans:
+            self.release(msg, in_port)
+            return 'unconfigured'
+        #a link off the spanning tree of the vlan discards everything, like a blocked stp port
+        if (dpid, in_port) in self.blocked.get(in_vlans[0], ()):
+            self.release(msg, in_port)
+            return 'blocked'
+        old_port = self.mac_to_port.learn(dpid, eth_src, in_port)
+
+        #new host (or host moved to another port): isolate it from the other vlans in the switch itself
+        if proactive_mode and old_port != in_port:
+            if old_port is not None:
+                self.delete_flows(datapath, of_protocol_parser.OFPMatch(eth_dst=eth_src))
+            self.install_cross_vlan_drops(datapath, eth_src, in_port)
+
+        #arp request for a host we know: send the reply back out of the port the request came in on
+        if proxy_arp and eth.payload_type == ether_types.ETH_TYPE_ARP:
+            reply = self.arp_proxy.handle(in_vlans[0], eth)
+            if reply is not None:
+                actions = [of_protocol_parser.OFPActionOutput(in_port)]
+                pkt_out = of_protocol_parser.OFPPacketOut(datapath=datapath, buffer_id=of_protocol.OFP_NO_BUFFER,
+                                                          in_port=of_protocol.OFPP_CONTROLLER, actions=actions,
+                                                          data=reply)
+                self.batcher.send_msg(datapath, pkt_out)
+                #the request itself goes no further
+                self.release(msg, in_port)
+                return 'arp_reply'
+
+        #if we know the output port for the destionation then we dont need to flood (get also ages the
+        #destination out, which drops the decisions cached for it)
+        out_ports = self.mac_to_port.get(dpid, eth_dst)
+
+        #the same switch, input port, tag and destination as an earlier packet get the same decision, so only
+        #the first one works it out (see decision_cache.py)
+        key = (dpid, in_port, eth.vid, eth_dst)
+        plan = self.decisions.get(key)
+        if plan is None:
+            plan = self.decide(dpid, in_port, out_ports, of_protocol_parser)
+            self.decisions.put(key, plan)
+        actions, outcome = plan
+
+        if outcome == 'flood':
+            #in proactive mode broadcasts are already flooded by the switch, unknown unicast is only
+            #flooded through the packet out below so the next one still comes back for learning
+            if not proactive_mode:
+                self.flood(datapath,dpid,in_port,eth_dst)
+
+        #if both are in same vlan than proceed foward
+        elif outcome == 'unicast':
+            self.packet_log.info("Adding flow: %s (src_mac) --> %s (dst_mac)", eth_src, eth_dst)
+            match = of_protocol_parser.OFPMatch(in_port=in_port, eth_src=eth_src, eth_dst=eth_dst)
+
+            #means there is a buffer id, the flow mod sends the buffered packet out so no packet out is needed
+            if msg.buffer_id != of_protocol.OFP_NO_BUFFER:
+                self.add_flow(datapath, match, LEARNED_PRIORITY, actions, msg.buffer_id, learned=True)
+                return outcome
             else:
-                #if both are not in the same vlan create a flow with empty action list. empty action list cause the packet to be dropped
-                self.logger.info("VLAN's are not same")
-                match = of_protocol_parser.OFPMatch(in_port=in_port, eth_src=eth_src, eth_dst=eth_dst)
-                actions = []
-                self.add_flow(datapath,match,1,actions)
+                self.add_flow(datapath,match,LEARNED_PRIORITY,actions,learned=True)
+        else:
+            #if both are not in the same vlan create a flow with empty action list. empty action list cause the packet to be dropped
+            self.packet_log.info("VLAN's are not same")
+            match = of_protocol_parser.OFPMatch(in_port=in_port, eth_src=eth_src, eth_dst=eth_dst)
+            #a buffered packet is dropped by the flow mod too
+            if msg.buffer_id != of_protocol.OFP_NO_BUFFER:
+                self.add_flow(datapath, match, LEARNED_PRIORITY, actions, msg.buffer_id, learned=True)
+                return outcome
+            self.add_flow(datapath,match,LEARNED_PRIORITY,actions,learned=True)
 
         #THE FOLLOWING WORK WILL BE PERFORMED FOR THE VERY FIRST PACKET WE RECIEVE. WE CREATE A RULE FOR IT
-        #AND THEN SEND IT OUT USING THE PACKET OUT FUNCTION
-
-        #get the group table it
-        grp_id = vlan_to_group[src_vid]
-        #set the action to group table to flood to same members of vlan
-        actions = [of_protocol_parser.OFPActionGroup(group_id=grp_id)]
-
-        #if switch cannot buffer the data than send the data along with the packet
-        data = None
-        if msg.buffer_id == of_protocol.OFP_NO_BUFFER:
-            data = msg.data
-        
-        #create a packet out to send the packet to be send and send it to the switch
-        pkt_out = of_protocol_parser.OFPPacketOut(datapath=datapath,buffer_id=msg.buffer_id, in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(pkt_out)
\ No newline at end of file
+        #AND THEN SEND IT OUT USING THE PACKET OUT FUNCTION: TO THE LEARNED PORT, DROPPED (NO ACTIONS, THIS STILL
+        #RELEASES A BUFFERED PACKET) ACROSS VLANS, OR FLOODED THROUGH THE GROUP TABLE OF THE VLAN
+
+        #create a packet out to send the packet to be send and send it to the switch. a buffered packet is sent
+        #by its buffer id, only a packet the switch cannot buffer is sent along with the data
+        pkt_out = packet_in_guard.packet_out(msg, in_port, actions)
+        if pkt_out is not None:
+            self.batcher.send_msg(datapath, pkt_out)
+        return outcome
+
+    #the (actions, outcome) of a packet from in_port to a destination learned on out_ports (None if unknown). it is
+    #cached and shared by every packet with the same key, so nothing may change it afterwards
+    def decide(self, dpid, in_port, out_ports, of_protocol_parser):
+        #get the source port vlan id by providing dpid and input port
+        src_vid = self.port_to_vlan[dpid][in_port][0]
+
+        #if we dont know the output port we need to flood
+        if out_ports is None:
+            #get the group table it and set the action to group table to flood to same members of vlan
+            grp_id = self.vlan_to_group[src_vid]
+            return [of_protocol_parser.OFPActionGroup(group_id=grp_id)], 'flood'
+
+        #get the destination port vlan id, a port that is in no vlan (anymore) is in none of the source
+        dst_vid = self.port_to_vlan[dpid].get(out_ports, [None])[0]
+        if src_vid == dst_vid:
+            #send it out of the port the destination was learned on
+            return [of_protocol_parser.OFPActionOutput(out_ports)], 'unicast'
+        #empty action list: dropped
+        return [], 'cross_vlan_drop'
+
+    #drop a packet the switch buffered instead of leaving it in the buffer until it times out
+    def release(self, msg, in_port):
+        pkt_out = packet_in_guard.packet_out(msg, in_port, [])
+        if pkt_out is not None:
+            self.batcher.send_msg(msg.datapath, pkt_out)
@@ -7,16 +7,37 @@
 
 
 
+import os
+
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
-from ryu.lib.packet import vlan
+from ryu.ofproto import ofproto_v1_3_parser
 from ryu.lib.packet import ether_types
 
+import eth_header
+import mac_table
+import msg_batcher
+import msg_template
+import packet_in_guard
+import reconcile
+import flow_inventory
+import stats_collector
+import metrics
+import packet_log
+import sharding
+import topology
+import arp_proxy
+import decision_cache
+import snapshot
+import vlan_config
+
+#VLAN CONFIGURATION FILE (JSON/YAML, SEE vlan_config.py). WHEN SET IT REPLACES THE GLOBAL VARIABLES BELOW
+#AND CHANGES TO IT ARE APPLIED TO THE SWITCHES WITHOUT RESTARTING THE CONTROLLER
+vlan_config_file = os.environ.get('VLAN_CONFIG_FILE')
+
 #GLOBAL VARIABLES  
  #port_vlan[a][b]=c => 'a'= dpid, 'b'= port number,'c'= VLAN ID
 port_vlan = {
@@ -34,7 +55,7 @@ port_vlan = {
       }
     } 
 
-#access[a]=[B] => 'a' = dpid ,'[B]'=List of ports configured as Access Ports			
+#access[a]=[B] => 'a' = dpid ,'[B]'=List of ports configured as Access Ports                    
 access= {
     1:[1,2,3],
     2:[1,2,3]
@@ -43,243 +64,804 @@ access= {
 trunk = {
     1:[4],
     2:[4]
-    }			
+    }                   
+
+#links = [(a,b,c,d)] => PORT 'b' OF dpid 'a' IS CABLED TO PORT 'd' OF dpid 'c' (E.G. (1,4,2,4) FOR THE TWO SWITCHES ABOVE)
+links = []
+
+#INSTALL THE FLOWS ALONG THE WHOLE PATH ON THE FIRST PACKET IN OF A HOST PAIR, NEEDS THE links (OR THE
+#"links" OF THE CONFIGURATION FILE). HOSTS ARE LOCATED ONCE FOR THE NETWORK, ON THEIR ACCESS PORT
+path_install = False
+
+#ANSWER ARP REQUESTS FOR KNOWN HOSTS FROM THE CONTROLLER (SEE arp_proxy.py) INSTEAD OF FLOODING THEM IN THE VLAN
+proxy_arp = False
+
+#FLOOD IN THE SWITCHES THROUGH ONE OFPGT_ALL GROUP PER (VLAN, TAGGED OR UNTAGGED INGRESS), BROADCASTS AND
+#MULTICASTS NEVER COME TO THE CONTROLLER. False FLOODS WITH PACKET OUTS FROM THE CONTROLLER INSTEAD
+group_flooding = True
+
+#PRIORITY OF THE FLOOD FLOWS. THEY ONLY MATCH BROADCAST/MULTICAST eth_dst, THE LEARNED FLOWS ONLY UNICAST ONES
+FLOOD_PRIORITY = 1
+
+#PRIORITY OF THE FLOW SENDING ARP REQUESTS TO THE CONTROLLER WHEN proxy_arp IS ON, ABOVE THE FLOOD FLOWS
+ARP_PROXY_PRIORITY = 2
+
+#eth_dst/MASK OF EVERY BROADCAST AND MULTICAST FRAME (GROUP BIT SET)
+MULTICAST_DST = ('01:00:00:00:00:00', '01:00:00:00:00:00')
+
+
+def flood_group_id(vid, tagged):
+    #GROUP TABLE ID OF THE FLOOD GROUP OF vid FOR FRAMES COMING IN TAGGED OR NOT, THE NATIVE VLAN ("NULL") HAS GROUP 0
+    if vid == "NULL":
+        return 0
+    return (vid << 1) | tagged
+
 class VlanSwitch13(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
     def __init__(self, *args, **kwargs):
         super(VlanSwitch13, self).__init__(*args, **kwargs)
-        self.mac_to_port = {}
-	
+        self.decisions = decision_cache.DecisionCache()        #FORWARDING DECISIONS, DROPPED WHEN THEIR DESTINATION CHANGES PORT
+        self.mac_to_port = mac_table.MacTables(on_change=self.decisions.mac_changed, backend=mac_table.backend)
+        self.batcher = msg_batcher.MessageBatcher(logger=self.logger)
+        self.templates = msg_template.MessageTemplates()       #SERIALIZED FLOW MODS/PACKET OUTS OF THE DECISIONS (SEE msg_template.py)
+        self.packet_in_guard = packet_in_guard.PacketInGuard(
+            self._packet_in_handler, self.logger, batcher=self.batcher)
+        self.flow_inventory = flow_inventory.FlowInventory(self.batcher, self.logger)
+        self.reconciler = reconcile.Reconciler(self.batcher, self.logger,
+                                               self.mac_to_port,
+                                               self.flow_inventory)
+        self.stats_collector = stats_collector.StatsCollector(self.batcher, self.logger, self.vlan_flood_groups)
+        self.packet_in_metrics = metrics.PacketInMetrics(self.name)
+        self.packet_in_metrics.add_batcher(self.batcher)
+        self.packet_in_metrics.add_decision_cache(self.decisions)
+        metrics.start_server(self.logger)
+        sharding.start_worker(self.logger)          #TAKES THE SWITCHES OF THIS SHARD FROM THE FRONT-END (SEE sharding.py)
+        self.packet_log = packet_log.PacketLog(self.logger)
+        self.datapaths = {}
+        self.flood_plans = {}
+        self.topology = topology.Topology()
+        self.host_locations = mac_table.MacTable()             #MAC -> (dpid, ACCESS PORT) FOR THE WHOLE NETWORK
+        self.link_discovery = topology.LinkDiscovery(self.batcher, self.topology, self.logger, self.topology_changed)
+        self.blocked = {}                                      #VLAN ID ("NULL" = NATIVE) -> LINK PORTS OFF ITS SPANNING TREE
+        self.arp_proxy = arp_proxy.ArpProxy()                  #IP -> MAC PER VLAN, FROM THE ARP PACKETS SEEN
+        self.flood_groups = {}                                 #dpid -> THE FLOOD GROUPS ON THE SWITCH (SEE flood_group_members)
+        self.snapshots = snapshot.Snapshots(self.name, self.mac_to_port, self.flow_inventory, self.logger)
+        self.snapshots.start()                                 #LEARNED MACS SURVIVE A RESTART (SEE snapshot.py)
+
+        if vlan_config_file:
+            config = vlan_config.load(vlan_config_file)
+        else:
+            config = vlan_config.VlanConfig.from_port_vlan(port_vlan, access, trunk, links)
+        self.set_vlan_config(config)
+
+        if vlan_config_file:
+            self.config_watcher = vlan_config.VlanConfigWatcher(vlan_config_file, self.reload_vlan_config, self.logger)
+            self.config_watcher.start()
+
+    def close(self):                                           #RYU-MANAGER IS SHUTTING DOWN, TAKE A LAST SNAPSHOT
+        self.snapshots.close()
+
+    def set_vlan_config(self, config):
+        #SAME SHAPES AS THE GLOBAL VARIABLES: port_vlan[dpid][port] = [VLAN IDS], access/trunk[dpid] = [PORTS]
+        self.vlan_config = config
+        self.port_vlan = config.port_vlan
+        self.access = config.access
+        self.trunk = config.trunk
+        self.topology.set_links(config.links)
+        self.blocked = self.flood_trees()
+        self.compile_flood_plans()
+
+    def flood_trees(self):
+        #SPANNING TREE OF EVERY VLAN (AND OF THE NATIVE VLAN) OVER THE LINKS THAT CARRY IT
+        vlans = set(["NULL"])
+        for dpid in self.port_vlan:
+            for port in self.port_vlan[dpid]:
+                vlans.update(vid for vid in self.port_vlan[dpid][port] if vid != " ")
+        return dict((vid, self.topology.blocked(lambda dpid, port, vid=vid: self.carries(dpid, port, vid)))
+                    for vid in vlans)
+
+    def topology_changed(self, added, removed):
+        #LINKS CAME OR WENT: WHAT WAS LEARNED THROUGH A LINK THAT IS GONE IS FORGOTTEN ON BOTH ENDS, AND ONLY
+        #THE FLOODING OF THE SWITCHES WHOSE TREES CHANGED IS RECOMPILED
+        reset = {}
+        for dpid, port, peer_dpid, peer_port in removed:
+            for end_dpid, end_port in ((dpid, port), (peer_dpid, peer_port)):
+                datapath = self.datapaths.get(end_dpid)
+                if datapath is not None:
+                    self.reset_port(datapath, end_port)
+                    reset.setdefault(end_dpid, set()).add(end_port)
+
+        blocked = self.flood_trees()
+        changes = topology.blocked_changes(self.blocked, blocked)
+        self.blocked = blocked
+        if changes:
+            self.logger.info("flood trees changed on %s", sorted(changes))
+            self.compile_flood_plans(changes)
+
+        if group_flooding:
+            for dpid in set(changes) | set(reset):
+                datapath = self.datapaths.get(dpid)
+                if datapath is None:
+                    continue
+                self.sync_flood_groups(datapath)
+                if dpid in changes:
+                    self.install_flood_flows(datapath)
+                else:                                           #reset_port TOOK THEIR FLOOD FLOWS AS WELL
+                    self.install_flood_flows(datapath, reset[dpid])
+
+    def reload_vlan_config(self, config):
+        #APPLY A NEW VLAN CONFIGURATION. FLOODING ONLY NEEDS THE PLANS RECOMPILED AND THE FLOOD GROUPS WHOSE
+        #MEMBERS CHANGED MODIFIED, ON THE SWITCHES ONLY THE FLOWS IN AND OUT OF PORTS WHOSE VLANS CHANGED (AND
+        #THE HOSTS LEARNED ON THEM) ARE REMOVED
+        changed_ports, changed_vlans = vlan_config.diff(self.vlan_config, config)
+        links_changed = set(self.vlan_config.links) != set(config.links)
+        old_blocked = self.blocked
+        self.set_vlan_config(config)
+        tree_changes = topology.blocked_changes(old_blocked, self.blocked)
+
+        if links_changed:                                       #INSTALLED PATHS MAY USE A LINK THAT IS GONE
+            self.logger.info("inter-switch links changed")
+            for mac, location in self.host_locations.items():
+                self.forget_host(mac)
+
+        for dpid in changed_ports:
+            datapath = self.datapaths.get(dpid)
+            if datapath is None:
+                continue
+            self.logger.info("vlan configuration changed on %s ports %s", dpid, sorted(changed_ports[dpid]))
+            for port in changed_ports[dpid]:
+                self.reset_port(datapath, port)
+
+        if group_flooding:
+            for dpid, datapath in self.datapaths.items():
+                self.sync_flood_groups(datapath)
+                if dpid in tree_changes:
+                    self.install_flood_flows(datapath)
+                elif dpid in changed_ports:
+                    self.install_flood_flows(datapath, changed_ports[dpid])
+
+    def reset_port(self, datapath, port):
+        parser = datapath.ofproto_parser
+
+        self.delete_flows(datapath, parser.OFPMatch(in_port=port))
+        self.delete_flows(datapath, parser.OFPMatch(), out_port=port)
+        for mac in self.mac_to_port.evict_port(datapath.id, port):
+            self.delete_flows(datapath, parser.OFPMatch(eth_dst=mac))
+
+    def forget_host(self, mac):
+        #REMOVE THE PATH FLOWS TOWARDS mac FROM EVERY SWITCH, E.G. WHEN IT MOVED TO ANOTHER ACCESS PORT
+        self.host_locations.evict(mac)
+        for datapath in self.datapaths.values():
+            self.delete_flows(datapath, datapath.ofproto_parser.OFPMatch(eth_dst=mac))
+
+    def delete_flows(self, datapath, match, out_port=None):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        if out_port is None:
+            out_port = ofproto.OFPP_ANY
+        mod = parser.OFPFlowMod(datapath=datapath, command=ofproto.OFPFC_DELETE,
+                                out_port=out_port, out_group=ofproto.OFPG_ANY,
+                                match=match)
+        self.batcher.send_msg(datapath, mod)
+        
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
         datapath = ev.msg.datapath
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        self.datapaths[datapath.id] = datapath
+
+        #ONLY SEND WHAT THE SWITCH DOES NOT ALREADY HAVE (SEE reconcile.py)
+        self.flow_inventory.reset(datapath.id)
+        self.templates.forget(datapath.id)
+        self.snapshots.restore(datapath.id)                   #MACS OF THE LAST SNAPSHOT, THE FLOW DUMP OF THE SWITCH CORRECTS THEM
+        self.batcher.hold(datapath)
 
         # install table-miss flow entry
         #
-        # We specify NO BUFFER to max_len of the output action due to
-        # OVS bug. At this moment, if we specify a lesser number, e.g.,
-        # 128, OVS will send Packet-In with invalid buffer_id and
-        # truncated packet data. In that case, we cannot output packets
-        # correctly.  The bug has been fixed in OVS v2.1.0.
+        # max_len is NO BUFFER unless a miss_send_len is configured for
+        # the switch (see packet_in_guard.py). Before OVS v2.1.0 a lesser
+        # number, e.g., 128, made OVS send Packet-In with invalid
+        # buffer_id and truncated packet data, so only configure it for
+        # switches that buffer correctly.
         match = parser.OFPMatch()
-        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
-        self.add_flow(datapath, 0, match, actions)
+        max_len = self.packet_in_guard.install_miss_send_len(datapath, self.batcher)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, max_len)]
+        meter_id = self.packet_in_guard.install_meter(datapath, self.batcher)
+        self.add_flow(datapath, 0, match, actions, meter_id=meter_id)
+
+        #LLDP PROBES OF THE LINK DISCOVERY COME BACK TO THE CONTROLLER, WHATEVER ELSE IS INSTALLED
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_LLDP)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+        self.add_flow(datapath, topology.LLDP_PRIORITY, match, actions)
+
+        if group_flooding:
+            #THE SWITCH FLOODS BY ITSELF, ONLY UNKNOWN UNICAST STILL COMES TO THE CONTROLLER
+            self.flood_groups[datapath.id] = {}
+            self.sync_flood_groups(datapath)
+            self.install_flood_flows(datapath)
+            if proxy_arp:                                           #THE ARP PROXY STILL GETS TO SEE THE REQUESTS
+                match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP, arp_op=arp_proxy.ARP_REQUEST)
+                actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+                self.add_flow(datapath, ARP_PROXY_PRIORITY, match, actions, meter_id=meter_id)
+
+        self.reconciler.reconcile(datapath, self.batcher.take_held(datapath))
+        self.stats_collector.add_datapath(datapath)
+        self.link_discovery.add_datapath(datapath)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, ev):
+        if self.reconciler.flow_stats_reply(ev.msg):
+            return
+        if self.flow_inventory.flow_stats_reply(ev.msg):
+            return
+        self.stats_collector.flow_stats_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def _port_stats_reply_handler(self, ev):
+        self.stats_collector.port_stats_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPGroupStatsReply, MAIN_DISPATCHER)
+    def _group_stats_reply_handler(self, ev):
+        self.stats_collector.group_stats_reply(ev.msg)
 
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+    @set_ev_cls(ofp_event.EventOFPPortDescStatsReply, MAIN_DISPATCHER)
+    def _port_desc_reply_handler(self, ev):
+        self.link_discovery.port_desc_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, ev):
+        self.link_discovery.port_status(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        self.flow_inventory.flow_removed(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPGroupDescStatsReply, MAIN_DISPATCHER)
+    def _group_desc_reply_handler(self, ev):                 #PART OF THE GROUP DUMP OF A RECONNECTING SWITCH
+        self.reconciler.group_desc_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):                    #THE SWITCH HAS APPLIED EVERYTHING QUEUED BEFORE THE BARRIER
+        if self.batcher.barrier_reply(ev.msg):
+            self.logger.debug("Barrier reply from dpid: %s", ev.msg.datapath.id)
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 meter_id=None, learned=False):
+        mod = self.flow_mod(datapath, priority, match, actions, buffer_id, meter_id)
+        if learned:                                         #LEARNED FLOWS TIME OUT (SEE flow_inventory.py)
+            self.flow_inventory.track(datapath, mod)
+        self.batcher.send_msg(datapath, mod)
+
+    def flow_mod(self, datapath, priority, match, actions, buffer_id=None, meter_id=None):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                              actions)]
-        if buffer_id:
+        if meter_id is not None:
+            inst.insert(0, parser.OFPInstructionMeter(meter_id))
+        if buffer_id is not None:                           #BUFFER ID 0 IS A VALID BUFFER
             mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
                                     priority=priority, match=match,
                                     instructions=inst)
         else:
             mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
                                     match=match, instructions=inst)
-        datapath.send_msg(mod)
+        return mod
 
 
     def vlan_members(self,dpid,in_port,src_vlan):
-	
-	B=[]
-	self.access_ports = []
-	self.trunk_ports = []
-	
-	if src_vlan == "NULL":
-	    return
-	
-	for item in port_vlan[dpid]:
-    	    vlans=port_vlan[dpid][item]
-            if src_vlan in vlans and item!=in_port:
+        #RETURNS (ACCESS PORTS, TRUNK PORTS) OF src_vlan ON dpid, EXCLUDING in_port
+        
+        B=[]
+        access_ports = []
+        trunk_ports = []
+        
+        if src_vlan == "NULL":
+            return access_ports, trunk_ports
+        
+        blocked = self.blocked.get(src_vlan, ())
+        for item in self.port_vlan[dpid]:
+            vlans=self.port_vlan[dpid][item]
+            if src_vlan in vlans and item!=in_port and (dpid, item) not in blocked:     #ONLY ALONG THE VLAN'S TREE
                 B.append(item)
 
 
-	for port in B:
-	    if port in access[dpid]:
-	        self.access_ports.append(port)
-	    else:
-		self.trunk_ports.append(port)
+        for port in B:
+            if port in self.access[dpid]:
+                access_ports.append(port)
+            else:
+                trunk_ports.append(port)
+
+        return access_ports, trunk_ports
+
+    def getFloodActions(self,dpid,in_port,src_vlan,vlan_header_present,parser):
+        if dpid not in self.port_vlan:                                              # FOR NORMAL NON-VLAN L2 SWITCH
+            blocked = self.blocked.get(src_vlan, ())
+            ports = self.link_discovery.ports.get(dpid)
+            if ports and any((dpid, port) in blocked for port in ports):            #EVERY PORT BUT THE BLOCKED ONES
+                return [parser.OFPActionOutput(port) for port in sorted(ports)
+                        if port != in_port and (dpid, port) not in blocked]
+            return [parser.OFPActionOutput(ofproto_v1_3.OFPP_FLOOD)]
+
+        out_port_access, out_port_trunk = self.vlan_members(dpid,in_port,src_vlan)
+
+        if vlan_header_present:                                                     #IF TAGGED
+            return self.getActionsArrayTrunk(out_port_access,out_port_trunk,parser)
+        elif src_vlan!= "NULL":                                                     #IF UNTAGGED  BUT GENERATED FROM VLAN ASSOCIATED PORT
+            return self.getActionsArrayAccess(out_port_access,out_port_trunk,src_vlan, parser)
+        else:                                                                       #IF UNTAGGED AND BELONGING TO NATIVE VLAN (CAPTURED ON A VLAN AWARE SWITCH)
+            return self.getActionsNormalUntagged(dpid,in_port,parser)
+
+    def compile_flood_plans(self, dpids=None):
+        #PRECOMPUTE THE FLOOD ACTIONS FOR EVERY (dpid, in_port, src_vlan, tagged) OF THE VLAN CONFIGURATION
+        #SO THAT FLOODING ON A PACKET IN IS A SINGLE DICTIONARY LOOKUP. THE PLANS ARE TUPLES AND SHARED
+        #BY ALL PACKET OUTS, THEY MUST BE RECOMPILED WHENEVER port_vlan, access, trunk OR THE FLOOD TREES
+        #CHANGE (ONLY FOR dpids IF GIVEN). THE CACHED DECISIONS AND THEIR TEMPLATES DEPEND ON THE SAME, THEY ARE DROPPED
+        parser = ofproto_v1_3_parser
+        self.decisions.clear()
+        self.templates.clear()
+        if dpids is None:
+            plans = {}
+            dpids = self.port_vlan
+        else:
+            plans = dict((key, plan) for key, plan in self.flood_plans.items() if key[0] not in dpids)
+
+        for dpid in dpids:
+            if dpid not in self.port_vlan:
+                continue
+            dpid_vlans = set()
+            for port in self.port_vlan[dpid]:
+                dpid_vlans.update(vid for vid in self.port_vlan[dpid][port] if vid != " ")
+
+            for in_port in self.port_vlan[dpid]:
+                #TAGGED FRAMES CAN CARRY ANY VLAN CONFIGURED ON THE SWITCH
+                for vid in dpid_vlans:
+                    plans[(dpid, in_port, vid, 1)] = self.flood_plan(dpid, in_port, vid, 1, parser)
+
+                #UNTAGGED FRAMES BELONG TO THE ACCESS VLAN OF THE PORT OR TO THE NATIVE VLAN
+                if self.port_vlan[dpid][in_port][0] == " " or in_port in self.trunk[dpid]:
+                    src_vlan = "NULL"
+                else:
+                    src_vlan = self.port_vlan[dpid][in_port][0]
+                plans[(dpid, in_port, src_vlan, 0)] = self.flood_plan(dpid, in_port, src_vlan, 0, parser)
+
+        self.flood_plans = plans
+
+    def flood_plan(self,dpid,in_port,src_vlan,vlan_header_present,parser):
+        if group_flooding:                                      #THE FLOOD GROUP DOES THE WORK, THE SWITCH SKIPS in_port
+            return (parser.OFPActionGroup(flood_group_id(src_vlan, vlan_header_present)),)
+        return tuple(self.getFloodActions(dpid, in_port, src_vlan, vlan_header_present, parser))
+
+    def flood_group_members(self, dpid):
+        #THE FLOOD GROUPS dpid NEEDS: GROUP ID -> (VLAN ID OR "NULL", TAGGED, ACCESS MEMBERS, TRUNK MEMBERS),
+        #TWO PER VLAN ON THE SWITCH (FOR FRAMES COMING IN TAGGED AND UNTAGGED) AND ONE FOR THE NATIVE VLAN
+        groups = {}
+        blocked = self.blocked.get("NULL", ())
+        native_ports = tuple(port for port in sorted(self.port_vlan[dpid])
+                             if self.carries(dpid, port, "NULL") and (dpid, port) not in blocked)
+        groups[flood_group_id("NULL", 0)] = ("NULL", 0, native_ports, ())
+
+        dpid_vlans = set()
+        for port in self.port_vlan[dpid]:
+            dpid_vlans.update(vid for vid in self.port_vlan[dpid][port] if vid != " ")
+        for vid in dpid_vlans:
+            out_port_access, out_port_trunk = self.vlan_members(dpid, None, vid)
+            for tagged in (0, 1):
+                groups[flood_group_id(vid, tagged)] = (vid, tagged, tuple(sorted(out_port_access)),
+                                                       tuple(sorted(out_port_trunk)))
+        return groups
+
+    def vlan_flood_groups(self):
+        #VLAN ID -> THE FLOOD GROUPS ON THE SWITCHES (UNTAGGED AND TAGGED INGRESS), FOR THE PER VLAN STATISTICS
+        groups = {}
+        for dpid_groups in self.flood_groups.values():
+            for group_id, members in dpid_groups.items():
+                groups.setdefault(members[0], set()).add(group_id)
+        return dict((vid, tuple(sorted(group_ids))) for vid, group_ids in groups.items())
+
+    def getFloodBuckets(self,members,parser):
+        #ONE BUCKET PER MEMBER PORT, EVERY BUCKET WORKS ON ITS OWN COPY OF THE FRAME SO THE TAG IS PUSHED OR
+        #POPPED PER PORT, NOT IN THE ORDER OF A SINGLE ACTION LIST
+        src_vlan, vlan_header_present, out_port_access, out_port_trunk = members
+        buckets = []
+
+        for port in out_port_access:
+            if vlan_header_present:
+                actions = [parser.OFPActionPopVlan(), parser.OFPActionOutput(port)]
+            else:
+                actions = [parser.OFPActionOutput(port)]
+            buckets.append(parser.OFPBucket(actions=actions))
+
+        for port in out_port_trunk:
+            if vlan_header_present:
+                actions = [parser.OFPActionOutput(port)]
+            else:
+                actions = [parser.OFPActionPushVlan(33024), parser.OFPActionSetField(vlan_vid=src_vlan),
+                           parser.OFPActionOutput(port)]
+            buckets.append(parser.OFPBucket(actions=actions))
+
+        return buckets
+
+    def sync_flood_groups(self, datapath):
+        #ADD, MODIFY OR DELETE THE FLOOD GROUPS OF datapath WHOSE MEMBERS DIFFER FROM WHAT IS ON THE SWITCH
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+        if dpid not in self.port_vlan:
+            return
+
+        desired = self.flood_group_members(dpid)
+        installed = self.flood_groups.get(dpid, {})
+        sent = False
+        for group_id in sorted(desired):
+            if installed.get(group_id) == desired[group_id]:
+                continue
+            command = ofproto.OFPGC_MODIFY if group_id in installed else ofproto.OFPGC_ADD
+            req = parser.OFPGroupMod(datapath, command, ofproto.OFPGT_ALL, group_id,
+                                     self.getFloodBuckets(desired[group_id], parser))
+            self.batcher.send_msg(datapath, req)
+            sent = True
+        for group_id in sorted(set(installed) - set(desired)):       #THE SWITCH DELETES THE FLOWS USING IT AS WELL
+            req = parser.OFPGroupMod(datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_ALL, group_id, [])
+            self.batcher.send_msg(datapath, req)
+            sent = True
+        self.flood_groups[dpid] = desired
+
+        if sent:                                                      #GROUPS FIRST, THEN THE FLOWS USING THEM
+            self.batcher.barrier(datapath)
+
+    def install_flood_flows(self, datapath, ports=None):
+        #SEND THE BROADCASTS/MULTICASTS OF EVERY PORT (OR ONLY ports) TO THE FLOOD GROUP OF THEIR VLAN AND
+        #INGRESS KIND. A PORT OFF THE VLAN'S SPANNING TREE DROPS THEM INSTEAD
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+        if dpid not in self.port_vlan:
+            return
+
+        for port in sorted(ports or self.port_vlan[dpid]):
+            vlans = self.port_vlan[dpid].get(port)
+            if vlans is None:
+                continue
+            if port in self.trunk[dpid]:
+                for vid in vlans:
+                    self.add_flood_flow(datapath, port, vid, 1, 0x1000 | vid)
+                self.add_flood_flow(datapath, port, "NULL", 0, ofproto.OFPVID_NONE)
+            elif vlans[0] == " ":
+                self.add_flood_flow(datapath, port, "NULL", 0, ofproto.OFPVID_NONE)
+            else:
+                self.add_flood_flow(datapath, port, vlans[0], 0, ofproto.OFPVID_NONE)
+
+    def add_flood_flow(self, datapath, port, src_vlan, vlan_header_present, vlan_vid):
+        parser = datapath.ofproto_parser
+
+        if (datapath.id, port) in self.blocked.get(src_vlan, ()):
+            actions = []
+        else:
+            actions = [parser.OFPActionGroup(flood_group_id(src_vlan, vlan_header_present))]
+        match = parser.OFPMatch(in_port=port, eth_dst=MULTICAST_DST, vlan_vid=vlan_vid)
+        self.add_flow(datapath, FLOOD_PRIORITY, match, actions)
 
 #---------------------------------------------------------------#
  
     def getActionsArrayTrunk(self,out_port_access,out_port_trunk,parser):
-	actions= [ ]
-	
-	for port in out_port_trunk:
-	    actions.append(parser.OFPActionOutput(port))
+        actions= [ ]
+        
+        for port in out_port_trunk:
+            actions.append(parser.OFPActionOutput(port))
 
-	actions.append(parser.OFPActionPopVlan())
+        actions.append(parser.OFPActionPopVlan())
 
-	for port in out_port_access:
-	    actions.append(parser.OFPActionOutput(port))
+        for port in out_port_access:
+            actions.append(parser.OFPActionOutput(port))
 
         return actions
 
 
     def getActionsArrayAccess(self,out_port_access,out_port_trunk,src_vlan, parser):
-	actions= [ ]
-	
+        actions= [ ]
+        
 
-	for port in out_port_access:
-	    actions.append(parser.OFPActionOutput(port))
-	
-	actions.append(parser.OFPActionPushVlan(33024))
-	actions.append(parser.OFPActionSetField(vlan_vid=src_vlan))
+        for port in out_port_access:
+            actions.append(parser.OFPActionOutput(port))
+        
+        actions.append(parser.OFPActionPushVlan(33024))
+        actions.append(parser.OFPActionSetField(vlan_vid=src_vlan))
 
-	for port in out_port_trunk:
-	    actions.append(parser.OFPActionOutput(port))
+        for port in out_port_trunk:
+            actions.append(parser.OFPActionOutput(port))
 
         return actions
 
     def getActionsNormalUntagged(self,dpid,in_port,parser):
-	actions= [ ]
+        actions= [ ]
+        blocked = self.blocked.get("NULL", ())
 
-	for port in port_vlan[dpid]:
-	    if port_vlan[dpid][port][0]==" " and port!=in_port:
-	        actions.append(parser.OFPActionOutput(port))
+        for port in self.port_vlan[dpid]:
+            if self.port_vlan[dpid][port][0]==" " and port!=in_port and (dpid, port) not in blocked:
+                actions.append(parser.OFPActionOutput(port))
         
 
-	if dpid in trunk:
-	
-	    for port in trunk[dpid]:
-	        if port!=in_port:
-	            actions.append(parser.OFPActionOutput(port))
+        if dpid in self.trunk:
+        
+            for port in self.trunk[dpid]:
+                if port!=in_port and (dpid, port) not in blocked:
+                    actions.append(parser.OFPActionOutput(port))
 
-	return actions
+        return actions
+
+#---------------------------------------------------------------#
+
+    def carries(self,dpid,port,vid):
+        #TRUE IF port OF dpid CARRIES vid ("NULL" = THE NATIVE VLAN). A NORMAL NON-VLAN SWITCH CARRIES ALL OF THEM
+        if dpid not in self.port_vlan:
+            return True
+        vlans = self.port_vlan[dpid].get(port)
+        if vlans is None:
+            return False
+        if vid == "NULL":
+            return vlans[0] == " " or port in self.trunk[dpid]
+        return vid in vlans
+
+    def is_edge_port(self,dpid,port):
+        #HOSTS ARE ONLY LOCATED ON ACCESS PORTS, NEVER ON TRUNKS OR PORTS CABLED TO ANOTHER SWITCH
+        return (dpid in self.access and port in self.access[dpid]
+                and not self.topology.is_link(dpid, port))
+
+    def install_path(self,msg,in_port,dst,src_vlan,vlan_header_present,location):
+        #INSTALL THE FLOWS TOWARDS dst ON EVERY SWITCH OF THE PATH AND SEND THE PACKET ON ITS WAY.
+        #RETURNS False (NOTHING SENT) IF THERE IS NO PATH IN src_vlan
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        dst_dpid, dst_port = location
+
+        if src_vlan not in self.port_vlan.get(dst_dpid, {}).get(dst_port, ()):
+            return False
+        blocked = self.blocked.get(src_vlan, ())
+        hops = self.topology.path(datapath.id, dst_dpid,
+                                  lambda dpid, port: src_vlan in self.port_vlan.get(dpid, {}).get(port, ())
+                                  and (dpid, port) not in blocked)
+        if not hops or dst_dpid not in self.datapaths:
+            return False
+        if any(hop_dpid not in self.datapaths for hop_dpid, out_port in hops):
+            return False
+
+        #LAST SWITCH FIRST, SO THE PACKET FINDS ITS FLOWS ON EVERY HOP. AFTER THE FIRST SWITCH THE
+        #PACKET IS TAGGED, THE FLOWS THERE MATCH ANY IN PORT
+        tag = 0x1000 | src_vlan
+        egress = self.datapaths[dst_dpid]
+        match = egress.ofproto_parser.OFPMatch(eth_dst=dst, vlan_vid=tag)
+        actions = [egress.ofproto_parser.OFPActionPopVlan(), egress.ofproto_parser.OFPActionOutput(dst_port)]
+        self.add_flow(egress, 1, match, actions, learned=True)
+
+        for hop_dpid, out_port in reversed(hops[1:]):
+            transit = self.datapaths[hop_dpid]
+            match = transit.ofproto_parser.OFPMatch(eth_dst=dst, vlan_vid=tag)
+            actions = [transit.ofproto_parser.OFPActionOutput(out_port)]
+            self.add_flow(transit, 1, match, actions, learned=True)
+
+        out_port = hops[0][1]
+        if vlan_header_present:
+            match = parser.OFPMatch(in_port=in_port, eth_dst=dst, vlan_vid=tag)
+            actions = [parser.OFPActionOutput(out_port)]
+        else:
+            match = parser.OFPMatch(in_port=in_port, eth_dst=dst)
+            actions = [parser.OFPActionPushVlan(33024), parser.OFPActionSetField(vlan_vid=src_vlan), parser.OFPActionOutput(out_port)]
+
+        if msg.buffer_id != ofproto.OFP_NO_BUFFER:
+            self.add_flow(datapath, 1, match, actions, msg.buffer_id, learned=True)
+            return True
+        self.add_flow(datapath, 1, match, actions, learned=True)
+        out = packet_in_guard.packet_out(msg, in_port, actions)
+        if out is not None:
+            self.batcher.send_msg(datapath, out)
+        return True
 
 #---------------------------------------------------------------#
 
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
-        # If you hit this you might want to increase
-        # the "miss_send_length" of your switch
-        if ev.msg.msg_len < ev.msg.total_len:
+        if not self.packet_in_guard.admit(ev):
+            return
+        start = metrics.clock()
+        outcome = self.handle_packet_in(ev)
+        self.packet_in_metrics.record(ev.msg.datapath.id, outcome, metrics.clock() - start)
+
+    def handle_packet_in(self, ev):
+        #RETURNS THE FORWARDING DECISION (tagged_access, tagged_trunk, untagged_trunk, untagged_access,
+        #native, path, arp_reply, blocked, unconfigured OR flood) FOR THE METRICS
+        #
+        # A truncated packet is only forwarded if the switch buffered it.
+        # If you hit this you might want to increase the "miss_send_length"
+        # of your switch or check that it buffers packets.
+        if (ev.msg.buffer_id == ev.msg.datapath.ofproto.OFP_NO_BUFFER and
+                packet_in_guard.truncated(ev.msg)):
             self.logger.debug("packet truncated: only %s of %s bytes",
-                              ev.msg.msg_len, ev.msg.total_len)
+                              len(ev.msg.data), ev.msg.total_len)
         msg = ev.msg
         datapath = msg.datapath
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
-	
-	
-	#SWITCH ID
+        
+        
+        #SWITCH ID
         dpid = datapath.id
 
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
-	vlan_header = pkt.get_protocols(vlan.vlan)    #If packet is tagged,then this will have non-null value
-
-	
-
-	
-	if eth.ethertype == ether_types.ETH_TYPE_8021Q :       #Checking for VLAN Tagged Packet
-	    vlan_header_present = 1
-	    src_vlan=vlan_header[0].vid
-	elif dpid not in port_vlan:
-	    vlan_header_present = 0
-	    in_port_type = "NORMAL SWITCH "                    #NORMAL NON-VLAN L2 SWITCH
-	    src_vlan = "NULL"
-	elif port_vlan[dpid][in_port][0]== " " or in_port in trunk[dpid]:
-	    vlan_header_present = 0
-	    in_port_type = "NORMAL UNTAGGED"                  #NATIVE VLAN PACKET
-	    src_vlan = "NULL"
-	else:
-	    vlan_header_present = 0
-            src_vlan=port_vlan[dpid][in_port][0]               # STORE VLAN ASSOCIATION FOR THE IN PORT
+        eth = eth_header.decode(msg.data)             #Ethernet + 802.1Q fields only, read straight from msg.data
+        if eth is None:                               #Truncated below the headers it announces
+            self.release(msg, in_port)
+            return 'invalid'
 
         if eth.ethertype == ether_types.ETH_TYPE_LLDP:
-            # ignore lldp packet
-            return
-	
-        dst = eth.dst
-        src = eth.src
-	
+            # lldp probes find the links between the switches
+            self.link_discovery.packet_in(msg)
+            self.release(msg, in_port)
+            return 'lldp'
+
+        if dpid in self.port_vlan and in_port not in self.port_vlan[dpid]:   #PORT IN NO VLAN (E.G. DROPPED BY A RELOAD)
+            self.release(msg, in_port)
+            return 'unconfigured'
+
+        if eth.ethertype == ether_types.ETH_TYPE_8021Q :       #Checking for VLAN Tagged Packet
+            vlan_header_present = 1
+            src_vlan=eth.vid
+        elif dpid not in self.port_vlan:
+            vlan_header_present = 0
+            in_port_type = "NORMAL SWITCH "                    #NORMAL NON-VLAN L2 SWITCH
+            src_vlan = "NULL"
+        elif self.port_vlan[dpid][in_port][0]== " " or in_port in self.trunk[dpid]:
+            vlan_header_present = 0
+            in_port_type = "NORMAL UNTAGGED"                  #NATIVE VLAN PACKET
+            src_vlan = "NULL"
+        else:
+            vlan_header_present = 0
+            src_vlan=self.port_vlan[dpid][in_port][0]          # STORE VLAN ASSOCIATION FOR THE IN PORT
 
-	#CREATE NEW DICTIONARY ENTRY IF IT DOES NOT EXIST
-        self.mac_to_port.setdefault(dpid, {})
+        if (dpid, in_port) in self.blocked.get(src_vlan, ()):  #LINK OFF THE VLAN'S TREE, DISCARD LIKE A BLOCKED STP PORT
+            self.release(msg, in_port)
+            return 'blocked'
+        
+        dst = eth.dst_str
+        src = eth.src_str
+        
 
-        self.logger.info("packet in %s %s %s %s", dpid, src, dst, in_port)
+        self.packet_log.info("packet in %s %s %s %s", dpid, src, dst, in_port)
 
         # learn a mac address to avoid FLOOD next time.
-        self.mac_to_port[dpid][src] = in_port
-	
-	#Determine which ports are members of in_port's VLAN
-	self.vlan_members(dpid,in_port,src_vlan)  	
-	out_port_type = " "        
-
-        if dst in self.mac_to_port[dpid]:                       #MAC ADDRESS TABLE CREATION
-	    out_port_unknown = 0
-            out_port = self.mac_to_port[dpid][dst]
-	    if src_vlan!= "NULL":
-	        if out_port in access[dpid]:
-	            out_port_type = "ACCESS"
-	        else:
-	            out_port_type = "TRUNK"
-	    else :
-	        out_port_type = "NORMAL"
-        else:
-	    out_port_unknown = 1
-            out_port_access = self.access_ports        #List of All Access Ports Which are Members of Same VLAN (to Flood the Traffic)
-	    out_port_trunk = self.trunk_ports	       #List of All Trunk  Ports Which are Members of Same VLAN (to Flood the Traffic)
+        self.mac_to_port.learn(dpid, src, in_port)
+
+        if proxy_arp and eth.payload_type == ether_types.ETH_TYPE_ARP:
+            reply = self.arp_proxy.handle(src_vlan, eth)
+            if reply is not None:                               #TARGET KNOWN, ANSWER ON THE PORT THE REQUEST CAME IN
+                actions = [parser.OFPActionOutput(in_port)]
+                out = parser.OFPPacketOut(datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER,
+                                          in_port=ofproto.OFPP_CONTROLLER, actions=actions, data=reply)
+                self.batcher.send_msg(datapath, out)
+                self.release(msg, in_port)                      #THE REQUEST ITSELF GOES NO FURTHER
+                return 'arp_reply'
+
+        if path_install and src_vlan != "NULL":
+            if not vlan_header_present and self.is_edge_port(dpid, in_port):
+                old_location = self.host_locations.learn(src, (dpid, in_port))
+                if old_location is not None and old_location != (dpid, in_port):    #HOST MOVED, ITS OLD PATHS ARE WRONG
+                    self.forget_host(src)
+                    self.host_locations.learn(src, (dpid, in_port))
+
+            location = self.host_locations.get(dst)
+            if location is not None and location[0] != dpid:
+                if self.install_path(msg, in_port, dst, src_vlan, vlan_header_present, location):
+                    return 'path'
+        
+        out_port = self.mac_to_port.get(dpid, dst)              #NONE IF NEVER LEARNED OR AGED OUT (WHICH DROPS ITS CACHED DECISIONS)
+
+        #SAME SWITCH, IN PORT, TAG AND DESTINATION AS AN EARLIER PACKET: REUSE ITS DECISION (SEE decision_cache.py)
+        #ONLY AN 802.1Q TAG COUNTS, AN 802.1AD FRAME IS HANDLED AS UNTAGGED ABOVE
+        key = (dpid, in_port, src_vlan if vlan_header_present else None, dst)
+        plan = self.decisions.get(key)
+        if plan is None:
+            plan = self.decide(datapath, in_port, dst, src_vlan, vlan_header_present, out_port)
+            self.decisions.put(key, plan)
+        flow, values, fields, out, outcome = plan
+
 
-	
 
 #########################################  -----FLOW ENTRY ADDITION SEGMENT    ----###############################################
 #
 
 
+        if flow is not None:                                                              # IF OUT PORT IS KNOWN 
+            self.batcher.send_raw(datapath, flow.render(msg.buffer_id, values), flow.msg_type)
+            self.flow_inventory.record(datapath, 0, 1, fields)                           #LEARNED FLOW, SENT FROM ITS TEMPLATE
+            # verify if we have a valid buffer_id, if avoid yes to send both
+            # flow_mod & packet_out
+            if msg.buffer_id != ofproto.OFP_NO_BUFFER:
+                return outcome
+
+
+        out = packet_in_guard.render_packet_out(msg, in_port, out)   #BY BUFFER ID IF BUFFERED, THE DATA IS NOT SENT BACK
+        if out is not None:
+            self.batcher.send_raw(datapath, out, ofproto.OFPT_PACKET_OUT)
+        return outcome
+
+    def decide(self, datapath, in_port, dst, src_vlan, vlan_header_present, out_port):
+        #THE PLAN (flow, values, fields, out, outcome) OF A PACKET TOWARDS dst: THE TEMPLATE OF THE LEARNED FLOW WITH
+        #THE VALUES OF ITS in_port/eth_dst AND ITS MATCH FIELDS (ALL None WHEN THE PACKET IS FLOODED) AND THE TEMPLATE OF
+        #THE PACKET OUT. THE RESULT IS CACHED AND SHARED BY ALL PACKETS WITH THE SAME KEY, NOTHING MAY CHANGE IT AFTERWARDS
+        dpid = datapath.id
+        parser = datapath.ofproto_parser
+        out_port_type = " "        
+
+        if out_port is not None:                                #MAC ADDRESS TABLE CREATION
+            out_port_unknown = 0
+            if src_vlan!= "NULL":
+                if out_port in self.access[dpid]:
+                    out_port_type = "ACCESS"
+                else:
+                    out_port_type = "TRUNK"
+            else :
+                out_port_type = "NORMAL"
+        else:
+            out_port_unknown = 1
+
         if out_port_unknown!=1:                                                           # IF OUT PORT IS KNOWN 
-	    if vlan_header_present and out_port_type == "ACCESS" :                      #If VLAN Tagged and needs to be sent out through ACCESS port 
+            if vlan_header_present and out_port_type == "ACCESS" :                      #If VLAN Tagged and needs to be sent out through ACCESS port 
                 match = parser.OFPMatch(in_port=in_port, eth_dst=dst, vlan_vid=(0x1000 | src_vlan))  
                 actions = [parser.OFPActionPopVlan(), parser.OFPActionOutput(out_port)]   # STRIP VLAN TAG and SEND TO OUTPUT PORT
+                outcome = 'tagged_access'
             elif vlan_header_present and out_port_type == "TRUNK" :
                 match = parser.OFPMatch(in_port=in_port, eth_dst=dst, vlan_vid=(0x1000 | src_vlan))
                 actions = [parser.OFPActionOutput(out_port)]                              #SEND THROUGH TRUNK PORT AS IS   
-	    elif vlan_header_present!=1 and out_port_type == "TRUNK" :
-	        match = parser.OFPMatch(in_port=in_port, eth_dst=dst)
+                outcome = 'tagged_trunk'
+            elif vlan_header_present!=1 and out_port_type == "TRUNK" :
+                match = parser.OFPMatch(in_port=in_port, eth_dst=dst)
                 actions = [parser.OFPActionPushVlan(33024), parser.OFPActionSetField(vlan_vid=src_vlan), parser.OFPActionOutput(out_port)]
-	    else:
-		match = parser.OFPMatch(in_port=in_port, eth_dst=dst)
-	        actions = [parser.OFPActionOutput(out_port)]
-		
-
-	    # verify if we have a valid buffer_id, if avoid yes to send both
-            # flow_mod & packet_out
-            if msg.buffer_id != ofproto.OFP_NO_BUFFER:
-                self.add_flow(datapath, 1, match, actions, msg.buffer_id)
-                return
+                outcome = 'untagged_trunk'
             else:
-                self.add_flow(datapath, 1, match, actions)
-
-	else :                                                                                          #FOR FLOODING ACTIONS
-	    if vlan_header_present:                                                                     #IF TAGGED
-                actions = self.getActionsArrayTrunk(out_port_access,out_port_trunk,parser)
-	    elif vlan_header_present==0 and src_vlan!= "NULL":                                          #IF UNTAGGED  BUT GENERATED FROM VLAN ASSOCIATED PORT
-		actions = self.getActionsArrayAccess(out_port_access,out_port_trunk,src_vlan, parser)
-	    elif in_port_type == "NORMAL UNTAGGED":                                                     #IF UNTAGGED AND BELONGING TO NATIVE VLAN (CAPTURED ON A VLAN AWARE SWITCH)
-	        actions = self.getActionsNormalUntagged(dpid,in_port,parser)
-	    else :
-	        actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]                                  # FOR NORMAL NON-VLAN L2 SWITCH
-
-
-        
-
-
-        data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
-            data = msg.data
-
-        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
-                                  in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
+                match = parser.OFPMatch(in_port=in_port, eth_dst=dst)
+                actions = [parser.OFPActionOutput(out_port)]
+                if out_port_type == "NORMAL":
+                    outcome = 'native'
+                else:
+                    outcome = 'untagged_access'
+
+            #THE MESSAGES OF EVERY DESTINATION BEHIND out_port ONLY DIFFER IN in_port, eth_dst AND THE BUFFER ID
+            shape = ('unicast', src_vlan, vlan_header_present, out_port)
+            flow = self.templates.get(dpid, shape)
+            if flow is None:
+                mod = self.flow_mod(datapath, 1, match, actions)
+                self.flow_inventory.learned(datapath, mod)
+                flow = self.templates.put(dpid, shape, msg_template.FlowModTemplate(mod, ('in_port', 'eth_dst')))
+            return (flow, flow.values(in_port=in_port, eth_dst=dst), match.items(),
+                    self.packet_out_template(datapath, shape, actions), outcome)
+
+        #FOR FLOODING ACTIONS: PRECOMPILED PLAN FOR THE ACCESS/TRUNK MEMBERS OF THE SAME VLAN (SEE compile_flood_plans)
+        actions = self.flood_plans.get((dpid, in_port, src_vlan, vlan_header_present))
+        if actions is None:                                                                         #PORT OR VLAN NOT IN THE CONFIGURATION
+            actions = self.getFloodActions(dpid,in_port,src_vlan,vlan_header_present,parser)
+        shape = ('flood', in_port, src_vlan, vlan_header_present)
+        return None, None, None, self.packet_out_template(datapath, shape, actions), 'flood'
+
+    def packet_out_template(self, datapath, shape, actions):
+        #THE TEMPLATE OF THE PACKET OUTS THROUGH actions, shape IDENTIFIES actions
+        out = self.templates.get(datapath.id, ('packet_out',) + shape)
+        if out is None:
+            sample = datapath.ofproto_parser.OFPPacketOut(datapath=datapath, buffer_id=datapath.ofproto.OFP_NO_BUFFER,
+                                                          in_port=datapath.ofproto.OFPP_CONTROLLER, actions=list(actions))
+            out = self.templates.put(datapath.id, ('packet_out',) + shape, msg_template.PacketOutTemplate(sample))
+        return out
+
+    def release(self, msg, in_port):
+        #DROP A PACKET THE SWITCH BUFFERED, INSTEAD OF LEAVING IT IN THE BUFFER UNTIL IT TIMES OUT
+        out = packet_in_guard.packet_out(msg, in_port, [])
+        if out is not None:
+            self.batcher.send_msg(msg.datapath, out)
 
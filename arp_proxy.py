@@ -0,0 +1,121 @@
+#Controller side ARP responder.
+#
+#Every ARP request is a broadcast, so the apps flood each one to every port
+#of its vlan. ArpProxy learns the ip -> mac binding of every ARP packet the
+#apps see (the sender of requests, replies and gratuitous ARPs) per vlan and,
+#once the target of a request is known, builds the reply itself. The app
+#sends it straight back out of the port the request came in on instead of
+#flooding the request.
+#
+#The bindings of each vlan are a mac_table.MacTable (ip instead of mac as the
+#key, mac instead of port as the value), so they are bounded and age out the
+#same way the learned macs do.
+
+import struct
+import time
+
+from ryu.lib.packet import ether_types
+
+import mac_table
+
+
+#ip -> mac bindings per vlan, and seconds before an unrefreshed binding is forgotten
+DEFAULT_CAPACITY = mac_table.DEFAULT_CAPACITY
+DEFAULT_AGING_TIME = mac_table.DEFAULT_AGING_TIME
+
+ARP_REQUEST = 1
+ARP_REPLY = 2
+
+#ethernet/ipv4 ARP: htype, ptype, hlen, plen, opcode, sender mac, sender ip, target mac, target ip
+_arp_struct = struct.Struct('!HHBBH6s4s6s4s')
+_ARP_HEADER = struct.pack('!HHBB', 1, ether_types.ETH_TYPE_IP, 6, 4)
+
+#replies are padded to the minimum ethernet frame (without the fcs)
+MIN_FRAME_LEN = 60
+
+
+class Arp(object):
+    __slots__ = ('opcode', 'sender_mac', 'sender_ip', 'target_mac', 'target_ip')
+
+    def __init__(self, opcode, sender_mac, sender_ip, target_mac, target_ip):
+        #macs as 6 bytes, ips as 4 bytes, straight from the packet
+        self.opcode = opcode
+        self.sender_mac = sender_mac
+        self.sender_ip = sender_ip
+        self.target_mac = target_mac
+        self.target_ip = target_ip
+
+
+def decode(eth):
+    """The ARP packet following the EthHeader eth, or None if it is not ethernet/ipv4 ARP."""
+    if eth.payload_type != ether_types.ETH_TYPE_ARP:
+        return None
+    if len(eth.data) < eth.payload_offset + _arp_struct.size:
+        return None
+    htype, ptype, hlen, plen, opcode, sha, spa, tha, tpa = _arp_struct.unpack_from(eth.data, eth.payload_offset)
+    if htype != 1 or ptype != ether_types.ETH_TYPE_IP or hlen != 6 or plen != 4:
+        return None
+    return Arp(opcode, sha, spa, tha, tpa)
+
+
+def reply_frame(request, mac, vid=None):
+    """The ARP reply to request telling that its target ip is at mac (6 bytes), tagged with vid if given."""
+    frame = [request.sender_mac, mac]
+    if vid is not None:
+        frame.append(struct.pack('!HH', ether_types.ETH_TYPE_8021Q, vid))
+    frame.append(struct.pack('!H', ether_types.ETH_TYPE_ARP))
+    frame.append(_ARP_HEADER)
+    frame.append(struct.pack('!H', ARP_REPLY))
+    frame.extend((mac, request.target_ip, request.sender_mac, request.sender_ip))
+    data = b''.join(frame)
+    return data + b'\x00' * (MIN_FRAME_LEN - len(data))
+
+
+class ArpProxy(object):
+    """
+    The ip -> mac bindings of one app, per vlan. handle() learns from an
+    ARP packet and returns the reply to send back, if it can answer it.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, aging_time=DEFAULT_AGING_TIME, clock=time.monotonic):
+        #vlan -> ip -> mac
+        self.bindings = mac_table.MacTables(capacity, aging_time, clock)
+        self.answered = 0
+        self.unanswered = 0
+
+    def learn(self, vid, arp):
+        #0.0.0.0 is an address probe (RFC 5227), the sender has no address yet
+        if arp.sender_ip != b'\x00\x00\x00\x00':
+            self.bindings.learn(vid, arp.sender_ip, arp.sender_mac)
+
+    def lookup(self, vid, ip):
+        """The mac (6 bytes) of ip (4 bytes) in vlan vid, or None."""
+        return self.bindings.get(vid, ip)
+
+    def handle(self, vid, eth):
+        """
+        Learn from the ARP packet in the EthHeader eth, received in vlan vid.
+        Returns the reply frame for a request whose target is known, None
+        for anything the switch has to forward as usual.
+        """
+        arp = decode(eth)
+        if arp is None:
+            return None
+        self.learn(vid, arp)
+        #gratuitous ARPs announce the sender, everybody has to see them
+        if arp.opcode != ARP_REQUEST or arp.sender_ip == arp.target_ip:
+            return None
+
+        mac = self.lookup(vid, arp.target_ip)
+        if mac is None or mac == arp.sender_mac:
+            self.unanswered += 1
+            return None
+        self.answered += 1
+        return reply_frame(arp, mac, eth.vid)
+
+    def stats(self):
+        return {
+            'answered': self.answered,
+            'unanswered': self.unanswered,
+            'bindings': dict((vid, len(table)) for vid, table in self.bindings.tables.items()),
+        }
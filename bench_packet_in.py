@@ -0,0 +1,324 @@
+#Offline PacketIn benchmark of the switch apps.
+#
+#Drives the _packet_in_handler of SimpleSwitch13, VLANSwitch and VlanSwitch13
+#with synthetic traffic through an in-process fake datapath, so it runs on any
+#box with Ryu installed (no Mininet, no Open vSwitch). For every app and
+#traffic mix it reports the events handled per second, the p50/p99 latency of
+#the handler and the OpenFlow messages the app emitted per event.
+#
+#   python bench_packet_in.py [--events N] [--hosts N] [--app NAME] [--mix NAME]
+#                             [--frame-len N] [--miss-send-len N]
+#
+#The mixes:
+#
+#   arp_broadcast   ARP requests to ff:ff:ff:ff:ff:ff from every host
+#   known_unicast   unicast between hosts of the same vlan, all of them learned
+#   cross_vlan      unicast from a host to a learned host of another vlan
+#   trunk_tagged    802.1Q tagged unicast arriving on a trunk port
+#
+#A mix the vlan layout of an app cannot produce (no trunk port, only one
+#vlan) is skipped. The static flows of the features handler are not part of
+#the measurement, the admission limit of packet_in_guard is lifted for the
+#benchmark datapath and the metrics endpoint is not started.
+#
+#With --miss-send-len the fake switch buffers every frame and only sends its
+#first N bytes up, like a switch configured with packet_in_guard's
+#miss_send_len. Compare the controller bytes per event (in and out) with and
+#without it, on frames of --frame-len bytes.
+
+import argparse
+import random
+import struct
+import time
+
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+from ryu.controller import ofp_event
+
+import metrics
+import packet_in_guard
+
+
+BENCH_DPID = 1
+
+DEFAULT_EVENTS = 20000
+#hosts learned per access port
+DEFAULT_HOSTS = 16
+#bytes of every frame, padded with zeros (the smallest ethernet frame by default)
+DEFAULT_FRAME_LEN = 60
+
+MIXES = ('arp_broadcast', 'known_unicast', 'cross_vlan', 'trunk_tagged')
+
+_header_struct = struct.Struct('!BBHI')
+
+
+class FakeDatapath(object):
+    """
+    Stand-in for ryu.controller.controller.Datapath. Nothing is written
+    anywhere, send_msg()/send() only count the messages by type.
+    """
+
+    def __init__(self, dpid=BENCH_DPID):
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.xid = 0
+        self.is_active = True
+        #message type -> count
+        self.sent = {}
+        self.msgs = 0
+        self.writes = 0
+        self.bytes = 0
+
+    def set_xid(self, msg):
+        self.xid += 1
+        self.xid &= self.ofproto.MAX_XID
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg, close_socket=False):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        return self.send(msg.buf)
+
+    def send(self, buf, close_socket=False):
+        #walk the headers of the (possibly batched) messages in buf
+        self.writes += 1
+        self.bytes += len(buf)
+        offset = 0
+        while offset < len(buf):
+            _version, msg_type, msg_len, _xid = _header_struct.unpack_from(buf, offset)
+            self.sent[msg_type] = self.sent.get(msg_type, 0) + 1
+            self.msgs += 1
+            offset += msg_len
+        return True
+
+
+def mac(port, host):
+    return '02:00:00:00:%02x:%02x' % (port, host)
+
+
+def ethernet(src, dst, vid=None, ethertype=0x0800):
+    frame = bytes.fromhex(dst.replace(':', '') + src.replace(':', ''))
+    if vid is not None:
+        frame += struct.pack('!HH', 0x8100, vid)
+    return frame + struct.pack('!H', ethertype) + b'\x00' * 46
+
+
+def arp_request(src, vid=None):
+    return ethernet(src, 'ff:ff:ff:ff:ff:ff', vid, 0x0806)
+
+
+def packet_in_event(datapath, in_port, data, miss_send_len=None, buffer_id=None):
+    """
+    The PacketIn of data. With miss_send_len the frame is buffered as
+    buffer_id and only its first miss_send_len bytes are sent up.
+    """
+    parser = datapath.ofproto_parser
+    total_len = len(data)
+    if miss_send_len is None:
+        buffer_id = datapath.ofproto.OFP_NO_BUFFER
+    else:
+        data = data[:miss_send_len]
+    msg = parser.OFPPacketIn(datapath, buffer_id=buffer_id,
+                             total_len=total_len, reason=datapath.ofproto.OFPR_NO_MATCH,
+                             table_id=0, cookie=0, match=parser.OFPMatch(in_port=in_port),
+                             data=data)
+    msg.msg_len = len(data) + datapath.ofproto.OFP_PACKET_IN_SIZE
+    return ofp_event.EventOFPPacketIn(msg)
+
+
+class Layout(object):
+    """
+    The ports of the benchmark switch: the access ports with their vlan
+    (None for an app without vlans) and the trunk ports with their vlans.
+    """
+
+    def __init__(self, access, trunks=None):
+        #port -> vid (None = no vlan)
+        self.access = access
+        #port -> [vids]
+        self.trunks = trunks or {}
+
+
+def make_simple_switch():
+    import simple_switch_13
+    return simple_switch_13.SimpleSwitch13(), Layout({1: None, 2: None, 3: None, 4: None})
+
+
+def make_vlan_switch():
+    import LearningSwitch
+    ports = LearningSwitch.port_to_vlan[BENCH_DPID]
+    return LearningSwitch.VLANSwitch(), Layout(dict((port, vids[0]) for port, vids in ports.items()))
+
+
+def make_vlan_switch13():
+    import VLAN
+    app = VLAN.VlanSwitch13()
+    access = {}
+    trunks = {}
+    for port, vids in app.port_vlan[BENCH_DPID].items():
+        if port in app.trunk[BENCH_DPID]:
+            trunks[port] = list(vids)
+        elif vids[0] != " ":
+            access[port] = vids[0]
+    return app, Layout(access, trunks)
+
+
+APPS = (
+    ('SimpleSwitch13', make_simple_switch),
+    ('VLANSwitch', make_vlan_switch),
+    ('VlanSwitch13', make_vlan_switch13),
+)
+
+
+def hosts(layout, count):
+    """(port, vid, mac) of count hosts behind every access port."""
+    return [(port, vid, mac(port, host))
+            for port, vid in sorted(layout.access.items())
+            for host in range(count)]
+
+
+def traffic(mix, layout, hosts_per_port, rnd):
+    """
+    Returns (warmup, events) of (in_port, frame) pairs, or None if the mix
+    does not apply to the layout. warmup teaches the app every host.
+    """
+    all_hosts = hosts(layout, hosts_per_port)
+    warmup = [(port, arp_request(src)) for port, vid, src in all_hosts]
+
+    if mix == 'arp_broadcast':
+        frames = [(port, arp_request(src)) for port, vid, src in all_hosts]
+    elif mix == 'known_unicast':
+        frames = [(port, ethernet(src, dst))
+                  for port, vid, src in all_hosts
+                  for dst_port, dst_vid, dst in all_hosts
+                  if dst_vid == vid and dst_port != port]
+    elif mix == 'cross_vlan':
+        frames = [(port, ethernet(src, dst))
+                  for port, vid, src in all_hosts
+                  for dst_port, dst_vid, dst in all_hosts
+                  if dst_vid != vid]
+    elif mix == 'trunk_tagged':
+        frames = []
+        for trunk_port, vids in sorted(layout.trunks.items()):
+            for vid in vids:
+                #hosts behind the trunk talking to the learned hosts of their vlan
+                for i, (port, dst_vid, dst) in enumerate(all_hosts):
+                    if dst_vid == vid:
+                        frames.append((trunk_port, ethernet(mac(trunk_port, i % 256), dst, vid)))
+    else:
+        raise ValueError("unknown traffic mix %r" % mix)
+
+    if not frames:
+        return None
+    rnd.shuffle(frames)
+    return warmup, frames
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run(make_app, mix, events, hosts_per_port, seed=0, frame_len=DEFAULT_FRAME_LEN, miss_send_len=None):
+    """
+    Benchmark one app on one traffic mix. Returns a dict with the results,
+    or None if the mix does not apply to the app.
+    """
+    #no admission control, the benchmark wants to see every event handled
+    packet_in_guard.limits[BENCH_DPID] = packet_in_guard.DEFAULT_LIMITS._replace(rate=None, meter_rate=None)
+    metrics.listen_port = 0
+
+    app, layout = make_app()
+    datapath = FakeDatapath()
+    rnd = random.Random(seed)
+    plan = traffic(mix, layout, hosts_per_port, rnd)
+    if plan is None:
+        return None
+    warmup, frames = plan
+    frames = [(in_port, data + b'\x00' * (frame_len - len(data))) for in_port, data in frames]
+
+    handler = app._packet_in_handler
+    for in_port, data in warmup:
+        handler(packet_in_event(datapath, in_port, data))
+    #let the batcher write out the warmup before counting
+    hub.sleep(0)
+    datapath.sent.clear()
+    datapath.msgs = 0
+    datapath.writes = 0
+    datapath.bytes = 0
+
+    #build the events up front so only the handler is timed
+    pending = [packet_in_event(datapath, frames[i % len(frames)][0], frames[i % len(frames)][1],
+                               miss_send_len, i)
+               for i in range(events)]
+    #what the switch sent up
+    received = sum(ev.msg.msg_len for ev in pending)
+    latencies = []
+    clock = time.perf_counter
+    started = clock()
+    for ev in pending:
+        start = clock()
+        handler(ev)
+        latencies.append(clock() - start)
+        #the batcher flushes once the event loop gets control, like after each event in ryu-manager
+        hub.sleep(0)
+    elapsed = clock() - started
+
+    latencies.sort()
+    return {
+        'events': events,
+        'events_per_sec': events / elapsed if elapsed else 0.0,
+        'p50_us': percentile(latencies, 0.50) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'msgs_per_event': datapath.msgs / float(events),
+        'writes_per_event': datapath.writes / float(events),
+        'bytes_in_per_event': received / float(events),
+        'bytes_out_per_event': datapath.bytes / float(events),
+        'sent': dict(datapath.sent),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline PacketIn benchmark of the switch apps")
+    parser.add_argument('--events', type=int, default=DEFAULT_EVENTS,
+                        help="packet ins per app and traffic mix (default %(default)s)")
+    parser.add_argument('--hosts', type=int, default=DEFAULT_HOSTS,
+                        help="hosts behind every access port (default %(default)s)")
+    parser.add_argument('--app', action='append', choices=[name for name, make_app in APPS],
+                        help="only benchmark this app (can be repeated)")
+    parser.add_argument('--mix', action='append', choices=MIXES,
+                        help="only run this traffic mix (can be repeated)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--frame-len', type=int, default=DEFAULT_FRAME_LEN,
+                        help="bytes of every frame (default %(default)s)")
+    parser.add_argument('--miss-send-len', type=int,
+                        help="buffer the frames in the switch and send only this many bytes up")
+    args = parser.parse_args()
+
+    print("%-15s %-14s %12s %9s %9s %9s %9s %9s %9s" % ("app", "mix", "events/s", "p50 us", "p99 us",
+                                                      "msgs/ev", "writes/ev", "in B/ev", "out B/ev"))
+    for name, make_app in APPS:
+        if args.app and name not in args.app:
+            continue
+        for mix in MIXES:
+            if args.mix and mix not in args.mix:
+                continue
+            result = run(make_app, mix, args.events, args.hosts, args.seed, args.frame_len,
+                         args.miss_send_len)
+            if result is None:
+                print("%-15s %-14s %12s" % (name, mix, "n/a"))
+                continue
+            print("%-15s %-14s %12.0f %9.1f %9.1f %9.2f %9.2f %9.0f %9.0f" % (
+                name, mix, result['events_per_sec'], result['p50_us'], result['p99_us'],
+                result['msgs_per_event'], result['writes_per_event'],
+                result['bytes_in_per_event'], result['bytes_out_per_event']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#Fixtures shared by the tests: a stand-in for a connected switch and a
+#VlanSwitch13 set up without a controller around it. ryu is imported where
+#it is used, the tests that need it skip themselves when it is missing.
+
+import struct
+
+import pytest
+
+
+_header_struct = struct.Struct('!BBHI')
+
+
+class Datapath(object):
+    """Stand-in for a connected switch, keeps every message it is sent."""
+
+    def __init__(self, dpid=1):
+        from ryu.ofproto import ofproto_v1_3
+        from ryu.ofproto import ofproto_v1_3_parser
+
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.xid = 0
+        self.is_active = True
+        self.sent = []
+
+    def set_xid(self, msg):
+        self.xid = (self.xid + 1) & self.ofproto.MAX_XID
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send_msg(self, msg, close_socket=False):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        return self.send(msg.buf)
+
+    def send(self, buf, close_socket=False):
+        #split the (possibly batched) messages
+        buf = bytes(buf)
+        offset = 0
+        while offset < len(buf):
+            msg_len = _header_struct.unpack_from(buf, offset)[2]
+            self.sent.append(buf[offset:offset + msg_len])
+            offset += msg_len
+        return True
+
+    def take(self):
+        """The messages sent since the last take(), as (type, xid, buf)."""
+        sent = [(buf[1], _header_struct.unpack_from(buf)[3], buf) for buf in self.sent]
+        del self.sent[:]
+        return sent
+
+
+@pytest.fixture
+def datapath():
+    return Datapath()
+
+
+@pytest.fixture
+def vlan_switch13(monkeypatch):
+    """
+    Returns a function building a VlanSwitch13 for the given port_vlan,
+    access and trunk tables.
+    """
+    import VLAN
+    import metrics
+
+    def make(port_vlan=None, access=None, trunk=None, group_flooding=False):
+        monkeypatch.setattr(VLAN, 'vlan_config_file', None)
+        monkeypatch.setattr(VLAN, 'port_vlan', port_vlan or {})
+        monkeypatch.setattr(VLAN, 'access', access or {})
+        monkeypatch.setattr(VLAN, 'trunk', trunk or {})
+        monkeypatch.setattr(VLAN, 'links', [])
+        monkeypatch.setattr(VLAN, 'group_flooding', group_flooding)
+        monkeypatch.setattr(metrics, 'listen_port', 0)
+        return VLAN.VlanSwitch13()
+    return make
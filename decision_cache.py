@@ -0,0 +1,96 @@
+#Cache of the forwarding decisions of the switch apps.
+#
+#Until its flow lands on the switch every packet of a conversation comes up
+#as a PacketIn, and the apps worked out the same decision for each of them:
+#the vlan of the port, the port of the destination, whether that is an access
+#or a trunk port and a fresh match and action list. DecisionCache keeps the
+#finished plan per (dpid, in_port, vid, dst mac), in least recently used order
+#and bounded to capacity entries.
+#
+#A plan depends on the port the destination is learned on, so the cache is
+#the on_change callback of the app's mac_table.MacTables: a destination that
+#is learned, moves, is evicted or ages out drops every plan towards it on that
+#switch. The apps clear() the whole cache when the vlan configuration or the
+#spanning trees change. vid is the tag of the packet (None if untagged), the
+#vlan of an access port follows from the configuration.
+
+import collections
+
+
+#decisions kept per app
+DEFAULT_CAPACITY = 8192
+
+
+class DecisionCache(object):
+    """
+    (dpid, in_port, vid, dst) -> plan of one app, the plan is whatever the
+    app needs to skip its decision (treated as immutable).
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        #key -> plan, least recently used first
+        self.entries = collections.OrderedDict()
+        #(dpid, dst) -> keys of the plans towards dst on dpid
+        self.by_dst = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """The plan cached for key, or None."""
+        plan = self.entries.get(key)
+        if plan is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return plan
+
+    def put(self, key, plan):
+        entries = self.entries
+        entries[key] = plan
+        entries.move_to_end(key)
+        dpid, in_port, vid, dst = key
+        keys = self.by_dst.get((dpid, dst))
+        if keys is None:
+            keys = self.by_dst[(dpid, dst)] = set()
+        keys.add(key)
+
+        while len(entries) > self.capacity:
+            old_key = entries.popitem(last=False)[0]
+            self._unindex(old_key)
+
+    def _unindex(self, key):
+        dpid, in_port, vid, dst = key
+        keys = self.by_dst.get((dpid, dst))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_dst[(dpid, dst)]
+
+    def mac_changed(self, dpid, mac):
+        """MacTables on_change callback: forget the plans towards mac on dpid."""
+        keys = self.by_dst.pop((dpid, mac), None)
+        if not keys:
+            return
+        for key in keys:
+            del self.entries[key]
+        self.invalidations += len(keys)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.by_dst.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
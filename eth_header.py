@@ -0,0 +1,131 @@
+#Fast path decoder for the ethernet (and 802.1Q) header of a PacketIn.
+#
+#The switch apps only need the destination/source MAC, the ethertype and the
+#vlan id of a frame to make their forwarding decision. Building a full
+#packet.Packet() tree for that walks (and allocates objects for) every header
+#in the frame, which is the most expensive part of a PacketIn under ARP storms.
+#decode() reads only those fields straight out of msg.data and keeps the MAC
+#addresses as 48-bit integers. The full Ryu parser is still available through
+#EthHeader.packet() for the few places that need the deeper headers.
+
+import struct
+
+from ryu.lib.packet import packet
+from ryu.lib.packet import ether_types
+
+
+ETH_HEADER_LEN = 14
+VLAN_TAG_LEN = 4
+
+#ethertypes that carry an 802.1Q style tag after the source mac
+VLAN_TPIDS = (ether_types.ETH_TYPE_8021Q, ether_types.ETH_TYPE_8021AD)
+
+#bit 0 of the first octet is the group (multicast/broadcast) bit
+MULTICAST_BIT = 1 << 40
+BROADCAST_MAC = 0xffffffffffff
+
+#dst mac (16 + 32 bits), src mac (16 + 32 bits), ethertype
+_eth_struct = struct.Struct('!HIHIH')
+#tag control information, encapsulated ethertype
+_vlan_struct = struct.Struct('!HH')
+
+
+def mac_to_int(mac):
+    """Convert a "00:00:00:00:00:01" style mac address to an integer."""
+    return int(mac.replace(':', ''), 16)
+
+
+def mac_to_str(mac):
+    """Convert an integer mac address back to the "00:00:00:00:00:01" form."""
+    hex_mac = '%012x' % mac
+    return ':'.join((hex_mac[0:2], hex_mac[2:4], hex_mac[4:6],
+                     hex_mac[6:8], hex_mac[8:10], hex_mac[10:12]))
+
+
+class EthHeader(object):
+    """
+    The decoded link layer header of a frame.
+
+    dst and src are the mac addresses as integers, dst_str and src_str give
+    the usual string form (computed once, on first use). ethertype is the
+    outermost ethertype as seen on the wire (0x8100 for tagged frames), vid
+    is the vlan id of the outer tag or None if the frame is untagged and
+    payload_type is the ethertype of whatever follows the tags.
+    """
+
+    __slots__ = ('dst', 'src', 'ethertype', 'vid', 'pcp', 'payload_type',
+                 'payload_offset', 'data', '_dst_str', '_src_str', '_pkt')
+
+    def __init__(self, data, dst, src, ethertype, vid, pcp, payload_type,
+                 payload_offset):
+        self.data = data
+        self.dst = dst
+        self.src = src
+        self.ethertype = ethertype
+        self.vid = vid
+        self.pcp = pcp
+        self.payload_type = payload_type
+        self.payload_offset = payload_offset
+        self._dst_str = None
+        self._src_str = None
+        self._pkt = None
+
+    @property
+    def tagged(self):
+        return self.vid is not None
+
+    @property
+    def is_multicast(self):
+        #also true for broadcast
+        return bool(self.dst & MULTICAST_BIT)
+
+    @property
+    def dst_str(self):
+        if self._dst_str is None:
+            self._dst_str = mac_to_str(self.dst)
+        return self._dst_str
+
+    @property
+    def src_str(self):
+        if self._src_str is None:
+            self._src_str = mac_to_str(self.src)
+        return self._src_str
+
+    @property
+    def payload(self):
+        """Zero copy view of the bytes following the ethernet/vlan headers."""
+        return memoryview(self.data)[self.payload_offset:]
+
+    def packet(self):
+        """
+        Fall back to the full Ryu parser, for callers that need the headers
+        above layer 2. The result is cached so it is only ever parsed once.
+        """
+        if self._pkt is None:
+            self._pkt = packet.Packet(bytes(self.data))
+        return self._pkt
+
+
+def decode(data):
+    """
+    Decode the ethernet header (and the outer vlan tag if there is one) of
+    the frame in data. Returns an EthHeader, or None when the buffer is too
+    short to hold the headers it announces.
+    """
+    if len(data) < ETH_HEADER_LEN:
+        return None
+
+    dst_hi, dst_lo, src_hi, src_lo, ethertype = _eth_struct.unpack_from(data, 0)
+    dst = (dst_hi << 32) | dst_lo
+    src = (src_hi << 32) | src_lo
+
+    if ethertype not in VLAN_TPIDS:
+        return EthHeader(data, dst, src, ethertype, None, None, ethertype,
+                         ETH_HEADER_LEN)
+
+    if len(data) < ETH_HEADER_LEN + VLAN_TAG_LEN:
+        return None
+
+    tci, payload_type = _vlan_struct.unpack_from(data, ETH_HEADER_LEN)
+    return EthHeader(data, dst, src, ethertype, tci & 0x0fff, tci >> 13,
+                     payload_type, ETH_HEADER_LEN + VLAN_TAG_LEN)
@@ -0,0 +1,258 @@
+#Inventory of the learned flows installed on every switch.
+#
+#The apps used to install their learned flows without any timeout, so they
+#stayed in the flow tables of the switches forever and the controller had no
+#idea how full those tables were. FlowInventory gives every learned FlowMod an
+#idle/hard timeout and OFPFF_SEND_FLOW_REM, and records it per datapath and
+#table. EventOFPFlowRemoved (timeouts and deletes alike) takes the flow out of
+#the inventory again.
+#
+#When a table fills up to EVICT_HIGH of its capacity the inventory asks the
+#switch for the flow stats of that table. A flow whose packet count went up
+#since the last dump was hit since then, and the flows that went the longest
+#without a hit are deleted until the table is back at EVICT_LOW.
+#
+#Flows that only work together (like the two entries per host of the two table
+#pipeline) are tied together by the app through on_removed: it hears about every
+#learned flow that left the inventory, timed out, deleted or evicted alike.
+
+import collections
+import time
+
+import mac_table
+
+
+#timeouts of learned flows in seconds (0 = none), idle like the mac aging time
+IDLE_TIMEOUT = mac_table.DEFAULT_AGING_TIME
+HARD_TIMEOUT = 0
+
+#learned flows per table before flows get evicted
+TABLE_CAPACITY = 4096
+
+#start evicting at this fraction of the capacity and evict down to EVICT_LOW
+EVICT_HIGH = 0.9
+EVICT_LOW = 0.8
+
+#seconds after which an unanswered flow stats request of the eviction is sent again
+EVICT_RETRY = 10
+
+
+def flow_key(table_id, priority, match):
+    """Identity of a flow on a switch: table, priority and the match fields."""
+    return fields_key(table_id, priority, match.items())
+
+
+def fields_key(table_id, priority, fields):
+    """flow_key() of a match given as its (name, value) fields."""
+    return (table_id, priority, tuple(sorted(fields)))
+
+
+class Flow(object):
+    #match is None for flows recorded from their fields, see FlowInventory.record()
+    __slots__ = ('match', 'packet_count', 'last_hit')
+
+    def __init__(self, match, last_hit):
+        self.match = match
+        self.packet_count = 0
+        self.last_hit = last_hit
+
+
+class FlowInventory(object):
+    """
+    The learned flows of one app, per datapath id and table id. The app
+    passes every learned FlowMod through track() before sending it (or
+    record() for a learned flow sent from a template), and forwards
+    EventOFPFlowRemoved and the flow stats replies. on_removed(datapath,
+    table_id, fields) is called for every learned flow that is gone from the
+    switch, its match given as (name, value) fields.
+    """
+
+    def __init__(self, batcher, logger, idle_timeout=IDLE_TIMEOUT, hard_timeout=HARD_TIMEOUT,
+                 capacity=TABLE_CAPACITY, clock=time.monotonic, on_removed=None):
+        self.batcher = batcher
+        self.logger = logger
+        self.on_removed = on_removed
+        self.idle_timeout = idle_timeout
+        self.hard_timeout = hard_timeout
+        self.capacity = capacity
+        self.clock = clock
+        #dpid -> table id -> OrderedDict(flow_key -> Flow)
+        self.tables = {}
+        #xid -> (dpid, table id) of the flow stats requests sent for an eviction
+        self.evicting = {}
+        #(dpid, table id) -> time the last eviction request was sent
+        self._evict_sent = {}
+        #dpid -> counters
+        self.counters = {}
+        #dpid -> flow_key -> (packet count, seconds since the last hit) of the flows of a snapshot
+        self.history = {}
+
+    def _table(self, dpid, table_id):
+        tables = self.tables.get(dpid)
+        if tables is None:
+            tables = self.tables[dpid] = {}
+        table = tables.get(table_id)
+        if table is None:
+            table = tables[table_id] = collections.OrderedDict()
+        return table
+
+    def _counters(self, dpid):
+        counters = self.counters.get(dpid)
+        if counters is None:
+            counters = self.counters[dpid] = {'installed': 0, 'idle_timeout': 0, 'hard_timeout': 0,
+                                              'deleted': 0, 'evicted': 0}
+        return counters
+
+    def track(self, datapath, mod):
+        """
+        Give the FlowMod mod the timeouts of a learned flow and record it. Call
+        before sending mod.
+        """
+        self.learned(datapath, mod)
+        self._record(datapath, mod.table_id, flow_key(mod.table_id, mod.priority, mod.match), mod.match)
+
+    def learned(self, datapath, mod):
+        """Give the FlowMod mod the timeouts of a learned flow, without recording it."""
+        mod.idle_timeout = self.idle_timeout
+        mod.hard_timeout = self.hard_timeout
+        mod.flags |= datapath.ofproto.OFPFF_SEND_FLOW_REM
+
+    def record(self, datapath, table_id, priority, fields):
+        """
+        Record a learned flow sent without a FlowMod object (see
+        msg_template.py), its match given as (name, value) fields.
+        """
+        self._record(datapath, table_id, fields_key(table_id, priority, fields), None)
+
+    def _record(self, datapath, table_id, key, match):
+        table = self._table(datapath.id, table_id)
+        #a flow replacing one with the same match starts over
+        table.pop(key, None)
+        table[key] = Flow(match, self.clock())
+        self._counters(datapath.id)['installed'] += 1
+
+        if len(table) >= self.capacity * EVICT_HIGH:
+            self._request_eviction(datapath, table_id)
+
+    def restore(self, datapath, stats):
+        """Record a learned flow found on a reconnecting switch (an OFPFlowStats)."""
+        table = self._table(datapath.id, stats.table_id)
+        now = self.clock()
+        flow = Flow(stats.match, now)
+        flow.packet_count = stats.packet_count
+        key = flow_key(stats.table_id, stats.priority, stats.match)
+        history = self.history.get(datapath.id, {}).pop(key, None)
+        #not hit since the snapshot, it keeps the time of its last hit
+        if history is not None and history[0] == stats.packet_count:
+            flow.last_hit = now - history[1]
+        table[key] = flow
+
+    def reset(self, dpid):
+        """Forget every flow of dpid, e.g. when the switch connects again."""
+        self.tables.pop(dpid, None)
+        self.history.pop(dpid, None)
+
+    def snapshot(self):
+        """dpid -> [(table id, priority, match fields, packet count, seconds since the last hit)]."""
+        now = self.clock()
+        return dict((dpid, [(key[0], key[1], key[2], flow.packet_count, now - flow.last_hit)
+                            for table in tables.values() for key, flow in table.items()])
+                    for dpid, tables in self.tables.items())
+
+    def restore_history(self, dpid, flows):
+        """
+        The packet counts and last hits of the flows of dpid in a snapshot().
+        restore() gives them back to the flows the switch still has.
+        """
+        self.history[dpid] = dict((fields_key(table_id, priority, fields), (packet_count, idle))
+                                  for table_id, priority, fields, packet_count, idle in flows)
+
+    def flow_removed(self, msg):
+        """Take the flow of an OFPFlowRemoved out of the inventory."""
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        table = self.tables.get(datapath.id, {}).get(msg.table_id)
+        key = flow_key(msg.table_id, msg.priority, msg.match)
+        if table is None or table.pop(key, None) is None:
+            return
+
+        counters = self._counters(datapath.id)
+        if msg.reason == ofproto.OFPRR_IDLE_TIMEOUT:
+            counters['idle_timeout'] += 1
+        elif msg.reason == ofproto.OFPRR_HARD_TIMEOUT:
+            counters['hard_timeout'] += 1
+        else:
+            counters['deleted'] += 1
+        if self.on_removed is not None:
+            self.on_removed(datapath, msg.table_id, key[2])
+
+    def _request_eviction(self, datapath, table_id):
+        now = self.clock()
+        sent = self._evict_sent.get((datapath.id, table_id))
+        if sent is not None and now - sent < EVICT_RETRY:
+            return
+        self._evict_sent[(datapath.id, table_id)] = now
+
+        parser = datapath.ofproto_parser
+        req = parser.OFPFlowStatsRequest(datapath, table_id=table_id)
+        xid = self.batcher.send_msg(datapath, req)
+        self.evicting[xid] = (datapath.id, table_id)
+
+    def flow_stats_reply(self, msg):
+        """
+        Handle a flow stats reply to an eviction request. Returns True if it
+        belonged to one.
+        """
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        table_ref = self.evicting.get(msg.xid)
+        if table_ref is None or table_ref[0] != datapath.id:
+            return False
+
+        dpid, table_id = table_ref
+        table = self._table(dpid, table_id)
+        now = self.clock()
+        for stats in msg.body:
+            flow = table.get(flow_key(stats.table_id, stats.priority, stats.match))
+            if flow is not None and stats.packet_count != flow.packet_count:
+                flow.packet_count = stats.packet_count
+                flow.last_hit = now
+
+        if msg.flags & ofproto.OFPMPF_REPLY_MORE:
+            return True
+        del self.evicting[msg.xid]
+        self._evict_sent.pop(table_ref, None)
+        self._evict(datapath, table_id)
+        return True
+
+    def _evict(self, datapath, table_id):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        table = self._table(datapath.id, table_id)
+
+        excess = len(table) - int(self.capacity * EVICT_LOW)
+        if excess <= 0:
+            return
+        #least recently hit first, the ones with fewer packets first among those
+        victims = sorted(table.items(), key=lambda item: (item[1].last_hit, item[1].packet_count))[:excess]
+        for key, flow in victims:
+            del table[key]
+            match = flow.match
+            if match is None:
+                match = parser.OFPMatch(**dict(key[2]))
+            mod = parser.OFPFlowMod(datapath=datapath, table_id=table_id,
+                                    command=ofproto.OFPFC_DELETE_STRICT,
+                                    priority=key[1], out_port=ofproto.OFPP_ANY,
+                                    out_group=ofproto.OFPG_ANY, match=match)
+            self.batcher.send_msg(datapath, mod)
+            if self.on_removed is not None:
+                self.on_removed(datapath, table_id, key[2])
+        self._counters(datapath.id)['evicted'] += len(victims)
+        self.logger.info("evicted %d flows from table %s of dpid %s", len(victims), table_id, datapath.id)
+
+    def stats(self):
+        result = {}
+        for dpid, counters in self.counters.items():
+            tables = dict((table_id, len(table)) for table_id, table in self.tables.get(dpid, {}).items())
+            result[dpid] = dict(counters, tables=tables, capacity=self.capacity)
+        return result
@@ -0,0 +1,459 @@
+#Bounded, aging MAC learning table shared by the switch apps.
+#
+#The apps used to keep a plain mac_to_port[dpid][mac] = port dict that only
+#ever grew. MacTables keeps one MacTable per datapath instead, each capped at
+#a fixed number of entries and ordered by the last time a mac was seen as a
+#source. When a table is full the least recently seen mac is evicted, and a
+#mac that has not been seen for aging_time seconds is treated as unknown (and
+#dropped) again, like the mac-aging-time of a hardware switch.
+#
+#on_change is called with every mac whose port changes: learned for the
+#first time, moved to another port, evicted or aged out (refreshing a mac on
+#the port it is known on is not a change). Whatever the apps derived from the
+#port of a mac, like decision_cache.py's decisions, is dropped from there.
+#
+#With hundreds of thousands of hosts the mac strings, (port, time) tuples and
+#OrderedDict links of MacTable cost a lot of memory. The compact backend
+#(MAC_TABLE_BACKEND=compact in the environment) keeps the macs as 48-bit
+#integers instead and the ports, times and least recently seen order in
+#arrays (CompactMacTable). It has the same API, macs still go in and come out
+#as strings.
+
+import array
+import collections
+import functools
+import os
+import time
+
+import eth_header
+
+
+#same defaults as the Open vSwitch mac-table-size / mac-aging-time options
+DEFAULT_CAPACITY = 2048
+DEFAULT_AGING_TIME = 300
+
+DICT = 'dict'
+COMPACT = 'compact'
+
+#backend of the mac -> port tables of the apps
+backend = os.environ.get('MAC_TABLE_BACKEND', DICT)
+
+#no slot, the end of the lists of CompactMacTable
+NIL = -1
+
+
+class MacTable(object):
+    """
+    The learned macs of a single datapath. Entries are kept in an OrderedDict
+    in least recently learned first order, so both eviction and aging only
+    ever look at the head of the table.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, aging_time=DEFAULT_AGING_TIME,
+                 clock=time.monotonic, on_change=None):
+        self.capacity = capacity
+        self.aging_time = aging_time
+        self.clock = clock
+        self.on_change = on_change
+        #mac -> (port, time last seen)
+        self.entries = collections.OrderedDict()
+        self.evictions = 0
+        self.moves = 0
+        self.aged = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, mac):
+        return self.get(mac) is not None
+
+    def learn(self, mac, port):
+        """
+        Record that mac was seen on port. Returns the port the mac was known
+        on before, or None if it was not known.
+        """
+        now = self.clock()
+        entries = self.entries
+
+        old = entries.pop(mac, None)
+        old_port = None
+        if old is not None and now - old[1] <= self.aging_time:
+            old_port = old[0]
+            if old_port != port:
+                self.moves += 1
+
+        entries[mac] = (port, now)
+        on_change = self.on_change
+        if on_change is not None and old_port != port:
+            on_change(mac)
+
+        #the head is the least recently seen entry, age it out first
+        deadline = now - self.aging_time
+        while entries:
+            head = next(iter(entries))
+            if entries[head][1] >= deadline:
+                break
+            del entries[head]
+            self.aged += 1
+            if on_change is not None:
+                on_change(head)
+
+        while len(entries) > self.capacity:
+            evicted = entries.popitem(last=False)[0]
+            self.evictions += 1
+            if on_change is not None:
+                on_change(evicted)
+
+        return old_port
+
+    def get(self, mac):
+        """Returns the port mac was learned on, or None if unknown or aged."""
+        entry = self.entries.get(mac)
+        if entry is None:
+            return None
+        if self.clock() - entry[1] > self.aging_time:
+            del self.entries[mac]
+            self.aged += 1
+            if self.on_change is not None:
+                self.on_change(mac)
+            return None
+        return entry[0]
+
+    def evict(self, mac):
+        """Forget mac. Returns the port it was learned on, or None."""
+        entry = self.entries.pop(mac, None)
+        if entry is None:
+            return None
+        if self.on_change is not None:
+            self.on_change(mac)
+        return entry[0]
+
+    def evict_port(self, port):
+        """Forget every mac learned on port. Returns the macs that were removed."""
+        macs = [mac for mac, entry in self.entries.items() if entry[0] == port]
+        for mac in macs:
+            del self.entries[mac]
+            if self.on_change is not None:
+                self.on_change(mac)
+        return macs
+
+    def items(self):
+        """(mac, port) of every entry that has not aged out yet."""
+        deadline = self.clock() - self.aging_time
+        return [(mac, entry[0]) for mac, entry in self.entries.items() if entry[1] >= deadline]
+
+    def snapshot(self):
+        """(mac, port, seconds since it was seen) of every entry that has not aged out yet, oldest first."""
+        now = self.clock()
+        return [(mac, entry[0], now - entry[1]) for mac, entry in self.entries.items()
+                if now - entry[1] <= self.aging_time]
+
+    def restore(self, entries):
+        """
+        Put the (mac, port, age) entries of a snapshot() back, as last seen
+        age seconds ago. Meant for an empty table: macs that are already
+        known keep what was learned since.
+        """
+        now = self.clock()
+        #the most recently seen ones that fit, newest first as each goes in front of the table
+        entries = sorted((entry for entry in entries if entry[2] <= self.aging_time and entry[0] not in self.entries),
+                         key=lambda entry: entry[2])[:max(0, self.capacity - len(self.entries))]
+        for mac, port, age in entries:
+            self.entries[mac] = (port, now - age)
+            self.entries.move_to_end(mac, last=False)
+            if self.on_change is not None:
+                self.on_change(mac)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'evictions': self.evictions,
+            'moves': self.moves,
+            'aged': self.aged,
+        }
+
+
+class CompactMacTable(object):
+    """
+    MacTable for large tables of mac -> port. A dict maps every mac, as an
+    integer, to the slot of its entry in the arrays of ports and times. The
+    slots in use are linked in least recently learned first order through
+    the prev/next arrays, the free ones through next. Ports are unsigned 32
+    bit integers, like the OpenFlow ports.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, aging_time=DEFAULT_AGING_TIME,
+                 clock=time.monotonic, on_change=None):
+        self.capacity = capacity
+        self.aging_time = aging_time
+        self.clock = clock
+        self.on_change = on_change
+        #mac (integer) -> slot
+        self.slots = {}
+        #per slot: the mac, its port, the time it was last seen and its neighbours
+        self.macs = array.array('Q')
+        self.ports = array.array('I')
+        self.seen = array.array('d')
+        self.prev = array.array('i')
+        self.next = array.array('i')
+        #least and most recently learned slot, first free slot
+        self.head = NIL
+        self.tail = NIL
+        self.free = NIL
+        self.evictions = 0
+        self.moves = 0
+        self.aged = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, mac):
+        return self.get(mac) is not None
+
+    def _alloc(self, mac):
+        slot = self.free
+        if slot != NIL:
+            self.free = self.next[slot]
+            self.macs[slot] = mac
+        else:
+            slot = len(self.macs)
+            self.macs.append(mac)
+            self.ports.append(0)
+            self.seen.append(0.0)
+            self.prev.append(NIL)
+            self.next.append(NIL)
+        self.slots[mac] = slot
+        return slot
+
+    def _unlink(self, slot):
+        prev = self.prev[slot]
+        next_ = self.next[slot]
+        if prev == NIL:
+            self.head = next_
+        else:
+            self.next[prev] = next_
+        if next_ == NIL:
+            self.tail = prev
+        else:
+            self.prev[next_] = prev
+
+    def _append(self, slot):
+        self.prev[slot] = self.tail
+        self.next[slot] = NIL
+        if self.tail == NIL:
+            self.head = slot
+        else:
+            self.next[self.tail] = slot
+        self.tail = slot
+
+    def _prepend(self, slot):
+        self.prev[slot] = NIL
+        self.next[slot] = self.head
+        if self.head == NIL:
+            self.tail = slot
+        else:
+            self.prev[self.head] = slot
+        self.head = slot
+
+    def _remove(self, slot):
+        """Free slot, returns its mac as a string."""
+        self._unlink(slot)
+        mac = self.macs[slot]
+        del self.slots[mac]
+        self.next[slot] = self.free
+        self.free = slot
+        return eth_header.mac_to_str(mac)
+
+    def learn(self, mac, port):
+        """
+        Record that mac was seen on port. Returns the port the mac was known
+        on before, or None if it was not known.
+        """
+        now = self.clock()
+        key = eth_header.mac_to_int(mac)
+
+        slot = self.slots.get(key)
+        old_port = None
+        if slot is None:
+            slot = self._alloc(key)
+        else:
+            if now - self.seen[slot] <= self.aging_time:
+                old_port = self.ports[slot]
+                if old_port != port:
+                    self.moves += 1
+            self._unlink(slot)
+
+        self.ports[slot] = port
+        self.seen[slot] = now
+        self._append(slot)
+        on_change = self.on_change
+        if on_change is not None and old_port != port:
+            on_change(mac)
+
+        #the head is the least recently seen entry, age it out first
+        deadline = now - self.aging_time
+        while self.head != NIL and self.seen[self.head] < deadline:
+            aged = self._remove(self.head)
+            self.aged += 1
+            if on_change is not None:
+                on_change(aged)
+
+        while len(self.slots) > self.capacity:
+            evicted = self._remove(self.head)
+            self.evictions += 1
+            if on_change is not None:
+                on_change(evicted)
+
+        return old_port
+
+    def get(self, mac):
+        """Returns the port mac was learned on, or None if unknown or aged."""
+        slot = self.slots.get(eth_header.mac_to_int(mac))
+        if slot is None:
+            return None
+        if self.clock() - self.seen[slot] > self.aging_time:
+            self._remove(slot)
+            self.aged += 1
+            if self.on_change is not None:
+                self.on_change(mac)
+            return None
+        return self.ports[slot]
+
+    def evict(self, mac):
+        """Forget mac. Returns the port it was learned on, or None."""
+        slot = self.slots.get(eth_header.mac_to_int(mac))
+        if slot is None:
+            return None
+        port = self.ports[slot]
+        self._remove(slot)
+        if self.on_change is not None:
+            self.on_change(mac)
+        return port
+
+    def _slots(self):
+        """The slots in use, least recently learned first."""
+        slots = []
+        slot = self.head
+        while slot != NIL:
+            slots.append(slot)
+            slot = self.next[slot]
+        return slots
+
+    def evict_port(self, port):
+        """Forget every mac learned on port. Returns the macs that were removed."""
+        macs = [self._remove(slot) for slot in self._slots() if self.ports[slot] == port]
+        if self.on_change is not None:
+            for mac in macs:
+                self.on_change(mac)
+        return macs
+
+    def items(self):
+        """(mac, port) of every entry that has not aged out yet."""
+        deadline = self.clock() - self.aging_time
+        return [(eth_header.mac_to_str(self.macs[slot]), self.ports[slot]) for slot in self._slots()
+                if self.seen[slot] >= deadline]
+
+    def snapshot(self):
+        """(mac, port, seconds since it was seen) of every entry that has not aged out yet, oldest first."""
+        now = self.clock()
+        return [(eth_header.mac_to_str(self.macs[slot]), self.ports[slot], now - self.seen[slot])
+                for slot in self._slots() if now - self.seen[slot] <= self.aging_time]
+
+    def restore(self, entries):
+        """
+        Put the (mac, port, age) entries of a snapshot() back, as last seen
+        age seconds ago. Meant for an empty table: macs that are already
+        known keep what was learned since.
+        """
+        now = self.clock()
+        #the most recently seen ones that fit, newest first as each goes in front of the table
+        entries = sorted((entry for entry in entries if entry[2] <= self.aging_time
+                          and eth_header.mac_to_int(entry[0]) not in self.slots),
+                         key=lambda entry: entry[2])[:max(0, self.capacity - len(self.slots))]
+        for mac, port, age in entries:
+            slot = self._alloc(eth_header.mac_to_int(mac))
+            self.ports[slot] = port
+            self.seen[slot] = now - age
+            self._prepend(slot)
+            if self.on_change is not None:
+                self.on_change(mac)
+
+    def stats(self):
+        return {
+            'size': len(self.slots),
+            'capacity': self.capacity,
+            'evictions': self.evictions,
+            'moves': self.moves,
+            'aged': self.aged,
+        }
+
+
+BACKENDS = {DICT: MacTable, COMPACT: CompactMacTable}
+
+
+class MacTables(object):
+    """
+    One MacTable per datapath id, created on first use with the capacity
+    and aging time given here. on_change is called with the dpid and the mac.
+    backend picks the table (DICT or COMPACT, the latter for mac -> port
+    tables only).
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, aging_time=DEFAULT_AGING_TIME,
+                 clock=time.monotonic, on_change=None, backend=DICT):
+        if backend not in BACKENDS:
+            raise ValueError("unknown mac table backend %r" % (backend,))
+        self.capacity = capacity
+        self.aging_time = aging_time
+        self.clock = clock
+        self.on_change = on_change
+        self.table_class = BACKENDS[backend]
+        self.tables = {}
+
+    def table(self, dpid):
+        table = self.tables.get(dpid)
+        if table is None:
+            on_change = None
+            if self.on_change is not None:
+                on_change = functools.partial(self.on_change, dpid)
+            table = self.table_class(self.capacity, self.aging_time, self.clock, on_change)
+            self.tables[dpid] = table
+        return table
+
+    def learn(self, dpid, mac, port):
+        return self.table(dpid).learn(mac, port)
+
+    def get(self, dpid, mac):
+        table = self.tables.get(dpid)
+        if table is None:
+            return None
+        return table.get(mac)
+
+    def evict(self, dpid, mac):
+        table = self.tables.get(dpid)
+        if table is None:
+            return None
+        return table.evict(mac)
+
+    def evict_port(self, dpid, port):
+        table = self.tables.get(dpid)
+        if table is None:
+            return []
+        return table.evict_port(port)
+
+    def items(self, dpid):
+        table = self.tables.get(dpid)
+        if table is None:
+            return []
+        return table.items()
+
+    def snapshot(self):
+        """dpid -> the snapshot() of its table."""
+        return dict((dpid, table.snapshot()) for dpid, table in self.tables.items())
+
+    def restore(self, dpid, entries):
+        self.table(dpid).restore(entries)
+
+    def stats(self):
+        return dict((dpid, table.stats()) for dpid, table in self.tables.items())
@@ -0,0 +1,199 @@
+#Counters and latency histograms of the hot paths, served over HTTP.
+#
+#Every app records the outcome (the branch of its forwarding decision) and
+#the duration of each PacketIn it handles, and the message batcher counts the
+#OpenFlow messages sent per datapath and type. All of it lives in the process
+#wide REGISTRY and is served in the Prometheus text format on
+#http://127.0.0.1:METRICS_PORT/metrics (9101 unless METRICS_PORT is set in the
+#environment, 0 turns the endpoint off).
+#
+#Recording is a dictionary update on a pre-built label tuple plus a bisect
+#into the histogram buckets, nothing is formatted until the endpoint is read.
+
+import bisect
+import os
+import time
+
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3
+
+
+listen_host = '127.0.0.1'
+listen_port = int(os.environ.get('METRICS_PORT', 9101))
+
+#upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+#names of the message types counted by the batcher
+MSG_TYPES = {
+    ofproto_v1_3.OFPT_FLOW_MOD: 'flow_mod',
+    ofproto_v1_3.OFPT_PACKET_OUT: 'packet_out',
+    ofproto_v1_3.OFPT_GROUP_MOD: 'group_mod',
+    ofproto_v1_3.OFPT_METER_MOD: 'meter_mod',
+    ofproto_v1_3.OFPT_BARRIER_REQUEST: 'barrier_request',
+    ofproto_v1_3.OFPT_MULTIPART_REQUEST: 'multipart_request',
+}
+
+#time source of the handler timings
+clock = time.perf_counter
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        #one slot per bucket plus +Inf
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (key, value) for key, value in labels)
+
+
+class Registry(object):
+    """
+    Named counters and histograms, each keyed by a tuple of (label, value)
+    pairs. Collectors are called when the metrics are rendered and yield
+    (labels, value) of extra counters, for numbers kept elsewhere.
+    """
+
+    def __init__(self):
+        #name -> labels -> value
+        self.counters = {}
+        #name -> labels -> Histogram
+        self.histograms = {}
+        self.help = {}
+        #name -> key -> collect function
+        self.collectors = {}
+
+    def counter(self, name, help_text):
+        self.counters.setdefault(name, {})
+        self.help[name] = help_text
+
+    def histogram(self, name, help_text):
+        self.histograms.setdefault(name, {})
+        self.help[name] = help_text
+
+    def inc(self, name, labels, value=1):
+        values = self.counters[name]
+        values[labels] = values.get(labels, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self.histograms[name]
+        histogram = histograms.get(labels)
+        if histogram is None:
+            histogram = histograms[labels] = Histogram()
+        histogram.observe(value)
+
+    def add_collector(self, name, key, help_text, collect):
+        #a collector added again under the same key replaces the old one
+        self.help[name] = help_text
+        self.collectors.setdefault(name, {})[key] = collect
+
+    def render(self):
+        lines = []
+        for name, values in sorted(self.counters.items()):
+            lines.append('# HELP %s %s' % (name, self.help[name]))
+            lines.append('# TYPE %s counter' % name)
+            for labels, value in sorted(values.items()):
+                lines.append('%s{%s} %s' % (name, _labels(labels), value))
+
+        for name, collectors in sorted(self.collectors.items()):
+            lines.append('# HELP %s %s' % (name, self.help[name]))
+            lines.append('# TYPE %s counter' % name)
+            for key, collect in sorted(collectors.items()):
+                for labels, value in sorted(collect()):
+                    lines.append('%s{%s} %s' % (name, _labels(labels), value))
+
+        for name, histograms in sorted(self.histograms.items()):
+            lines.append('# HELP %s %s' % (name, self.help[name]))
+            lines.append('# TYPE %s histogram' % name)
+            for labels, histogram in sorted(histograms.items()):
+                label_str = _labels(labels)
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, label_str, bound, cumulative))
+                lines.append('%s_sum{%s} %.9f' % (name, label_str, histogram.sum))
+                lines.append('%s_count{%s} %d' % (name, label_str, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REGISTRY.counter('ryuswitch_packet_in_total', 'PacketIns handled, by app, dpid and forwarding decision')
+REGISTRY.histogram('ryuswitch_packet_in_seconds', 'Time spent in the PacketIn handler, by app and decision')
+
+
+class PacketInMetrics(object):
+    """Records the PacketIns of one app into REGISTRY."""
+
+    def __init__(self, app_name, registry=REGISTRY):
+        self.app_name = app_name
+        self.registry = registry
+        #(dpid, outcome) -> label tuples, built once
+        self._labels = {}
+
+    def record(self, dpid, outcome, seconds):
+        labels = self._labels.get((dpid, outcome))
+        if labels is None:
+            labels = self._labels[(dpid, outcome)] = (
+                (('app', self.app_name), ('dpid', dpid), ('outcome', outcome)),
+                (('app', self.app_name), ('outcome', outcome)))
+        self.registry.inc('ryuswitch_packet_in_total', labels[0])
+        self.registry.observe('ryuswitch_packet_in_seconds', labels[1], seconds)
+
+    def add_batcher(self, batcher):
+        """Export the messages batcher sent, per dpid and message type."""
+        app_name = self.app_name
+
+        def collect():
+            for dpid, counts in batcher.counts.items():
+                for msg_type, count in counts.items():
+                    yield ((('app', app_name), ('dpid', dpid),
+                            ('type', MSG_TYPES.get(msg_type, str(msg_type)))), count)
+        self.registry.add_collector('ryuswitch_messages_sent_total', app_name,
+                                    'OpenFlow messages sent, by app, dpid and message type', collect)
+
+    def add_decision_cache(self, cache):
+        """Export the hits, misses and invalidations of a decision_cache.DecisionCache."""
+        app_name = self.app_name
+
+        def collect():
+            for result in ('hits', 'misses', 'invalidations'):
+                yield ((('app', app_name), ('result', result)), getattr(cache, result))
+        self.registry.add_collector('ryuswitch_decision_cache_total', app_name,
+                                    'Forwarding decision cache lookups and invalidations, by app', collect)
+
+
+_server = None
+
+
+def _application(environ, start_response):
+    if environ.get('PATH_INFO') not in ('/', '/metrics'):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'not found\n']
+    body = REGISTRY.render().encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def start_server(logger):
+    """Serve REGISTRY on listen_host:listen_port, once per process."""
+    global _server
+    if _server is not None or not listen_port:
+        return
+    try:
+        _server = hub.WSGIServer((listen_host, listen_port), _application)
+    except (IOError, OSError) as e:
+        logger.warning("metrics endpoint on %s:%s not available: %s", listen_host, listen_port, e)
+        return
+    hub.spawn(_server.serve_forever)
+    logger.info("metrics on http://%s:%s/metrics", listen_host, listen_port)
@@ -0,0 +1,139 @@
+#Coalesced output of OpenFlow messages per datapath.
+#
+#datapath.send_msg() serializes a message and hands it to the send loop of
+#the datapath, which does one socket write per message. Under a burst of
+#PacketIns the apps emit a FlowMod and a PacketOut (or a GroupMod per vlan)
+#for every event, so the control channel ends up doing many tiny writes.
+#MessageBatcher queues the messages per datapath instead and writes all of
+#them as one buffer, either once the current burst of events has been handled
+#(the next tick of the event loop) or as soon as max_bytes are waiting.
+
+import struct
+
+from ryu.lib import hub
+
+
+#flush straight away once this many bytes are queued for one datapath
+DEFAULT_MAX_BYTES = 64 * 1024
+
+#offset of the xid in the header of every OpenFlow message
+XID_OFFSET = 4
+_xid_struct = struct.Struct('!I')
+
+
+class MessageBatcher(object):
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, logger=None):
+        self.max_bytes = max_bytes
+        self.logger = logger
+        #datapath -> [serialized message buffers]
+        self.pending = {}
+        #datapath -> number of bytes in pending[datapath]
+        self.pending_bytes = {}
+        #datapath id -> xids of barrier requests still waiting for a reply
+        self.barriers = {}
+        #datapath -> messages diverted by hold()
+        self.held = {}
+        #datapath id -> message type -> messages sent
+        self.counts = {}
+        self._flush_scheduled = False
+
+    def send_msg(self, datapath, msg):
+        """
+        Queue msg for datapath, a drop in replacement for
+        datapath.send_msg(msg). The xid is assigned straight away so the
+        caller can still match replies to the message.
+        """
+        if msg.xid is None:
+            datapath.set_xid(msg)
+
+        held = self.held.get(datapath)
+        if held is not None:
+            held.append(msg)
+            return msg.xid
+
+        msg.serialize()
+        self._queue(datapath, msg.buf, msg.cls_msg_type)
+        return msg.xid
+
+    def send_raw(self, datapath, buf, msg_type):
+        """
+        Queue the already serialized message buf (a bytearray, see
+        msg_template.py) of type msg_type for datapath. The xid is assigned
+        and patched into buf here and returned. Raw messages are never held,
+        hold() only applies to send_msg().
+        """
+        datapath.xid = (datapath.xid + 1) & datapath.ofproto.MAX_XID
+        _xid_struct.pack_into(buf, XID_OFFSET, datapath.xid)
+        self._queue(datapath, buf, msg_type)
+        return datapath.xid
+
+    def _queue(self, datapath, buf, msg_type):
+        counts = self.counts.get(datapath.id)
+        if counts is None:
+            counts = self.counts[datapath.id] = {}
+        counts[msg_type] = counts.get(msg_type, 0) + 1
+
+        bufs = self.pending.get(datapath)
+        if bufs is None:
+            bufs = self.pending[datapath] = []
+            self.pending_bytes[datapath] = 0
+        bufs.append(buf)
+        self.pending_bytes[datapath] += len(buf)
+
+        if self.pending_bytes[datapath] >= self.max_bytes:
+            self.flush(datapath)
+        elif not self._flush_scheduled:
+            #runs as soon as the event loop yields, i.e. after the events
+            #that are already queued have been handled
+            self._flush_scheduled = True
+            hub.spawn(self.flush_all)
+
+    def hold(self, datapath):
+        """
+        Keep the messages sent to datapath from now on instead of queueing
+        them, until take_held() hands them back. Used to find out what an app
+        would install on a switch without sending it yet.
+        """
+        self.held[datapath] = []
+
+    def take_held(self, datapath):
+        """Stop holding messages for datapath and return the held ones, in order."""
+        return self.held.pop(datapath, [])
+
+    def barrier(self, datapath):
+        """
+        Queue a barrier request behind everything already queued for
+        datapath. The switch answers it only once all of those messages have
+        been processed, see barrier_reply(). Returns the xid of the request.
+        """
+        parser = datapath.ofproto_parser
+        xid = self.send_msg(datapath, parser.OFPBarrierRequest(datapath))
+        self.barriers.setdefault(datapath.id, set()).add(xid)
+        return xid
+
+    def barrier_reply(self, msg):
+        """
+        Record the reply to a barrier(). Returns True if it answered one of
+        our barrier requests.
+        """
+        pending = self.barriers.get(msg.datapath.id)
+        if not pending or msg.xid not in pending:
+            return False
+        pending.discard(msg.xid)
+        return True
+
+    def flush(self, datapath):
+        """Write everything queued for datapath as a single buffer."""
+        bufs = self.pending.pop(datapath, None)
+        self.pending_bytes.pop(datapath, None)
+        if not bufs:
+            return
+        if not datapath.send(b''.join(bufs)) and self.logger:
+            self.logger.debug("dropped %d messages to closed datapath %s",
+                              len(bufs), datapath.id)
+
+    def flush_all(self):
+        self._flush_scheduled = False
+        for datapath in list(self.pending):
+            self.flush(datapath)
@@ -0,0 +1,139 @@
+#Pre-serialized OpenFlow messages for the PacketIn path.
+#
+#Every learned flow used to cost an OFPMatch, an OFPInstructionActions with
+#its actions and an OFPFlowMod, all serialized again by the batcher, and the
+#same for the PacketOut behind it. Yet the messages only come in a few shapes
+#per switch: the FlowMod of a unicast destination only differs from the one of
+#another destination behind the same port in eth_dst, in_port and the buffer
+#id. A template serializes one message of a shape once and copies that buffer
+#for every message, patching in the fields that differ. The copies go out
+#through MessageBatcher.send_raw(), which patches in the xid.
+#
+#The templates only know OpenFlow 1.3, the version of the apps.
+
+import struct
+
+from ryu.ofproto import ofproto_common
+from ryu.ofproto import ofproto_v1_3
+
+
+#offset of buffer_id in an OFPFlowMod: the header, cookie, cookie_mask, table_id,
+#command, idle and hard timeout and priority come first
+FLOW_MOD_BUFFER_ID = ofproto_common.OFP_HEADER_SIZE + struct.calcsize('!QQBBHHH')
+#offset of the first OXM field of a FlowMod, behind the type and length of its match
+FLOW_MOD_OXM = ofproto_v1_3.OFP_FLOW_MOD_SIZE - ofproto_v1_3.OFP_MATCH_SIZE + 4
+#offsets of the length of every message and of buffer_id, in_port of an OFPPacketOut
+MSG_LENGTH = 2
+PACKET_OUT_BUFFER_ID = ofproto_common.OFP_HEADER_SIZE
+
+_length_struct = struct.Struct('!H')
+_uint32_struct = struct.Struct('!I')
+_packet_out_struct = struct.Struct('!II')
+#OXM header: class, field and has mask (23 bits), length of the value and mask
+_oxm_struct = struct.Struct('!I')
+
+
+def _oxm_offsets(buf, offset, end):
+    """OXM field number -> (offset, length) of its value in the serialized match buf[offset:end]."""
+    offsets = {}
+    while offset + _oxm_struct.size <= end:
+        header = _oxm_struct.unpack_from(buf, offset)[0]
+        length = header & 0xff
+        offsets[header >> 9] = (offset + _oxm_struct.size, length)
+        offset += _oxm_struct.size + length
+    return offsets
+
+
+class FlowModTemplate(object):
+    """
+    An OFPFlowMod serialized once. Messages made from it carry the buffer id
+    and the values of the match fields named in fields given to render(),
+    everything else (priority, timeouts, flags, instructions and the other
+    match fields) as in mod. mod itself is not sent.
+    """
+
+    def __init__(self, mod, fields):
+        ofproto = mod.datapath.ofproto
+        mod.serialize()
+        self.buf = bytes(mod.buf)
+        self.msg_type = mod.cls_msg_type
+        self.fields = tuple(fields)
+
+        match_length = _length_struct.unpack_from(self.buf, FLOW_MOD_OXM - 2)[0]
+        oxms = _oxm_offsets(self.buf, FLOW_MOD_OXM, FLOW_MOD_OXM - 4 + match_length)
+        self.offsets = []
+        for name in self.fields:
+            num, value, mask = ofproto.oxm_from_user(name, mod.match[name])
+            if mask is not None:
+                raise ValueError("masked match field %s can not be patched" % name)
+            self.offsets.append(oxms[num])
+
+    def values(self, **match):
+        """The wire form of the template's match fields, as render() takes them."""
+        return tuple(ofproto_v1_3.oxm_from_user(name, match[name])[1] for name in self.fields)
+
+    def render(self, buffer_id, values):
+        """A new FlowMod for buffer_id, values from values()."""
+        buf = bytearray(self.buf)
+        _uint32_struct.pack_into(buf, FLOW_MOD_BUFFER_ID, buffer_id)
+        for (offset, length), value in zip(self.offsets, values):
+            buf[offset:offset + length] = value
+        return buf
+
+
+class PacketOutTemplate(object):
+    """
+    An OFPPacketOut serialized once, without data. Messages made from it get
+    their buffer id, in_port and data in render(), the actions are those of
+    out.
+    """
+
+    def __init__(self, out):
+        out.serialize()
+        self.buf = bytes(out.buf)
+        self.msg_type = out.cls_msg_type
+        self.actions = bool(out.actions)
+
+    def render(self, buffer_id, in_port, data=None):
+        """A new PacketOut of buffer_id, sending data along if given."""
+        buf = bytearray(self.buf)
+        _packet_out_struct.pack_into(buf, PACKET_OUT_BUFFER_ID, buffer_id, in_port)
+        if data:
+            buf += data
+            _length_struct.pack_into(buf, MSG_LENGTH, len(buf))
+        return buf
+
+
+class MessageTemplates(object):
+    """
+    The templates of one app per datapath id and shape. A shape is any
+    hashable key the app uses for messages that only differ in the patched
+    fields.
+    """
+
+    def __init__(self):
+        #dpid -> shape -> template
+        self.templates = {}
+
+    def get(self, dpid, shape):
+        templates = self.templates.get(dpid)
+        if templates is None:
+            return None
+        return templates.get(shape)
+
+    def put(self, dpid, shape, template):
+        templates = self.templates.get(dpid)
+        if templates is None:
+            templates = self.templates[dpid] = {}
+        templates[shape] = template
+        return template
+
+    def forget(self, dpid):
+        """Drop the templates of dpid, e.g. when the switch connects again."""
+        self.templates.pop(dpid, None)
+
+    def clear(self):
+        self.templates.clear()
+
+    def stats(self):
+        return dict((dpid, len(templates)) for dpid, templates in self.templates.items())
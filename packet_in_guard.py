@@ -0,0 +1,257 @@
+#Protection of the controller against PacketIn floods.
+#
+#The table-miss entry sends every unmatched packet to the controller without
+#any limit, so a single misbehaving host can keep the controller busy for all
+#switches. Two independent limits can be set per datapath:
+#
+# - meter_rate/meter_burst: an OpenFlow 1.3 meter (drop band, packets per
+#   second) attached to the table-miss flow, so the switch itself polices the
+#   packets it sends up. Off unless configured, as not every switch supports
+#   meters and a table-miss flow pointing at a missing meter is rejected.
+# - rate/burst: a token bucket in the controller in front of the PacketIn
+#   handler. Events over the limit are deferred into a small per datapath
+#   queue that is replayed as tokens become available, or dropped when that
+#   queue is full. Both are counted. A dropped PacketIn of a buffered frame
+#   gets a PacketOut without actions, so the switch frees its buffer right
+#   away. Off unless configured, like the meter.
+#
+#The size of the PacketIns themselves is set per datapath by miss_send_len.
+#By default the table-miss flow sends every unmatched frame up whole (up to
+#jumbo size). With miss_send_len set the switch keeps the frame in its buffer
+#and only sends its first miss_send_len bytes, which is all the apps need to
+#take their decision. packet_out() then builds the PacketOut that releases the
+#buffered frame by buffer_id, without sending the payload back down.
+
+import collections
+import time
+
+from ryu.lib import hub
+
+
+Limits = collections.namedtuple('Limits', ['rate', 'burst', 'defer', 'meter_rate', 'meter_burst',
+                                           'miss_send_len'])
+
+#packet ins per second / burst admitted by the controller (None = no limit, the
+#burst defaults to the rate), deferred events kept per datapath, the switch side
+#meter (None = no meter) and the bytes of an unmatched frame sent with its
+#packet in (None = the whole frame, unbuffered)
+DEFAULT_LIMITS = Limits(rate=None, burst=None, defer=256, meter_rate=None, meter_burst=None,
+                        miss_send_len=None)
+
+#per dpid overrides of DEFAULT_LIMITS, e.g.
+#   limits = {1: DEFAULT_LIMITS._replace(rate=200, burst=400, meter_rate=500, meter_burst=100)}
+#   limits = {2: DEFAULT_LIMITS._replace(miss_send_len=128)}
+limits = {}
+
+#smallest miss_send_len: a tagged ethernet header and an ARP packet, for the
+#arp proxy (OpenFlow's own default is 128)
+MIN_MISS_SEND_LEN = 64
+
+#meter used by the table-miss flow
+TABLE_MISS_METER_ID = 1
+
+#how often the deferred events are replayed (seconds)
+REPLAY_INTERVAL = 0.01
+
+
+def truncated(msg):
+    """True if the PacketIn msg carries only the first bytes of its frame."""
+    return len(msg.data) < msg.total_len
+
+
+def packet_out(msg, in_port, actions):
+    """
+    The PacketOut sending the frame of the PacketIn msg through actions. A
+    buffered frame is released by its buffer_id, only unbuffered frames are
+    sent back as data. Returns None when there is nothing to send: the frame
+    is dropped (no actions) and not buffered, or the switch truncated it
+    without buffering it, so the rest of it is gone.
+    """
+    datapath = msg.datapath
+    ofproto = datapath.ofproto
+    data = None
+    if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+        if not actions or truncated(msg):
+            return None
+        data = msg.data
+    return datapath.ofproto_parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
+                                                in_port=in_port, actions=actions, data=data)
+
+
+def render_packet_out(msg, in_port, template):
+    """
+    packet_out() through a msg_template.PacketOutTemplate: the serialized
+    PacketOut with the actions of template, or None if there is nothing to send.
+    """
+    if msg.buffer_id != msg.datapath.ofproto.OFP_NO_BUFFER:
+        return template.render(msg.buffer_id, in_port)
+    if not template.actions or truncated(msg):
+        return None
+    return template.render(msg.buffer_id, in_port, msg.data)
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.last = clock()
+
+    def consume(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class PacketInGuard(object):
+    """
+    Admission control for one app. handler is the app's PacketIn handler, it
+    is called again for deferred events once they are admitted. The PacketOuts
+    releasing the buffers of dropped events go through batcher (a
+    msg_batcher.MessageBatcher), or straight to the datapath without one.
+    """
+
+    def __init__(self, handler, logger, clock=time.monotonic, batcher=None):
+        self.handler = handler
+        self.logger = logger
+        self.clock = clock
+        self.batcher = batcher
+        self.buckets = {}
+        self.deferred = {}
+        #dpid -> {'admitted': n, 'deferred': n, 'dropped': n, 'released': n}, released counts the
+        #dropped events whose buffered frame was freed on the switch
+        self.counters = {}
+        self._replaying = None
+        self._replay_thread = None
+
+    def limits(self, dpid):
+        return limits.get(dpid, DEFAULT_LIMITS)
+
+    def install_meter(self, datapath, batcher):
+        """
+        Add the table-miss meter to datapath if one is configured for it.
+        Returns the meter id to attach to the table-miss flow, or None.
+        """
+        dpid_limits = self.limits(datapath.id)
+        if not dpid_limits.meter_rate:
+            return None
+
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        burst = dpid_limits.meter_burst or 0
+        flags = ofproto.OFPMF_PKTPS
+        if burst:
+            flags |= ofproto.OFPMF_BURST
+        bands = [parser.OFPMeterBandDrop(rate=dpid_limits.meter_rate, burst_size=burst)]
+        #delete first so a reconnecting switch does not reject the add
+        batcher.send_msg(datapath, parser.OFPMeterMod(datapath, command=ofproto.OFPMC_DELETE,
+                                                      meter_id=TABLE_MISS_METER_ID))
+        batcher.send_msg(datapath, parser.OFPMeterMod(datapath, command=ofproto.OFPMC_ADD, flags=flags,
+                                                      meter_id=TABLE_MISS_METER_ID, bands=bands))
+        #the meter has to exist before the table-miss flow refers to it
+        batcher.barrier(datapath)
+        return TABLE_MISS_METER_ID
+
+    def install_miss_send_len(self, datapath, batcher):
+        """
+        Set the miss_send_len configured for datapath on it. Returns the max_len
+        for the output action of its table-miss flow.
+        """
+        ofproto = datapath.ofproto
+        miss_send_len = self.limits(datapath.id).miss_send_len
+        if miss_send_len is None:
+            return ofproto.OFPCML_NO_BUFFER
+
+        miss_send_len = max(miss_send_len, MIN_MISS_SEND_LEN)
+        #the switch config covers the packets sent up for other reasons than a flow (e.g. an invalid ttl)
+        batcher.send_msg(datapath, datapath.ofproto_parser.OFPSetConfig(datapath, ofproto.OFPC_FRAG_NORMAL,
+                                                                        miss_send_len))
+        return miss_send_len
+
+    def _counters(self, dpid):
+        counters = self.counters.get(dpid)
+        if counters is None:
+            counters = self.counters[dpid] = {'admitted': 0, 'deferred': 0, 'dropped': 0, 'released': 0}
+        return counters
+
+    def _bucket(self, dpid):
+        #None when there is no rate limit for dpid
+        if dpid not in self.buckets:
+            dpid_limits = self.limits(dpid)
+            bucket = None
+            if dpid_limits.rate is not None:
+                bucket = TokenBucket(dpid_limits.rate, dpid_limits.burst or dpid_limits.rate, self.clock)
+            self.buckets[dpid] = bucket
+        return self.buckets[dpid]
+
+    def _release(self, msg):
+        #drop the frame of msg, freeing its buffer on the switch if it has one
+        if msg.buffer_id == msg.datapath.ofproto.OFP_NO_BUFFER:
+            return False
+        out = packet_out(msg, msg.match['in_port'], [])
+        if self.batcher is not None:
+            self.batcher.send_msg(msg.datapath, out)
+        else:
+            msg.datapath.send_msg(out)
+        return True
+
+    def admit(self, ev):
+        """
+        Returns True if the handler should process ev now. False means the
+        event was deferred (it will be handed to the handler later) or dropped.
+        """
+        if ev is self._replaying:
+            return True
+
+        dpid = ev.msg.datapath.id
+        counters = self._counters(dpid)
+        queue = self.deferred.get(dpid)
+        bucket = self._bucket(dpid)
+        #while older events wait their turn, new ones queue up behind them
+        if not queue and (bucket is None or bucket.consume()):
+            counters['admitted'] += 1
+            return True
+
+        if queue is None:
+            queue = self.deferred[dpid] = collections.deque()
+        if len(queue) < self.limits(dpid).defer:
+            queue.append(ev)
+            counters['deferred'] += 1
+            if self._replay_thread is None:
+                self._replay_thread = hub.spawn(self._replay)
+        else:
+            counters['dropped'] += 1
+            if self._release(ev.msg):
+                counters['released'] += 1
+            if counters['dropped'] % 1000 == 1:
+                self.logger.warning("dropping packet ins from dpid %s over the admission limit", dpid)
+        return False
+
+    def _replay(self):
+        try:
+            while any(self.deferred.values()):
+                hub.sleep(REPLAY_INTERVAL)
+                for dpid, queue in list(self.deferred.items()):
+                    bucket = self._bucket(dpid)
+                    while queue and (bucket is None or bucket.consume()):
+                        ev = queue.popleft()
+                        self._counters(dpid)['admitted'] += 1
+                        self._replaying = ev
+                        try:
+                            self.handler(ev)
+                        except Exception:
+                            self.logger.exception("deferred packet in from dpid %s failed", dpid)
+                        finally:
+                            self._replaying = None
+        finally:
+            self._replay_thread = None
+
+    def stats(self):
+        return dict((dpid, dict(counters, queued=len(self.deferred.get(dpid, ()))))
+                    for dpid, counters in self.counters.items())
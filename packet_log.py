@@ -0,0 +1,114 @@
+#Sampled, non-blocking logging of per packet log lines.
+#
+#The apps log a line for every PacketIn ("packet in ...", "Adding flow ...").
+#Formatting and writing those synchronously in the handler dominates its
+#latency under load and fills the disks. In the default sampled mode
+#PacketLog only keeps 1 in SAMPLE_EVERY lines of each kind, at most
+#MAX_PER_SECOND of them, and hands the kept ones unformatted to a writer
+#greenthread through a bounded queue (lines that do not fit are dropped).
+#The writer logs them and every SUMMARY_INTERVAL seconds a summary of how many
+#lines of each kind there were. Set PACKET_LOG_MODE=sync in the environment
+#for the old behaviour of logging every line straight away.
+
+import collections
+import logging
+import os
+import time
+
+from ryu.lib import hub
+
+import packet_in_guard
+
+
+SAMPLED = 'sampled'
+SYNC = 'sync'
+
+mode = os.environ.get('PACKET_LOG_MODE', SAMPLED)
+
+#keep 1 in SAMPLE_EVERY lines per kind, and at most MAX_PER_SECOND lines in total
+SAMPLE_EVERY = 100
+MAX_PER_SECOND = 50
+
+#lines waiting for the writer
+QUEUE_SIZE = 1000
+
+#seconds between two runs of the writer, and between two summaries
+WRITE_INTERVAL = 0.1
+SUMMARY_INTERVAL = 10
+
+
+class PacketLog(object):
+    """
+    Per packet logging of one app. info() takes the same arguments as
+    logger.info(), kind names the line in the summaries and defaults to the
+    format string.
+    """
+
+    def __init__(self, logger, sample_every=SAMPLE_EVERY, max_per_second=MAX_PER_SECOND,
+                 queue_size=QUEUE_SIZE, clock=time.monotonic):
+        self.logger = logger
+        self.sample_every = sample_every
+        self.queue_size = queue_size
+        self.clock = clock
+        self.bucket = packet_in_guard.TokenBucket(max_per_second, max_per_second, clock)
+        #(level, format, args) waiting for the writer
+        self.queue = collections.deque()
+        #kind -> [seen, queued, dropped] since the last summary
+        self.counts = {}
+        self._last_summary = clock()
+        self._writer = None
+
+    def info(self, fmt, *args, **kwargs):
+        self.log(logging.INFO, fmt, *args, **kwargs)
+
+    def log(self, level, fmt, *args, **kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        if mode == SYNC:
+            self.logger.log(level, fmt, *args)
+            return
+
+        kind = kwargs.get('kind', fmt)
+        counts = self.counts.get(kind)
+        if counts is None:
+            counts = self.counts[kind] = [0, 0, 0]
+        counts[0] += 1
+        #always keep the first line of a kind, then 1 in sample_every
+        if (counts[0] - 1) % self.sample_every or not self.bucket.consume():
+            return
+        if len(self.queue) >= self.queue_size:
+            counts[2] += 1
+            return
+        counts[1] += 1
+        self.queue.append((level, fmt, args))
+        if self._writer is None:
+            self._writer = hub.spawn(self._write_loop)
+
+    def _write_loop(self):
+        try:
+            while self.queue or any(counts[0] for counts in self.counts.values()):
+                hub.sleep(WRITE_INTERVAL)
+                self.flush()
+                if self.clock() - self._last_summary >= SUMMARY_INTERVAL:
+                    self.summary()
+        finally:
+            self._writer = None
+
+    def flush(self):
+        """Write the queued lines."""
+        queue = self.queue
+        while queue:
+            level, fmt, args = queue.popleft()
+            self.logger.log(level, fmt, *args)
+
+    def summary(self):
+        """Log how many lines of each kind there were since the last summary."""
+        now = self.clock()
+        elapsed = now - self._last_summary
+        self._last_summary = now
+        for kind, counts in sorted(self.counts.items()):
+            seen, queued, dropped = counts
+            if not seen:
+                continue
+            self.logger.info("%d x %r in %.0fs (%d logged, %d dropped)", seen, kind, elapsed, queued, dropped)
+            counts[:] = [0, 0, 0]
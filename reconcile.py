@@ -0,0 +1,233 @@
+#Reconciliation of the static flows and groups of a reconnecting switch.
+#
+#The apps program every switch from scratch on EventOFPSwitchFeatures: the
+#table-miss flow is added again and LearningSwitch.py adds every vlan group
+#with OFPGC_ADD, which the switch rejects when the group survived a flapping
+#control channel. The flows learned before the disconnect are still on the
+#switch while mac_to_port starts out empty.
+#
+#Reconciler takes what the features handler would have sent (captured with
+#MessageBatcher.hold()), dumps the flows and groups the switch already has
+#with multipart requests and only sends the differences:
+#
+# - flow adds that are already installed identically are skipped. They are
+#   tagged with STATIC_COOKIE, and flows with that cookie that the app no
+#   longer wants are deleted.
+# - group adds are skipped when the group is identical, turned into a modify
+#   when it differs, and groups the app does not want are deleted.
+# - every other message (meter mods, barriers, ...) is sent as before.
+# - the flows without STATIC_COOKIE are what the app learned before the
+#   disconnect. They are left alone, their macs are learned back into
+#   mac_to_port and the flows themselves into the flow inventory.
+#
+#If the switch does not answer within RECONCILE_TIMEOUT everything is sent
+#as is, like before.
+
+from ryu.lib import hub
+
+import flow_inventory
+
+
+#cookie of the flows installed by the features handler
+STATIC_COOKIE = 0x5707
+
+#seconds to wait for the flow and group dumps before falling back to a full install
+RECONCILE_TIMEOUT = 5
+
+
+def _serialized(objs):
+    #wire form of instructions/buckets, so objects built by the app compare
+    #equal to the ones parsed from the switch
+    out = []
+    for obj in objs:
+        buf = bytearray()
+        obj.serialize(buf, 0)
+        out.append(bytes(buf))
+    return tuple(sorted(out))
+
+
+class _Dump(object):
+    """State of one running reconciliation."""
+
+    def __init__(self, datapath, desired, flow_xid, group_xid):
+        self.datapath = datapath
+        self.desired = desired
+        self.flow_xid = flow_xid
+        self.group_xid = group_xid
+        self.flows = [] if flow_xid is not None else None
+        self.groups = [] if group_xid is not None else None
+        self.flows_done = flow_xid is None
+        self.groups_done = group_xid is None
+
+
+class Reconciler(object):
+    """
+    Reconciles the static state of reconnecting switches for one app. All
+    messages go out through batcher, learned macs are put back into
+    mac_to_port (a mac_table.MacTables) and learned flows into inventory (a
+    flow_inventory.FlowInventory) if they are given.
+    """
+
+    def __init__(self, batcher, logger, mac_to_port=None, inventory=None, timeout=RECONCILE_TIMEOUT):
+        self.batcher = batcher
+        self.logger = logger
+        self.mac_to_port = mac_to_port
+        self.inventory = inventory
+        self.timeout = timeout
+        #dpid -> _Dump
+        self.dumps = {}
+
+    def reconcile(self, datapath, desired):
+        """
+        Bring datapath in line with desired, the list of (unsent) messages
+        the app wants to install on a freshly connected switch.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        for msg in desired:
+            if isinstance(msg, parser.OFPFlowMod) and msg.command == ofproto.OFPFC_ADD:
+                msg.cookie = STATIC_COOKIE
+
+        flow_req = parser.OFPFlowStatsRequest(datapath, table_id=ofproto.OFPTT_ALL)
+        flow_xid = datapath.set_xid(flow_req)
+        group_xid = None
+        if any(isinstance(msg, parser.OFPGroupMod) for msg in desired):
+            group_req = parser.OFPGroupDescStatsRequest(datapath)
+            group_xid = datapath.set_xid(group_req)
+
+        #a new connection of the same switch replaces a dump still in progress
+        dump = self.dumps[datapath.id] = _Dump(datapath, desired, flow_xid, group_xid)
+        self.batcher.send_msg(datapath, flow_req)
+        if group_xid is not None:
+            self.batcher.send_msg(datapath, group_req)
+        hub.spawn_after(self.timeout, self._timed_out, dump)
+
+    def _timed_out(self, dump):
+        if self.dumps.get(dump.datapath.id) is not dump:
+            return
+        del self.dumps[dump.datapath.id]
+        self.logger.warning("no flow/group dump from dpid %s, installing everything", dump.datapath.id)
+        for msg in dump.desired:
+            self.batcher.send_msg(dump.datapath, msg)
+
+    def flow_stats_reply(self, msg):
+        """
+        Collect a flow stats reply. Returns True if it belonged to a
+        reconciliation.
+        """
+        dump = self.dumps.get(msg.datapath.id)
+        if dump is None or msg.xid != dump.flow_xid:
+            return False
+        dump.flows.extend(msg.body)
+        if not msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            dump.flows_done = True
+            self._finish(dump)
+        return True
+
+    def group_desc_reply(self, msg):
+        """
+        Collect a group description reply. Returns True if it belonged to a
+        reconciliation.
+        """
+        dump = self.dumps.get(msg.datapath.id)
+        if dump is None or msg.xid != dump.group_xid:
+            return False
+        dump.groups.extend(msg.body)
+        if not msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            dump.groups_done = True
+            self._finish(dump)
+        return True
+
+    def _finish(self, dump):
+        if not (dump.flows_done and dump.groups_done):
+            return
+        del self.dumps[dump.datapath.id]
+
+        datapath = dump.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        #meters that get deleted take the flows using them along (OpenFlow 1.3, 7.3.4.4)
+        deleted_meters = set(msg.meter_id for msg in dump.desired
+                             if isinstance(msg, parser.OFPMeterMod) and msg.command == ofproto.OFPMC_DELETE)
+
+        installed_flows = {}
+        for stats in dump.flows:
+            if stats.cookie != STATIC_COOKIE:
+                self._relearn(datapath, stats)
+                if self.inventory is not None:
+                    self.inventory.restore(datapath, stats)
+                continue
+            if any(isinstance(inst, parser.OFPInstructionMeter) and inst.meter_id in deleted_meters
+                   for inst in stats.instructions):
+                continue
+            installed_flows[flow_inventory.flow_key(stats.table_id, stats.priority, stats.match)] = stats
+
+        installed_groups = {}
+        for stats in dump.groups or []:
+            installed_groups[stats.group_id] = stats
+
+        sent = skipped = 0
+        wanted_flows = set()
+        wanted_groups = set()
+        for msg in dump.desired:
+            if isinstance(msg, parser.OFPFlowMod) and msg.command == ofproto.OFPFC_ADD:
+                key = flow_inventory.flow_key(msg.table_id, msg.priority, msg.match)
+                wanted_flows.add(key)
+                stats = installed_flows.get(key)
+                if stats is not None and _serialized(stats.instructions) == _serialized(msg.instructions):
+                    skipped += 1
+                    continue
+            elif isinstance(msg, parser.OFPGroupMod) and msg.command == ofproto.OFPGC_ADD:
+                wanted_groups.add(msg.group_id)
+                stats = installed_groups.get(msg.group_id)
+                if stats is not None:
+                    if stats.type == msg.type and _serialized(stats.buckets) == _serialized(msg.buckets):
+                        skipped += 1
+                        continue
+                    msg.command = ofproto.OFPGC_MODIFY
+            self.batcher.send_msg(datapath, msg)
+            sent += 1
+
+        #static flows and groups the app does not want (any more)
+        for key, stats in installed_flows.items():
+            if key in wanted_flows:
+                continue
+            mod = parser.OFPFlowMod(datapath=datapath, cookie=STATIC_COOKIE, cookie_mask=0xffffffffffffffff,
+                                    table_id=stats.table_id, command=ofproto.OFPFC_DELETE_STRICT,
+                                    priority=stats.priority, out_port=ofproto.OFPP_ANY,
+                                    out_group=ofproto.OFPG_ANY, match=stats.match)
+            self.batcher.send_msg(datapath, mod)
+            sent += 1
+        for group_id in installed_groups:
+            if group_id in wanted_groups:
+                continue
+            req = parser.OFPGroupMod(datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_ALL, group_id, [])
+            self.batcher.send_msg(datapath, req)
+            sent += 1
+
+        self.logger.info("reconciled dpid %s: %d messages sent, %d already installed",
+                         datapath.id, sent, skipped)
+
+    def _relearn(self, datapath, stats):
+        #put the hosts a learned flow refers to back into mac_to_port
+        if self.mac_to_port is None:
+            return
+        ofproto = datapath.ofproto
+        match = stats.match
+        dpid = datapath.id
+
+        in_port = match.get('in_port')
+        eth_src = match.get('eth_src')
+        if in_port is not None and isinstance(eth_src, str):
+            self.mac_to_port.learn(dpid, eth_src, in_port)
+
+        eth_dst = match.get('eth_dst')
+        if not isinstance(eth_dst, str) or int(eth_dst[:2], 16) & 1:
+            #masked or multicast destination
+            return
+        out_ports = [action.port for inst in stats.instructions for action in getattr(inst, 'actions', [])
+                     if hasattr(action, 'port') and action.port <= ofproto.OFPP_MAX]
+        if len(out_ports) == 1:
+            self.mac_to_port.learn(dpid, eth_dst, out_ports[0])
@@ -0,0 +1,321 @@
+#Sharding of the switches over several controller processes.
+#
+#A single ryu-manager handles the PacketIns of every switch on one core. In
+#sharded mode the front-end below accepts the OpenFlow connections instead and
+#spawns SHARD_WORKERS ryu-manager processes running the apps. For every switch
+#that connects it does the start of the handshake itself (HELLO and
+#FEATURES_REQUEST) to learn the dpid, picks the worker owning that dpid on a
+#consistent hash ring and passes the connected socket on to it over a unix
+#socket. The worker runs an ordinary ryu Datapath on it, so the apps do not
+#know the difference. Adding or removing a worker only moves the switches of
+#about one worker's share of the ring.
+#
+#   python sharding.py --workers 4 [--listen-port 6653] VLAN.py
+#
+#Every worker has the state of its own switches only. The state the switches
+#share is the vlan configuration, which every worker loads from the same
+#VLAN_CONFIG_FILE and reloads when it changes. Link discovery is off in
+#sharded mode (a worker would only see the probes of its own switches), the
+#spanning trees are built from the "links" of the vlan configuration, which
+#gives every worker the same trees. Paths (VLAN.py's path_install) are only
+#installed across switches of the same worker.
+#
+#Each worker serves its metrics on METRICS_PORT + its index.
+
+import argparse
+import array
+import bisect
+import hashlib
+import json
+import logging
+import os
+import select
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+
+from ryu.lib import hub
+
+import metrics
+
+
+#set by the front-end in the environment of the workers
+SOCKET_ENV = 'SHARD_SOCKET'
+INDEX_ENV = 'SHARD_INDEX'
+COUNT_ENV = 'SHARD_COUNT'
+
+#points per worker on the hash ring
+RING_REPLICAS = 160
+
+#seconds a switch gets to send its HELLO and FEATURES_REPLY to the front-end
+HANDSHAKE_TIMEOUT = 10
+
+#the apps speak OpenFlow 1.3
+OFP_VERSION = 0x04
+OFPT_HELLO = 0
+OFPT_ERROR = 1
+OFPT_ECHO_REQUEST = 2
+OFPT_ECHO_REPLY = 3
+OFPT_FEATURES_REQUEST = 5
+OFPT_FEATURES_REPLY = 6
+
+#version, type, length, xid (and the datapath id of a FEATURES_REPLY)
+_header_struct = struct.Struct('!BBHI')
+_features_struct = struct.Struct('!BBHIQ')
+
+#largest hand-off message: the peer address and the HELLO of the switch
+MAX_HANDOFF_LEN = 65536
+
+
+def _hash(data):
+    return struct.unpack_from('!Q', hashlib.md5(data).digest())[0]
+
+
+class HashRing(object):
+    """
+    Consistent hashing of dpids over worker indexes 0 .. workers - 1. Every
+    worker has replicas points on the ring, a dpid belongs to the worker of
+    the first point following its hash.
+    """
+
+    def __init__(self, workers, replicas=RING_REPLICAS):
+        points = sorted((_hash(b'worker-%d-%d' % (worker, replica)), worker)
+                        for worker in range(workers) for replica in range(replicas))
+        self.hashes = [point for point, worker in points]
+        self.workers = [worker for point, worker in points]
+
+    def owner(self, dpid):
+        index = bisect.bisect(self.hashes, _hash(struct.pack('!Q', dpid)))
+        return self.workers[index % len(self.workers)]
+
+
+def worker_index():
+    """Index of this process among the workers of a sharded controller, or None if it is not one."""
+    index = os.environ.get(INDEX_ENV)
+    if index is None:
+        return None
+    return int(index)
+
+
+def _recv_exactly(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError("connection closed during the handshake")
+        data += chunk
+    return data
+
+
+def _recv_message(sock):
+    header = _recv_exactly(sock, _header_struct.size)
+    version, msg_type, length, xid = _header_struct.unpack(header)
+    if length < _header_struct.size:
+        raise ValueError("bad message length %d" % length)
+    return version, msg_type, xid, header + _recv_exactly(sock, length - _header_struct.size)
+
+
+class Frontend(object):
+    """
+    Accepts the switch connections and hands each one to the worker owning
+    its dpid. socket_paths are the unix sockets of the workers, by index.
+    """
+
+    def __init__(self, socket_paths, logger, replicas=RING_REPLICAS):
+        self.socket_paths = socket_paths
+        self.logger = logger
+        self.ring = HashRing(len(socket_paths), replicas)
+        #worker index -> switches handed to it
+        self.handed = [0] * len(socket_paths)
+
+    def handshake(self, sock):
+        """Returns the dpid of the switch on sock and the HELLO it sent."""
+        version, msg_type, xid, hello = _recv_message(sock)
+        if msg_type != OFPT_HELLO:
+            raise ValueError("expected a HELLO, got message type %d" % msg_type)
+        if version < OFP_VERSION:
+            raise ValueError("switch only speaks OpenFlow version 0x%02x" % version)
+        sock.sendall(_header_struct.pack(OFP_VERSION, OFPT_HELLO, _header_struct.size, 0))
+        sock.sendall(_header_struct.pack(OFP_VERSION, OFPT_FEATURES_REQUEST, _header_struct.size, 1))
+
+        while True:
+            version, msg_type, xid, msg = _recv_message(sock)
+            if msg_type == OFPT_FEATURES_REPLY:
+                return _features_struct.unpack_from(msg)[4], hello
+            if msg_type == OFPT_ECHO_REQUEST:
+                sock.sendall(struct.pack('!BBHI', OFP_VERSION, OFPT_ECHO_REPLY, len(msg), xid) +
+                             msg[_header_struct.size:])
+            elif msg_type == OFPT_ERROR:
+                raise ValueError("switch sent an error during the handshake")
+
+    def handle(self, sock, address):
+        """StreamServer handler: hand the connection of one switch to its worker."""
+        try:
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            dpid, hello = self.handshake(sock)
+            worker = self.ring.owner(dpid)
+            self.handoff(worker, sock, address, hello)
+        except Exception as e:
+            self.logger.warning("switch at %s not handed to a worker: %s", address, e)
+            return
+        finally:
+            #the worker has its own copy of the socket now
+            sock.close()
+        self.handed[worker] += 1
+        self.logger.info("dpid %s at %s handed to worker %d", dpid, address, worker)
+
+    def handoff(self, worker, sock, address, hello):
+        meta = json.dumps({'address': list(address[:2])}).encode('utf-8')
+        payload = struct.pack('!H', len(meta)) + meta + hello
+        unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            unix_sock.connect(self.socket_paths[worker])
+            unix_sock.sendmsg([payload], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                           array.array('i', [sock.fileno()]))])
+        finally:
+            unix_sock.close()
+
+
+class _HandoffSocket(object):
+    """
+    The socket of a switch handed over by the front-end, as the Datapath of a
+    worker sees it. The switch already exchanged HELLOs with the front-end:
+    the first reads return the HELLO it sent, and the HELLO of the Datapath is
+    not sent again. The FEATURES_REQUEST of the Datapath does go out, the
+    switch simply answers it a second time.
+    """
+
+    def __init__(self, sock, hello):
+        self._sock = sock
+        self._replay = hello
+        self._hello_sent = False
+
+    def recv(self, length):
+        if self._replay:
+            data, self._replay = self._replay[:length], self._replay[length:]
+            return data
+        return self._sock.recv(length)
+
+    def sendall(self, data):
+        if not self._hello_sent and len(data) >= _header_struct.size:
+            version, msg_type, length, xid = _header_struct.unpack_from(data)
+            if msg_type == OFPT_HELLO:
+                self._hello_sent = True
+                data = data[length:]
+                if not data:
+                    return
+        return self._sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+_worker = None
+
+
+def start_worker(logger):
+    """Take over the switches the front-end hands to this process, once per process (if it is a worker)."""
+    global _worker
+    path = os.environ.get(SOCKET_ENV)
+    if _worker is not None or not path:
+        return
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    listener.bind(path)
+    listener.listen(128)
+    _worker = hub.spawn(_accept_loop, listener, logger)
+    logger.info("shard worker %s of %s waiting for switches on %s",
+                worker_index(), os.environ.get(COUNT_ENV), path)
+
+
+def _accept_loop(listener, logger):
+    while True:
+        conn, _address = listener.accept()
+        try:
+            sock, address, hello = _receive(conn)
+        except Exception:
+            logger.exception("bad hand-off from the front-end")
+            continue
+        finally:
+            conn.close()
+        hub.spawn(_serve, sock, address, hello)
+
+
+def _receive(conn):
+    #wait for the message first, the (green) socket hands recvmsg to its non blocking socket
+    select.select([conn], [], [])
+    fd_size = array.array('i').itemsize
+    payload, ancdata, _flags, _address = conn.recvmsg(MAX_HANDOFF_LEN, socket.CMSG_SPACE(fd_size))
+    fds = array.array('i')
+    for level, cmsg_type, data in ancdata:
+        if level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fd_size])
+    if len(fds) != 1:
+        for fd in fds:
+            os.close(fd)
+        raise ValueError("expected one socket, got %d" % len(fds))
+
+    meta_len = struct.unpack_from('!H', payload)[0]
+    meta = json.loads(payload[2:2 + meta_len].decode('utf-8'))
+    sock = socket.socket(fileno=fds[0])
+    return sock, tuple(meta['address']), payload[2 + meta_len:]
+
+
+def _serve(sock, address, hello):
+    #imported here, the front-end itself never runs a Datapath
+    from ryu.controller import controller
+    try:
+        controller.datapath_connection_factory(_HandoffSocket(sock, hello), address)
+    finally:
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shard the switches over several ryu-manager processes")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="worker processes (default: one per core)")
+    parser.add_argument('--listen-host', default='')
+    parser.add_argument('--listen-port', type=int, default=6653,
+                        help="OpenFlow port the switches connect to (default %(default)s)")
+    parser.add_argument('--ryu-manager', default='ryu-manager')
+    parser.add_argument('apps', nargs='+', help="the apps every worker runs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    logger = logging.getLogger('sharding')
+
+    socket_dir = tempfile.mkdtemp(prefix='ryu-shards-')
+    socket_paths = [os.path.join(socket_dir, 'worker-%d.sock' % index) for index in range(args.workers)]
+    workers = []
+    for index, path in enumerate(socket_paths):
+        env = dict(os.environ)
+        env[SOCKET_ENV] = path
+        env[INDEX_ENV] = str(index)
+        env[COUNT_ENV] = str(args.workers)
+        env['METRICS_PORT'] = str(metrics.listen_port + index if metrics.listen_port else 0)
+        #the workers get their switches from us, their own listener stays on localhost
+        cmd = [args.ryu_manager, '--ofp-listen-host', '127.0.0.1',
+               '--ofp-tcp-listen-port', str(args.listen_port + 1 + index)] + args.apps
+        workers.append(subprocess.Popen(cmd, env=env))
+
+    #stopping the front-end stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    frontend = Frontend(socket_paths, logger)
+    logger.info("front-end for %d workers on port %d", args.workers, args.listen_port)
+    try:
+        hub.StreamServer((args.listen_host, args.listen_port), frontend.handle).serve_forever()
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
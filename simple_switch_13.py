@@ -18,17 +18,59 @@ from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
 from ryu.lib.packet import ether_types
 
+import eth_header
+import mac_table
+import msg_batcher
+import packet_in_guard
+import reconcile
+import flow_inventory
+import stats_collector
+import metrics
+import packet_log
+import sharding
+import snapshot
+
+# Two-table learning pipeline. Table 0 only knows which source MACs were
+# seen on which port and sends everything else to the controller, table 1
+# forwards on eth_dst alone and floods unknown destinations. The controller
+# then sees every host once per switch, and a switch needs about 2 flows per
+# host instead of one per (in_port, eth_src, eth_dst).
+multi_table = False
+
+SRC_TABLE = 0
+DST_TABLE = 1
 
 class SimpleSwitch13(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
 
     def __init__(self, *args, **kwargs):
         super(SimpleSwitch13, self).__init__(*args, **kwargs)
-        self.mac_to_port = {}
+        self.mac_to_port = mac_table.MacTables(backend=mac_table.backend)
+        self.batcher = msg_batcher.MessageBatcher(logger=self.logger)
+        self.packet_in_guard = packet_in_guard.PacketInGuard(
+            self._packet_in_handler, self.logger, batcher=self.batcher)
+        self.flow_inventory = flow_inventory.FlowInventory(
+            self.batcher, self.logger,
+            on_removed=self._learned_flow_removed)
+        self.reconciler = reconcile.Reconciler(self.batcher, self.logger,
+                                               self.mac_to_port,
+                                               self.flow_inventory)
+        self.stats_collector = stats_collector.StatsCollector(self.batcher,
+                                                              self.logger)
+        self.packet_in_metrics = metrics.PacketInMetrics(self.name)
+        self.packet_in_metrics.add_batcher(self.batcher)
+        metrics.start_server(self.logger)
+        sharding.start_worker(self.logger)
+        self.packet_log = packet_log.PacketLog(self.logger)
+        # learned macs survive a restart of the controller, see snapshot.py
+        self.snapshots = snapshot.Snapshots(self.name, self.mac_to_port,
+                                            self.flow_inventory, self.logger)
+        self.snapshots.start()
+
+    def close(self):
+        self.snapshots.close()
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
@@ -36,66 +78,214 @@ class SimpleSwitch13(app_manager.RyuApp):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
+        # collect the static entries first and only send what the switch
+        # is missing (it may have kept its flows over a reconnect)
+        self.flow_inventory.reset(datapath.id)
+        self.snapshots.restore(datapath.id)
+        self.batcher.hold(datapath)
+
         # install table-miss flow entry
         #
-        # We specify NO BUFFER to max_len of the output action due to
-        # OVS bug. At this moment, if we specify a lesser number, e.g.,
-        # 128, OVS will send Packet-In with invalid buffer_id and
-        # truncated packet data. In that case, we cannot output packets
-        # correctly.  The bug has been fixed in OVS v2.1.0.
+        # max_len is NO BUFFER unless a miss_send_len is configured for
+        # the switch (see packet_in_guard.py). Before OVS v2.1.0 a lesser
+        # number, e.g., 128, made OVS send Packet-In with invalid
+        # buffer_id and truncated packet data, so only configure it for
+        # switches that buffer correctly.
         match = parser.OFPMatch()
-        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
-                                          ofproto.OFPCML_NO_BUFFER)]
-        self.add_flow(datapath, 0, match, actions)
+        max_len = self.packet_in_guard.install_miss_send_len(datapath,
+                                                             self.batcher)
+        actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, max_len)]
+        meter_id = self.packet_in_guard.install_meter(datapath, self.batcher)
+        self.add_flow(datapath, 0, match, actions, meter_id=meter_id)
+
+        if multi_table:
+            # unknown destinations are flooded by the switch itself
+            actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+            self.add_flow(datapath, 0, match, actions, table_id=DST_TABLE)
+
+        self.reconciler.reconcile(datapath, self.batcher.take_held(datapath))
+        self.stats_collector.add_datapath(datapath)
+
+    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def _flow_stats_reply_handler(self, ev):
+        if self.reconciler.flow_stats_reply(ev.msg):
+            return
+        if self.flow_inventory.flow_stats_reply(ev.msg):
+            return
+        self.stats_collector.flow_stats_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def _port_stats_reply_handler(self, ev):
+        self.stats_collector.port_stats_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPGroupStatsReply, MAIN_DISPATCHER)
+    def _group_stats_reply_handler(self, ev):
+        self.stats_collector.group_stats_reply(ev.msg)
 
-    def add_flow(self, datapath, priority, match, actions, buffer_id=None):
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        self.flow_inventory.flow_removed(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):
+        # the switch has applied everything queued before the barrier
+        if self.batcher.barrier_reply(ev.msg):
+            self.logger.debug("barrier reply from dpid: %s",
+                              ev.msg.datapath.id)
+
+    def _learned_flow_removed(self, datapath, table_id, fields):
+        # The entries of a host in both tables only work together: without
+        # its table 1 entry frames to the host would be flooded forever, as
+        # table 0 keeps it from being learned again. Only the table 0 entry
+        # times out, when it goes the host is forgotten and learned anew.
+        if not multi_table:
+            return
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+        fields = dict(fields)
+
+        if table_id == SRC_TABLE:
+            src = fields['eth_src']
+            # the entry of the old port of a host that moved
+            port = self.mac_to_port.get(dpid, src)
+            if port is not None and port != fields['in_port']:
+                return
+            self.mac_to_port.evict(dpid, src)
+            self.delete_flow(datapath, DST_TABLE, 1,
+                             parser.OFPMatch(eth_dst=src))
+        elif table_id == DST_TABLE:
+            # table 1 entries are only in the inventory when they were found
+            # on the switch after a reconnect, its table 0 entries go too
+            src = fields['eth_dst']
+            self.mac_to_port.evict(dpid, src)
+            self.delete_flow(datapath, SRC_TABLE, 1,
+                             parser.OFPMatch(eth_src=src), strict=False)
+
+    def add_flow(self, datapath, priority, match, actions, buffer_id=None,
+                 meter_id=None, table_id=0, goto_table=None, learned=False):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                              actions)]
-        if buffer_id:
+        if meter_id is not None:
+            inst.insert(0, parser.OFPInstructionMeter(meter_id))
+        if goto_table is not None:
+            inst.append(parser.OFPInstructionGotoTable(goto_table))
+        # buffer id 0 is a valid buffer
+        if buffer_id is not None:
             mod = parser.OFPFlowMod(datapath=datapath, buffer_id=buffer_id,
                                     priority=priority, match=match,
-                                    instructions=inst)
+                                    instructions=inst, table_id=table_id)
         else:
             mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                    match=match, instructions=inst)
-        datapath.send_msg(mod)
+                                    match=match, instructions=inst,
+                                    table_id=table_id)
+        # learned flows time out and are tracked in the inventory
+        if learned:
+            self.flow_inventory.track(datapath, mod)
+        self.batcher.send_msg(datapath, mod)
+
+    def delete_flow(self, datapath, table_id, priority, match, strict=True):
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+
+        command = ofproto.OFPFC_DELETE_STRICT
+        if not strict:
+            command = ofproto.OFPFC_DELETE
+        mod = parser.OFPFlowMod(datapath=datapath, table_id=table_id,
+                                command=command,
+                                priority=priority, out_port=ofproto.OFPP_ANY,
+                                out_group=ofproto.OFPG_ANY, match=match)
+        self.batcher.send_msg(datapath, mod)
+
+    def learn_two_table(self, msg, in_port, src, dst):
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        dpid = datapath.id
+
+        old_port = self.mac_to_port.learn(dpid, src, in_port)
+        if old_port is not None and old_port != in_port:
+            # the host moved, its source entry on the old port is stale
+            self.delete_flow(datapath, SRC_TABLE, 1,
+                             parser.OFPMatch(in_port=old_port, eth_src=src))
+
+        # forward to the host (replaces the entry of the old port on a move).
+        # It does not time out, it is removed along with the table 0 entry.
+        self.add_flow(datapath, 1, parser.OFPMatch(eth_dst=src),
+                      [parser.OFPActionOutput(in_port)], table_id=DST_TABLE)
+
+        # source is known on this port now, skip the controller from now on.
+        # A buffered packet is released into the pipeline by this flow_mod.
+        match = parser.OFPMatch(in_port=in_port, eth_src=src)
+        if msg.buffer_id != ofproto.OFP_NO_BUFFER:
+            self.add_flow(datapath, 1, match, [], msg.buffer_id,
+                          table_id=SRC_TABLE, goto_table=DST_TABLE,
+                          learned=True)
+            return
+        self.add_flow(datapath, 1, match, [],
+                      table_id=SRC_TABLE, goto_table=DST_TABLE, learned=True)
+
+        out_port = self.mac_to_port.get(dpid, dst)
+        if out_port is None:
+            out_port = ofproto.OFPP_FLOOD
+        actions = [parser.OFPActionOutput(out_port)]
+        out = packet_in_guard.packet_out(msg, in_port, actions)
+        if out is not None:
+            self.batcher.send_msg(datapath, out)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
-        # If you hit this you might want to increase
-        # the "miss_send_length" of your switch
-        if ev.msg.msg_len < ev.msg.total_len:
+        if not self.packet_in_guard.admit(ev):
+            return
+        start = metrics.clock()
+        outcome = self.handle_packet_in(ev)
+        self.packet_in_metrics.record(ev.msg.datapath.id, outcome,
+                                      metrics.clock() - start)
+
+    def handle_packet_in(self, ev):
+        # returns the forwarding decision, for the metrics
+        #
+        # A truncated packet is only forwarded if the switch buffered it.
+        # If you hit this you might want to increase the "miss_send_length"
+        # of your switch or check that it buffers packets.
+        if (ev.msg.buffer_id == ev.msg.datapath.ofproto.OFP_NO_BUFFER and
+                packet_in_guard.truncated(ev.msg)):
             self.logger.debug("packet truncated: only %s of %s bytes",
-                              ev.msg.msg_len, ev.msg.total_len)
+                              len(ev.msg.data), ev.msg.total_len)
         msg = ev.msg
         datapath = msg.datapath
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         in_port = msg.match['in_port']
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        eth = eth_header.decode(msg.data)
+        if eth is None:
+            # not even a full ethernet header
+            self.release(msg, in_port)
+            return 'invalid'
 
         if eth.ethertype == ether_types.ETH_TYPE_LLDP:
             # ignore lldp packet
-            return
-        dst = eth.dst
-        src = eth.src
+            self.release(msg, in_port)
+            return 'lldp'
+        dst = eth.dst_str
+        src = eth.src_str
 
         dpid = datapath.id
-        self.mac_to_port.setdefault(dpid, {})
 
-        self.logger.info("packet in %s %s %s %s", dpid, src, dst, in_port)
+        self.packet_log.info("packet in %s %s %s %s", dpid, src, dst, in_port)
+
+        if multi_table:
+            self.learn_two_table(msg, in_port, src, dst)
+            return 'learn'
 
         # learn a mac address to avoid FLOOD next time.
-        self.mac_to_port[dpid][src] = in_port
+        self.mac_to_port.learn(dpid, src, in_port)
 
-        if dst in self.mac_to_port[dpid]:
-            out_port = self.mac_to_port[dpid][dst]
-        else:
+        out_port = self.mac_to_port.get(dpid, dst)
+        if out_port is None:
             out_port = ofproto.OFPP_FLOOD
 
         actions = [parser.OFPActionOutput(out_port)]
@@ -106,14 +296,22 @@ class SimpleSwitch13(app_manager.RyuApp):
             # verify if we have a valid buffer_id, if yes avoid to send both
             # flow_mod & packet_out
             if msg.buffer_id != ofproto.OFP_NO_BUFFER:
-                self.add_flow(datapath, 1, match, actions, msg.buffer_id)
-                return
+                self.add_flow(datapath, 1, match, actions, msg.buffer_id,
+                              learned=True)
+                return 'unicast'
             else:
-                self.add_flow(datapath, 1, match, actions)
-        data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
-            data = msg.data
-
-        out = parser.OFPPacketOut(datapath=datapath, buffer_id=msg.buffer_id,
-                                  in_port=in_port, actions=actions, data=data)
-        datapath.send_msg(out)
+                self.add_flow(datapath, 1, match, actions, learned=True)
+        # a buffered packet is released by its buffer_id, without the data
+        out = packet_in_guard.packet_out(msg, in_port, actions)
+        if out is not None:
+            self.batcher.send_msg(datapath, out)
+        if out_port == ofproto.OFPP_FLOOD:
+            return 'flood'
+        return 'unicast'
+
+    def release(self, msg, in_port):
+        # drop a packet the switch buffered instead of leaving it in the
+        # buffer until it times out
+        out = packet_in_guard.packet_out(msg, in_port, [])
+        if out is not None:
+            self.batcher.send_msg(msg.datapath, out)
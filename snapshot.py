@@ -0,0 +1,165 @@
+#Warm restart of the apps from snapshots of their learned state.
+#
+#A restarted controller starts out with empty mac tables, so every switch
+#floods until each host has been seen again. With SNAPSHOT_DIR set in the
+#environment every app writes the macs it learned and the hit history of its
+#learned flows to SNAPSHOT_DIR/<app name>.json.gz every SNAPSHOT_INTERVAL
+#seconds and when it is closed. The file is written next to the old one and
+#renamed over it, so a crash never leaves half a snapshot behind.
+#
+#On startup the snapshot is read back. When a switch connects its macs are
+#restored, with the age they had (plus the time the controller was down)
+#before reconcile.py dumps the flows of the switch. That dump is the check
+#against the switch: the macs of the learned flows it finds are learned again
+#over the snapshot, and only flows the switch still has get their hit history
+#back. Groups are not part of the snapshot, the apps derive them from the vlan
+#configuration and reconcile.py checks them against the switch on every
+#connect. In sharded mode (sharding.py) every worker has a snapshot of its
+#own.
+
+import gzip
+import json
+import os
+import tempfile
+import time
+
+from ryu.lib import hub
+
+import sharding
+
+
+snapshot_dir = os.environ.get('SNAPSHOT_DIR')
+
+#seconds between two snapshots
+SNAPSHOT_INTERVAL = 30
+
+#version of the file layout, snapshots of another version are ignored
+FORMAT = 1
+
+
+def _fields(fields):
+    #json turns the tuples of the match fields (and of masked values) into lists
+    return tuple((name, tuple(value) if isinstance(value, list) else value) for name, value in fields)
+
+
+class Snapshots(object):
+    """
+    Snapshots of the mac_to_port (a mac_table.MacTables) and inventory (a
+    flow_inventory.FlowInventory) of the app name. Nothing is read or
+    written unless a directory is given (or set in SNAPSHOT_DIR).
+    """
+
+    def __init__(self, name, mac_to_port, inventory, logger, directory=None, interval=SNAPSHOT_INTERVAL,
+                 clock=time.time):
+        if directory is None:
+            directory = snapshot_dir
+        self.path = None
+        if directory:
+            index = sharding.worker_index()
+            if index is not None:
+                name = '%s-%d' % (name, index)
+            self.path = os.path.join(directory, '%s.json.gz' % name)
+        self.mac_to_port = mac_to_port
+        self.inventory = inventory
+        self.logger = logger
+        self.interval = interval
+        #wall clock, the ages in a snapshot count across restarts
+        self.clock = clock
+        #dpid -> (time of the snapshot, macs, flows) of the switches that did not connect since it was read
+        self.pending = {}
+        self._thread = None
+
+    def start(self):
+        """Read the last snapshot and take a new one every interval seconds."""
+        if self.path is None or self._thread is not None:
+            return
+        self.load()
+        self._thread = hub.spawn(self._loop)
+
+    def close(self):
+        """Stop taking snapshots and take a last one."""
+        if self._thread is None:
+            return
+        hub.kill(self._thread)
+        self._thread = None
+        self.save()
+
+    def _loop(self):
+        while True:
+            hub.sleep(self.interval)
+            try:
+                self.save()
+            except Exception:
+                self.logger.exception("snapshot %s not written", self.path)
+
+    def load(self):
+        try:
+            with gzip.open(self.path, 'rt') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning("snapshot %s not read: %s", self.path, e)
+            return
+        if data.get('format') != FORMAT:
+            self.logger.warning("snapshot %s has format %s, not %s", self.path, data.get('format'), FORMAT)
+            return
+
+        taken = data['time']
+        for dpid, state in data['switches'].items():
+            self.pending[int(dpid)] = (taken, state['macs'], state['flows'])
+        self.logger.info("read snapshot %s of %d switches, taken %.0f seconds ago",
+                         self.path, len(self.pending), self.clock() - taken)
+
+    def restore(self, dpid):
+        """
+        Put the state of dpid in the snapshot back. Call when the switch
+        connects, before its reconciliation.
+        """
+        pending = self.pending.pop(dpid, None)
+        if pending is None:
+            return
+        taken, macs, flows = pending
+        down = max(0, self.clock() - taken)
+        self.mac_to_port.restore(dpid, [(mac, port, age + down) for mac, port, age in macs])
+        self.inventory.restore_history(dpid, [(table_id, priority, _fields(fields), packet_count, idle + down)
+                                              for table_id, priority, fields, packet_count, idle in flows])
+        self.logger.info("restored %d macs of dpid %s from the snapshot", len(self.mac_to_port.items(dpid)), dpid)
+
+    def save(self):
+        """Write a snapshot now."""
+        if self.path is None:
+            return
+        now = self.clock()
+        switches = {}
+        #switches that did not connect again yet keep their state, until it aged out
+        for dpid, (taken, macs, flows) in self.pending.items():
+            down = now - taken
+            macs = [(mac, port, age + down) for mac, port, age in macs
+                    if age + down <= self.mac_to_port.aging_time]
+            if macs:
+                switches[dpid] = {'macs': macs,
+                                  'flows': [(table_id, priority, fields, packet_count, idle + down)
+                                            for table_id, priority, fields, packet_count, idle in flows]}
+
+        #ages to a tenth of a second, the aging itself is in seconds
+        for dpid, macs in self.mac_to_port.snapshot().items():
+            switches[dpid] = {'macs': [(mac, port, round(age, 1)) for mac, port, age in macs], 'flows': []}
+        for dpid, flows in self.inventory.snapshot().items():
+            switches.setdefault(dpid, {'macs': []})['flows'] = [
+                (table_id, priority, fields, packet_count, round(idle, 1))
+                for table_id, priority, fields, packet_count, idle in flows]
+
+        data = {'format': FORMAT, 'time': now, 'switches': switches}
+        directory = os.path.dirname(self.path) or '.'
+        fd, tmp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                    gz.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
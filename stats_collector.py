@@ -0,0 +1,212 @@
+#Periodic flow/port/group statistics of the connected switches.
+#
+#StatsCollector polls every datapath it is given for its flow, port and group
+#statistics and keeps the results as bounded time series (a deque of the last
+#HISTORY samples) per dpid and table, port, group and vlan. Reading the latest
+#sample or a whole series is a dictionary lookup, so other components can ask
+#for it as often as they like.
+#
+#The datapaths are polled one at a time, spread evenly over the poll interval
+#instead of all at the same moment, and the interval grows with the number of
+#switches (PER_DATAPATH seconds each, between MIN_INTERVAL and MAX_INTERVAL)
+#so the load on the controller stays about the same.
+
+import collections
+import time
+
+from ryu.lib import hub
+
+
+#poll interval of every datapath in seconds, PER_DATAPATH per switch within these bounds
+MIN_INTERVAL = 10
+MAX_INTERVAL = 300
+PER_DATAPATH = 0.5
+
+#samples kept per time series
+HISTORY = 360
+
+PortSample = collections.namedtuple('PortSample', ['time', 'rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes',
+                                                   'rx_dropped', 'tx_dropped', 'rx_errors', 'tx_errors'])
+GroupSample = collections.namedtuple('GroupSample', ['time', 'packet_count', 'byte_count'])
+#flow_count flows were in the table, with these packet/byte counters in total
+TableSample = collections.namedtuple('TableSample', ['time', 'flow_count', 'packet_count', 'byte_count'])
+
+PORT = 'port'
+GROUP = 'group'
+TABLE = 'table'
+
+
+class StatsCollector(object):
+    """
+    Polls the datapaths added with add_datapath(). The app forwards the flow,
+    port and group stats replies to the *_reply() methods. vlan_to_group is
+    an optional callable returning the current vlan id -> group id mapping,
+    for the per vlan queries. A vlan flooded through several groups maps to
+    a tuple of their ids.
+    """
+
+    def __init__(self, batcher, logger, vlan_to_group=None, history=HISTORY, clock=time.time):
+        self.batcher = batcher
+        self.logger = logger
+        self.vlan_to_group = vlan_to_group
+        self.history = history
+        self.clock = clock
+        #dpid -> datapath
+        self.datapaths = {}
+        #(kind, dpid, key) -> deque of samples
+        self.series = {}
+        #xid -> (dpid, time sent) of outstanding requests
+        self.requests = {}
+        #xid -> {table id: [flows, packets, bytes]} of flow stats still coming in
+        self._tables = {}
+        self._thread = None
+
+    def add_datapath(self, datapath):
+        self.datapaths[datapath.id] = datapath
+        if self._thread is None:
+            self._thread = hub.spawn(self._loop)
+
+    def remove_datapath(self, dpid):
+        self.datapaths.pop(dpid, None)
+
+    def interval(self):
+        return min(MAX_INTERVAL, max(MIN_INTERVAL, len(self.datapaths) * PER_DATAPATH))
+
+    def _loop(self):
+        try:
+            while self.datapaths:
+                for dpid in sorted(self.datapaths):
+                    datapath = self.datapaths.get(dpid)
+                    if datapath is None:
+                        continue
+                    if not datapath.is_active:
+                        self.remove_datapath(dpid)
+                        continue
+                    self.poll(datapath)
+                    #spread the datapaths over the interval
+                    hub.sleep(self.interval() / max(1, len(self.datapaths)))
+        finally:
+            self._thread = None
+
+    def poll(self, datapath):
+        """Send the flow, port and group stats requests to datapath."""
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        now = self.clock()
+
+        #forget requests the switch never answered
+        deadline = now - 2 * self.interval()
+        for xid, (dpid, sent) in list(self.requests.items()):
+            if sent < deadline:
+                del self.requests[xid]
+                self._tables.pop(xid, None)
+
+        for req in (parser.OFPFlowStatsRequest(datapath, table_id=ofproto.OFPTT_ALL),
+                    parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY),
+                    parser.OFPGroupStatsRequest(datapath, 0, ofproto.OFPG_ALL)):
+            xid = self.batcher.send_msg(datapath, req)
+            self.requests[xid] = (datapath.id, now)
+
+    def _append(self, kind, dpid, key, sample):
+        series = self.series.get((kind, dpid, key))
+        if series is None:
+            series = self.series[(kind, dpid, key)] = collections.deque(maxlen=self.history)
+        series.append(sample)
+
+    def _reply(self, msg):
+        #the request of msg if it is one of ours, None otherwise. Done once the last part is in
+        request = self.requests.get(msg.xid)
+        if request is None or request[0] != msg.datapath.id:
+            return None
+        if not msg.flags & msg.datapath.ofproto.OFPMPF_REPLY_MORE:
+            del self.requests[msg.xid]
+        return request
+
+    def flow_stats_reply(self, msg):
+        """Record a flow stats reply. Returns True if it answered one of our requests."""
+        if self._reply(msg) is None:
+            return False
+        tables = self._tables.setdefault(msg.xid, {})
+        for stats in msg.body:
+            totals = tables.get(stats.table_id)
+            if totals is None:
+                totals = tables[stats.table_id] = [0, 0, 0]
+            totals[0] += 1
+            totals[1] += stats.packet_count
+            totals[2] += stats.byte_count
+
+        if msg.xid not in self.requests:
+            now = self.clock()
+            for table_id, totals in self._tables.pop(msg.xid).items():
+                self._append(TABLE, msg.datapath.id, table_id, TableSample(now, *totals))
+        return True
+
+    def port_stats_reply(self, msg):
+        """Record a port stats reply. Returns True if it answered one of our requests."""
+        if self._reply(msg) is None:
+            return False
+        now = self.clock()
+        for stats in msg.body:
+            self._append(PORT, msg.datapath.id, stats.port_no,
+                         PortSample(now, stats.rx_packets, stats.tx_packets, stats.rx_bytes, stats.tx_bytes,
+                                    stats.rx_dropped, stats.tx_dropped, stats.rx_errors, stats.tx_errors))
+        return True
+
+    def group_stats_reply(self, msg):
+        """Record a group stats reply. Returns True if it answered one of our requests."""
+        if self._reply(msg) is None:
+            return False
+        now = self.clock()
+        for stats in msg.body:
+            self._append(GROUP, msg.datapath.id, stats.group_id,
+                         GroupSample(now, stats.packet_count, stats.byte_count))
+        return True
+
+    #queries, each returns the deque of samples (oldest first, do not modify) or an empty tuple
+
+    def port(self, dpid, port_no):
+        return self.series.get((PORT, dpid, port_no), ())
+
+    def group(self, dpid, group_id):
+        return self.series.get((GROUP, dpid, group_id), ())
+
+    def table(self, dpid, table_id):
+        return self.series.get((TABLE, dpid, table_id), ())
+
+    def vlan(self, dpid, vid):
+        """
+        The series of the flooding group of vlan vid. For several groups the
+        samples are summed, over the newest samples all of them have.
+        """
+        if self.vlan_to_group is None:
+            return ()
+        group_id = self.vlan_to_group().get(vid)
+        if group_id is None:
+            return ()
+        if not isinstance(group_id, tuple):
+            return self.group(dpid, group_id)
+        series = [self.group(dpid, one) for one in group_id]
+        length = min(len(one) for one in series)
+        if not length:
+            return ()
+        samples = zip(*[list(one)[-length:] for one in series])
+        return collections.deque(GroupSample(max(sample.time for sample in group_samples),
+                                             sum(sample.packet_count for sample in group_samples),
+                                             sum(sample.byte_count for sample in group_samples))
+                                 for group_samples in samples)
+
+    def latest(self, series):
+        """The newest sample of one of the series above, or None."""
+        if not series:
+            return None
+        return series[-1]
+
+    def rate(self, series, field):
+        """Change of field per second between the last two samples of series, or None."""
+        if len(series) < 2:
+            return None
+        old, new = series[-2], series[-1]
+        elapsed = new.time - old.time
+        if elapsed <= 0:
+            return None
+        return (getattr(new, field) - getattr(old, field)) / float(elapsed)
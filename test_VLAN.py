@@ -0,0 +1,261 @@
+#Tests of VlanSwitch13 (VLAN.py) driven through its event handlers, with the
+#switch stood in for by the Datapath of conftest.py.
+
+import struct
+
+import pytest
+
+pytest.importorskip('ryu')
+
+from ryu.controller import ofp_event
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+import reconcile
+import vlan_config
+
+
+ofproto = ofproto_v1_3
+parser = ofproto_v1_3_parser
+
+PORT_VLAN = {1: {1: [20], 2: [20], 3: [30], 4: [20, 30]}}
+ACCESS = {1: [1, 2, 3]}
+TRUNK = {1: [4]}
+
+BUFFERED = 7
+
+
+def connect(app, datapath):
+    """Connect datapath to app, returns what it was sent."""
+    features = parser.OFPSwitchFeatures(datapath, datapath_id=datapath.id)
+    app.switch_features_handler(ofp_event.EventOFPSwitchFeatures(features))
+    app.batcher.flush_all()
+    return datapath.take()
+
+
+def multipart_xid(sent, stats_type):
+    #xid of the multipart request of stats_type among the sent messages
+    xids = [xid for msg_type, xid, buf in sent
+            if msg_type == ofproto.OFPT_MULTIPART_REQUEST and struct.unpack_from('!H', buf, 8)[0] == stats_type]
+    assert len(xids) == 1
+    return xids[0]
+
+
+def flow_stats_reply(app, datapath, xid, body):
+    msg = parser.OFPFlowStatsReply(datapath, body=body, flags=0)
+    msg.xid = xid
+    app._flow_stats_reply_handler(ofp_event.EventOFPFlowStatsReply(msg))
+    app.batcher.flush_all()
+    return datapath.take()
+
+
+def group_desc_reply(app, datapath, xid, body):
+    msg = parser.OFPGroupDescStatsReply(datapath, body=body, flags=0)
+    msg.xid = xid
+    app._group_desc_reply_handler(ofp_event.EventOFPGroupDescStatsReply(msg))
+    app.batcher.flush_all()
+    return datapath.take()
+
+
+def frame(src, dst, vid=None):
+    data = bytes.fromhex(dst.replace(':', '') + src.replace(':', ''))
+    if vid is not None:
+        data += struct.pack('!HH', 0x8100, vid)
+    return data + struct.pack('!H', 0x0800) + b'\x00' * 46
+
+
+def packet_in(app, datapath, in_port, data, buffer_id=BUFFERED):
+    """Hand a PacketIn to app, returns its decision and what it sent."""
+    msg = parser.OFPPacketIn(datapath, buffer_id=buffer_id, total_len=len(data), reason=ofproto.OFPR_NO_MATCH,
+                             table_id=0, cookie=0, match=parser.OFPMatch(in_port=in_port), data=data)
+    msg.msg_len = len(data) + ofproto.OFP_PACKET_IN_SIZE
+    outcome = app.handle_packet_in(ofp_event.EventOFPPacketIn(msg))
+    app.batcher.flush_all()
+    return outcome, datapath.take()
+
+
+def released(sent, buffer_id=BUFFERED):
+    """Whether sent is the PacketOut without actions that drops buffer_id."""
+    return [(msg_type, struct.unpack_from('!I', buf, 8)[0], struct.unpack_from('!H', buf, 16)[0])
+            for msg_type, xid, buf in sent] == [(ofproto.OFPT_PACKET_OUT, buffer_id, 0)]
+
+
+def mods(sent):
+    """The (type, command) of the flow and group mods among the sent messages."""
+    out = []
+    for msg_type, xid, buf in sent:
+        if msg_type == ofproto.OFPT_FLOW_MOD:
+            out.append((msg_type, buf[25]))
+        elif msg_type == ofproto.OFPT_GROUP_MOD:
+            out.append((msg_type, struct.unpack_from('!H', buf, 8)[0]))
+    return out
+
+
+def installed(desired):
+    """The flow and group stats of a switch that has everything in desired."""
+    flows = [parser.OFPFlowStats(table_id=msg.table_id, priority=msg.priority, cookie=msg.cookie,
+                                 idle_timeout=msg.idle_timeout, hard_timeout=msg.hard_timeout, flags=msg.flags,
+                                 duration_sec=10, duration_nsec=0, packet_count=0, byte_count=0,
+                                 match=msg.match, instructions=msg.instructions)
+             for msg in desired if isinstance(msg, parser.OFPFlowMod)]
+    groups = [parser.OFPGroupDescStats(msg.type, msg.group_id, msg.buckets)
+              for msg in desired if isinstance(msg, parser.OFPGroupMod)]
+    return flows, groups
+
+
+def test_connect_new_switch(vlan_switch13, datapath):
+    app = vlan_switch13(PORT_VLAN, ACCESS, TRUNK, group_flooding=True)
+    sent = connect(app, datapath)
+    #nothing is installed before the switch said what it has
+    assert mods(sent) == []
+    flow_xid = multipart_xid(sent, ofproto.OFPMP_FLOW)
+    group_xid = multipart_xid(sent, ofproto.OFPMP_GROUP_DESC)
+
+    assert mods(flow_stats_reply(app, datapath, flow_xid, [])) == []
+    assert datapath.id in app.reconciler.dumps
+
+    sent = mods(group_desc_reply(app, datapath, group_xid, []))
+    assert app.reconciler.dumps == {}
+    groups = [mod for mod in sent if mod[0] == ofproto.OFPT_GROUP_MOD]
+    flows = [mod for mod in sent if mod[0] == ofproto.OFPT_FLOW_MOD]
+    assert groups == [(ofproto.OFPT_GROUP_MOD, ofproto.OFPGC_ADD)] * len(app.flood_groups[datapath.id])
+    assert flows and set(flows) == set([(ofproto.OFPT_FLOW_MOD, ofproto.OFPFC_ADD)])
+
+
+def test_connect_installed_switch(vlan_switch13, datapath, monkeypatch):
+    #the switch kept its flows and groups while the controller restarted
+    app = vlan_switch13(PORT_VLAN, ACCESS, TRUNK, group_flooding=True)
+    desired = []
+    reconcile_ = app.reconciler.reconcile
+
+    def spy(datapath, msgs):
+        desired.extend(msgs)
+        return reconcile_(datapath, msgs)
+    monkeypatch.setattr(app.reconciler, 'reconcile', spy)
+    sent = connect(app, datapath)
+    flows, groups = installed(desired)
+    assert groups
+    assert set(flow.cookie for flow in flows) == set([reconcile.STATIC_COOKIE])
+
+    #a flow learned before the disconnect, from the host on port 1 to the one on port 2
+    match = parser.OFPMatch(in_port=1, eth_dst='02:00:00:00:02:01')
+    inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, [parser.OFPActionOutput(2)])]
+    learned = parser.OFPFlowStats(table_id=0, priority=1, cookie=0, idle_timeout=0, hard_timeout=0, flags=0,
+                                  duration_sec=10, duration_nsec=0, packet_count=3, byte_count=300,
+                                  match=match, instructions=inst)
+
+    assert flow_stats_reply(app, datapath, multipart_xid(sent, ofproto.OFPMP_FLOW), flows + [learned]) == []
+    sent = group_desc_reply(app, datapath, multipart_xid(sent, ofproto.OFPMP_GROUP_DESC), groups)
+    assert app.reconciler.dumps == {}
+    #everything is already there
+    assert mods(sent) == []
+    assert app.mac_to_port.get(datapath.id, '02:00:00:00:02:01') == 2
+    assert len(app.flow_inventory.tables[datapath.id][0]) == 1
+
+
+def test_packet_in_on_dropped_port(vlan_switch13, datapath):
+    app = vlan_switch13(PORT_VLAN, ACCESS, TRUNK)
+    connect(app, datapath)
+    data = frame('02:00:00:00:03:01', '02:00:00:00:01:01')
+    assert packet_in(app, datapath, 3, data)[0] == 'flood'
+
+    #port 3 is taken out of its vlan while its packets are on their way to the controller
+    port_vlan = {1: {1: [20], 2: [20], 4: [20, 30]}}
+    app.reload_vlan_config(vlan_config.VlanConfig.from_port_vlan(port_vlan, {1: [1, 2]}, TRUNK, []))
+    app.batcher.flush_all()
+    datapath.take()
+    outcome, sent = packet_in(app, datapath, 3, data)
+    assert outcome == 'unconfigured'
+    assert released(sent)
+    assert app.mac_to_port.get(datapath.id, '02:00:00:00:03:01') is None
+
+
+def test_barrier_reply(vlan_switch13, datapath):
+    app = vlan_switch13(PORT_VLAN, ACCESS, TRUNK, group_flooding=True)
+    sent = connect(app, datapath)
+    sent += group_desc_reply(app, datapath, multipart_xid(sent, ofproto.OFPMP_GROUP_DESC), [])
+    sent += flow_stats_reply(app, datapath, multipart_xid(sent, ofproto.OFPMP_FLOW), [])
+    #the flood groups go in before the flows using them
+    xids = [xid for msg_type, xid, buf in sent if msg_type == ofproto.OFPT_BARRIER_REQUEST]
+    assert len(xids) == 1
+    assert app.batcher.barriers[datapath.id] == set(xids)
+
+    reply = parser.OFPBarrierReply(datapath)
+    reply.xid = xids[0]
+    app._barrier_reply_handler(ofp_event.EventOFPBarrierReply(reply))
+    assert app.batcher.barriers[datapath.id] == set()
+
+
+def test_vlan_stats(vlan_switch13, datapath):
+    app = vlan_switch13(PORT_VLAN, ACCESS, TRUNK, group_flooding=True)
+    connect(app, datapath)
+    assert app.vlan_flood_groups() == {'NULL': (0,), 20: (40, 41), 30: (60, 61)}
+
+    for count in (1, 2):
+        app.stats_collector.poll(datapath)
+        app.batcher.flush_all()
+        msg = parser.OFPGroupStatsReply(datapath, flags=0, body=[
+            parser.OFPGroupStats(group_id=group_id, ref_count=1, packet_count=count * packets,
+                                 byte_count=count * packets * 100, duration_sec=count, duration_nsec=0,
+                                 bucket_stats=[])
+            for group_id, packets in ((40, 1), (41, 2), (60, 5))])
+        msg.xid = multipart_xid(datapath.take(), ofproto.OFPMP_GROUP)
+        app._group_stats_reply_handler(ofp_event.EventOFPGroupStatsReply(msg))
+
+    #both flood groups of vlan 20 count
+    series = app.stats_collector.vlan(datapath.id, 20)
+    assert [(sample.packet_count, sample.byte_count) for sample in series] == [(3, 300), (6, 600)]
+    #only one of the groups of vlan 30 answered
+    assert app.stats_collector.vlan(datapath.id, 30) == ()
+    assert app.stats_collector.vlan(datapath.id, 40) == ()
+
+
+def test_reload(vlan_switch13, datapath):
+    app = vlan_switch13(PORT_VLAN, ACCESS, TRUNK, group_flooding=True)
+    sent = connect(app, datapath)
+    group_desc_reply(app, datapath, multipart_xid(sent, ofproto.OFPMP_GROUP_DESC), [])
+    flow_stats_reply(app, datapath, multipart_xid(sent, ofproto.OFPMP_FLOW), [])
+    packet_in(app, datapath, 3, frame('02:00:00:00:03:01', '02:00:00:00:01:01'), ofproto.OFP_NO_BUFFER)
+
+    #port 3 moves from vlan 30 to vlan 20
+    port_vlan = {1: {1: [20], 2: [20], 3: [20], 4: [20, 30]}}
+    app.reload_vlan_config(vlan_config.VlanConfig.from_port_vlan(port_vlan, ACCESS, TRUNK, []))
+    app.batcher.flush_all()
+    sent = datapath.take()
+
+    #the groups of both vlans change members, nothing is added or removed
+    group_mods = set((struct.unpack_from('!H', buf, 8)[0], struct.unpack_from('!I', buf, 12)[0])
+                     for msg_type, xid, buf in sent if msg_type == ofproto.OFPT_GROUP_MOD)
+    assert group_mods == set((ofproto.OFPGC_MODIFY, group_id) for group_id in (40, 41, 60, 61))
+    #only the flows of port 3 and of the host learned on it are deleted, its flood flow comes back in vlan 20
+    deletes = [parser.OFPFlowMod.parser(datapath, ofproto.OFP_VERSION, msg_type, len(buf), xid, buf)
+               for msg_type, xid, buf in sent
+               if msg_type == ofproto.OFPT_FLOW_MOD and buf[25] == ofproto.OFPFC_DELETE]
+    assert sorted((mod.out_port, sorted(mod.match.items())) for mod in deletes) == [
+        (3, []),
+        (ofproto.OFPP_ANY, [('eth_dst', '02:00:00:00:03:01')]),
+        (ofproto.OFPP_ANY, [('in_port', 3)]),
+    ]
+    assert app.mac_to_port.get(datapath.id, '02:00:00:00:03:01') is None
+    assert [action.group_id for action in app.flood_plans[(datapath.id, 3, 20, 0)]] == [40]
+
+
+def output_ports(actions):
+    #the port of every output action, None for the others
+    return [getattr(action, 'port', None) for action in actions]
+
+
+def test_flood_plans(vlan_switch13):
+    app = vlan_switch13(PORT_VLAN, ACCESS, TRUNK)
+    #tagged frames of every vlan of the switch on every port, untagged ones of the vlan of the port
+    assert set(app.flood_plans) == set([(1, port, vid, 1) for port in (1, 2, 3, 4) for vid in (20, 30)] +
+                                       [(1, 1, 20, 0), (1, 2, 20, 0), (1, 3, 30, 0), (1, 4, 'NULL', 0)])
+    for (dpid, in_port, vid, tagged), plan in app.flood_plans.items():
+        assert isinstance(plan, tuple)
+        assert [str(action) for action in plan] == \
+            [str(action) for action in app.getFloodActions(dpid, in_port, vid, tagged, parser)]
+
+    #untagged from an access port: the other access port as is, the trunk tagged
+    assert output_ports(app.flood_plans[(1, 1, 20, 0)]) == [2, None, None, 4]
+    #tagged from the trunk: untagged to the access ports
+    assert output_ports(app.flood_plans[(1, 4, 30, 1)]) == [None, 3]
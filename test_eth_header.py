@@ -0,0 +1,97 @@
+#Tests of eth_header.py: decode() has to agree with the full Ryu parser on
+#every field the apps read.
+
+import pytest
+
+pytest.importorskip('ryu')
+
+from ryu.lib.packet import arp
+from ryu.lib.packet import ether_types
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ipv4
+from ryu.lib.packet import packet
+from ryu.lib.packet import vlan
+
+import eth_header
+
+
+SRC = '02:00:00:00:00:01'
+DST = '0a:1b:2c:3d:4e:5f'
+
+
+def build(*protocols):
+    pkt = packet.Packet()
+    for protocol in protocols:
+        pkt.add_protocol(protocol)
+    pkt.serialize()
+    return bytes(pkt.data)
+
+
+FRAMES = {
+    'untagged': lambda: build(ethernet.ethernet(DST, SRC, ether_types.ETH_TYPE_IP),
+                              ipv4.ipv4(src='10.0.0.1', dst='10.0.0.2')),
+    'tagged': lambda: build(ethernet.ethernet(DST, SRC, ether_types.ETH_TYPE_8021Q),
+                            vlan.vlan(pcp=5, vid=20, ethertype=ether_types.ETH_TYPE_IP),
+                            ipv4.ipv4(src='10.0.0.1', dst='10.0.0.2')),
+    'qinq': lambda: build(ethernet.ethernet(DST, SRC, ether_types.ETH_TYPE_8021AD),
+                          vlan.svlan(pcp=1, vid=4094, ethertype=ether_types.ETH_TYPE_8021Q),
+                          vlan.vlan(vid=30, ethertype=ether_types.ETH_TYPE_IP),
+                          ipv4.ipv4(src='10.0.0.1', dst='10.0.0.2')),
+    'arp_broadcast': lambda: build(ethernet.ethernet('ff:ff:ff:ff:ff:ff', SRC, ether_types.ETH_TYPE_ARP),
+                                   arp.arp_ip(arp.ARP_REQUEST, SRC, '10.0.0.1', '00:00:00:00:00:00',
+                                              '10.0.0.2')),
+}
+
+
+@pytest.mark.parametrize('name', sorted(FRAMES))
+def test_decode_like_ryu(name):
+    data = FRAMES[name]()
+    eth = eth_header.decode(data)
+    pkt = packet.Packet(data)
+    expected = pkt.get_protocol(ethernet.ethernet)
+
+    assert eth.dst_str == expected.dst
+    assert eth.src_str == expected.src
+    assert eth.dst == eth_header.mac_to_int(expected.dst)
+    assert eth.src == eth_header.mac_to_int(expected.src)
+    assert eth.ethertype == expected.ethertype
+    assert eth.is_multicast == (name == 'arp_broadcast')
+
+    tag = pkt.get_protocol(vlan.svlan) or pkt.get_protocol(vlan.vlan)
+    if tag is None:
+        assert not eth.tagged
+        assert eth.vid is None
+        assert eth.payload_type == expected.ethertype
+        assert eth.payload_offset == eth_header.ETH_HEADER_LEN
+    else:
+        assert eth.tagged
+        assert (eth.vid, eth.pcp, eth.payload_type) == (tag.vid, tag.pcp, tag.ethertype)
+        assert eth.payload_offset == eth_header.ETH_HEADER_LEN + eth_header.VLAN_TAG_LEN
+    assert bytes(eth.payload) == data[eth.payload_offset:]
+    #the full parser is there for the deeper headers, and parses only once
+    assert eth.packet().get_protocol(ethernet.ethernet).dst == expected.dst
+    assert eth.packet() is eth.packet()
+
+
+def test_decode_buffers():
+    data = FRAMES['tagged']()
+    for buf in (bytearray(data), memoryview(data)):
+        assert eth_header.decode(buf).vid == 20
+
+
+def test_decode_truncated():
+    untagged = FRAMES['untagged']()
+    tagged = FRAMES['tagged']()
+    assert eth_header.decode(b'') is None
+    assert eth_header.decode(untagged[:13]) is None
+    assert eth_header.decode(untagged[:14]).payload_type == ether_types.ETH_TYPE_IP
+    #a tag announced but cut off
+    assert eth_header.decode(tagged[:17]) is None
+    assert eth_header.decode(tagged[:18]).vid == 20
+
+
+def test_mac_conversion():
+    for mac in ('00:00:00:00:00:00', '00:00:00:00:00:01', DST, 'ff:ff:ff:ff:ff:ff'):
+        assert eth_header.mac_to_str(eth_header.mac_to_int(mac)) == mac
+    assert eth_header.mac_to_int('ff:ff:ff:ff:ff:ff') == eth_header.BROADCAST_MAC
+    assert eth_header.mac_to_int('01:00:00:00:00:00') == eth_header.MULTICAST_BIT
@@ -0,0 +1,151 @@
+#Tests of flow_inventory.py: learned flows get their timeouts and are
+#tracked until they are removed, and a filling table gets the flows that went
+#the longest without a hit evicted.
+
+import logging
+import struct
+
+import pytest
+
+pytest.importorskip('ryu')
+
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+import flow_inventory
+import msg_batcher
+
+
+ofproto = ofproto_v1_3
+parser = ofproto_v1_3_parser
+
+
+class Clock(object):
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def inventory():
+    removed = []
+    inventory = flow_inventory.FlowInventory(msg_batcher.MessageBatcher(), logging.getLogger('test'),
+                                             capacity=10, clock=Clock(),
+                                             on_removed=lambda datapath, table_id, fields:
+                                             removed.append((table_id, dict(fields))))
+    inventory.removed = removed
+    return inventory
+
+
+def mac(i):
+    return '02:00:00:00:00:%02x' % i
+
+
+def learned(datapath, i, table_id=0):
+    return parser.OFPFlowMod(datapath=datapath, table_id=table_id, priority=1,
+                             match=parser.OFPMatch(in_port=1, eth_dst=mac(i)))
+
+
+def flow_stats(mod, packet_count):
+    return parser.OFPFlowStats(table_id=mod.table_id, priority=mod.priority, cookie=0, idle_timeout=0,
+                               hard_timeout=0, flags=0, duration_sec=1, duration_nsec=0,
+                               packet_count=packet_count, byte_count=0, match=mod.match, instructions=[])
+
+
+def stats_xids(datapath):
+    #xids of the flow stats requests sent to datapath
+    return [xid for msg_type, xid, buf in datapath.take()
+            if msg_type == ofproto.OFPT_MULTIPART_REQUEST and struct.unpack_from('!H', buf, 8)[0] == ofproto.OFPMP_FLOW]
+
+
+def test_track(inventory, datapath):
+    mod = learned(datapath, 1)
+    inventory.track(datapath, mod)
+    assert (mod.idle_timeout, mod.hard_timeout) == (flow_inventory.IDLE_TIMEOUT, flow_inventory.HARD_TIMEOUT)
+    assert mod.flags & ofproto.OFPFF_SEND_FLOW_REM
+    inventory.record(datapath, 1, 1, [('eth_dst', mac(2)), ('in_port', 1)])
+    assert sorted(inventory.tables[datapath.id]) == [0, 1]
+    assert inventory.stats()[datapath.id]['installed'] == 2
+
+    msg = parser.OFPFlowRemoved(datapath, priority=1, reason=ofproto.OFPRR_IDLE_TIMEOUT, table_id=0,
+                                match=mod.match)
+    inventory.flow_removed(msg)
+    #counted once, it is not in the inventory any more
+    inventory.flow_removed(msg)
+    assert inventory.stats()[datapath.id]['idle_timeout'] == 1
+    assert inventory.tables[datapath.id][0] == {}
+    assert inventory.removed == [(0, {'in_port': 1, 'eth_dst': mac(1)})]
+
+
+def test_evict(inventory, datapath):
+    mods = [learned(datapath, i) for i in range(9)]
+    for mod in mods[:8]:
+        inventory.clock.now += 1
+        inventory.track(datapath, mod)
+    assert stats_xids(datapath) == []
+
+    #90% full: the flow stats of the table are requested, once
+    inventory.track(datapath, mods[8])
+    inventory.batcher.flush_all()
+    xids = stats_xids(datapath)
+    assert len(xids) == 1
+    inventory.track(datapath, learned(datapath, 8))
+    inventory.batcher.flush_all()
+    assert stats_xids(datapath) == []
+    assert len(inventory.tables[datapath.id][0]) == 9
+
+    #the oldest flows but 0 and 2 were hit since they were installed
+    inventory.clock.now += 100
+    reply = parser.OFPFlowStatsReply(datapath, flags=0,
+                                     body=[flow_stats(mod, 0 if i in (0, 2) else 5) for i, mod in enumerate(mods)])
+    reply.xid = xids[0]
+    assert inventory.flow_stats_reply(reply)
+    inventory.batcher.flush_all()
+    deleted = [parser.OFPFlowMod.parser(datapath, ofproto.OFP_VERSION, msg_type, len(buf), xid, buf)
+               for msg_type, xid, buf in datapath.take()]
+    assert [(mod.command, mod.match['eth_dst']) for mod in deleted] == [(ofproto.OFPFC_DELETE_STRICT, mac(0))]
+    assert inventory.removed == [(0, {'in_port': 1, 'eth_dst': mac(0)})]
+    assert len(inventory.tables[datapath.id][0]) == 8
+    assert inventory.stats()[datapath.id]['evicted'] == 1
+    #answered
+    assert not inventory.flow_stats_reply(reply)
+
+
+def test_evict_recorded(inventory, datapath):
+    #flows sent from a template have no match object, it is built from their fields
+    for i in range(9):
+        inventory.clock.now += 1
+        inventory.record(datapath, 0, 1, [('in_port', 1), ('eth_dst', mac(i))])
+    inventory.batcher.flush_all()
+    xid = stats_xids(datapath)[0]
+    reply = parser.OFPFlowStatsReply(datapath, flags=0, body=[])
+    reply.xid = xid
+    assert inventory.flow_stats_reply(reply)
+    inventory.batcher.flush_all()
+    deleted = [parser.OFPFlowMod.parser(datapath, ofproto.OFP_VERSION, msg_type, len(buf), xid, buf)
+               for msg_type, xid, buf in datapath.take()]
+    assert [sorted(mod.match.items()) for mod in deleted] == [[('eth_dst', mac(0)), ('in_port', 1)]]
+
+
+def test_snapshot_restore(inventory, datapath):
+    mod = learned(datapath, 1)
+    inventory.track(datapath, mod)
+    inventory.clock.now += 30
+    snapshot = inventory.snapshot()
+    assert snapshot == {datapath.id: [(0, 1, (('eth_dst', mac(1)), ('in_port', 1)), 0, 30)]}
+
+    restored = flow_inventory.FlowInventory(inventory.batcher, logging.getLogger('test'), clock=inventory.clock)
+    restored.restore_history(datapath.id, snapshot[datapath.id])
+    #not hit since the snapshot: it keeps its last hit
+    restored.restore(datapath, flow_stats(mod, 0))
+    flow = restored.tables[datapath.id][0][flow_inventory.flow_key(0, 1, mod.match)]
+    assert flow.last_hit == inventory.clock.now - 30
+    #a flow that was hit since counts as hit now
+    restored.restore_history(datapath.id, snapshot[datapath.id])
+    restored.restore(datapath, flow_stats(mod, 3))
+    flow = restored.tables[datapath.id][0][flow_inventory.flow_key(0, 1, mod.match)]
+    assert (flow.last_hit, flow.packet_count) == (inventory.clock.now, 3)
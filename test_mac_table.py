@@ -0,0 +1,216 @@
+#Tests of the mac tables of mac_table.py. Every test runs against both
+#backends, and CompactMacTable has to give the same answers as MacTable for
+#any sequence of operations.
+
+import random
+
+import pytest
+
+pytest.importorskip('ryu')
+
+import eth_header
+import mac_table
+
+
+class Clock(object):
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(params=sorted(mac_table.BACKENDS))
+def make_table(request):
+    clock = Clock()
+    changes = []
+
+    def make(capacity=mac_table.DEFAULT_CAPACITY, aging_time=mac_table.DEFAULT_AGING_TIME):
+        return mac_table.BACKENDS[request.param](capacity, aging_time, clock, changes.append)
+    make.clock = clock
+    make.changes = changes
+    return make
+
+
+def test_learn(make_table):
+    table = make_table()
+    assert table.learn('02:00:00:00:00:01', 1) is None
+    assert table.learn('02:00:00:00:00:02', 2) is None
+    assert table.get('02:00:00:00:00:01') == 1
+    assert table.get('02:00:00:00:00:02') == 2
+    assert table.get('02:00:00:00:00:03') is None
+    assert '02:00:00:00:00:01' in table
+    assert '02:00:00:00:00:03' not in table
+    assert len(table) == 2
+    #seen again on the same port: not a change
+    assert table.learn('02:00:00:00:00:01', 1) == 1
+    assert make_table.changes == ['02:00:00:00:00:01', '02:00:00:00:00:02']
+    assert table.stats()['moves'] == 0
+
+
+def test_move(make_table):
+    table = make_table()
+    table.learn('02:00:00:00:00:01', 1)
+    assert table.learn('02:00:00:00:00:01', 3) == 1
+    assert table.get('02:00:00:00:00:01') == 3
+    assert table.items() == [('02:00:00:00:00:01', 3)]
+    assert make_table.changes == ['02:00:00:00:00:01', '02:00:00:00:00:01']
+    assert table.stats()['moves'] == 1
+
+
+def test_get_ages(make_table):
+    table = make_table(aging_time=10)
+    table.learn('02:00:00:00:00:01', 1)
+    make_table.clock.now += 10
+    assert table.get('02:00:00:00:00:01') == 1
+    make_table.clock.now += 0.5
+    assert table.items() == []
+    assert table.get('02:00:00:00:00:01') is None
+    assert len(table) == 0
+    assert table.stats()['aged'] == 1
+    assert make_table.changes == ['02:00:00:00:00:01', '02:00:00:00:00:01']
+    #an aged mac is learned as new, on any port
+    assert table.learn('02:00:00:00:00:01', 2) is None
+    assert table.stats()['moves'] == 0
+
+
+def test_learn_ages_oldest(make_table):
+    table = make_table(aging_time=10)
+    table.learn('02:00:00:00:00:01', 1)
+    make_table.clock.now += 6
+    table.learn('02:00:00:00:00:02', 2)
+    make_table.clock.now += 6
+    table.learn('02:00:00:00:00:03', 3)
+    assert len(table) == 2
+    assert table.items() == [('02:00:00:00:00:02', 2), ('02:00:00:00:00:03', 3)]
+
+
+def test_evict(make_table):
+    table = make_table()
+    table.learn('02:00:00:00:00:01', 1)
+    assert table.evict('02:00:00:00:00:01') == 1
+    assert table.evict('02:00:00:00:00:01') is None
+    assert table.get('02:00:00:00:00:01') is None
+    assert make_table.changes == ['02:00:00:00:00:01', '02:00:00:00:00:01']
+
+
+def test_evict_port(make_table):
+    table = make_table()
+    for i, port in enumerate((1, 2, 1, 3, 1)):
+        table.learn('02:00:00:00:00:%02x' % i, port)
+    del make_table.changes[:]
+    assert sorted(table.evict_port(1)) == ['02:00:00:00:00:00', '02:00:00:00:00:02', '02:00:00:00:00:04']
+    assert sorted(make_table.changes) == ['02:00:00:00:00:00', '02:00:00:00:00:02', '02:00:00:00:00:04']
+    assert table.items() == [('02:00:00:00:00:01', 2), ('02:00:00:00:00:03', 3)]
+    assert table.evict_port(1) == []
+
+
+def test_capacity(make_table):
+    table = make_table(capacity=3)
+    for i in range(3):
+        table.learn('02:00:00:00:00:%02x' % i, 1)
+    #seen again, so no longer the least recently seen
+    table.learn('02:00:00:00:00:00', 1)
+    del make_table.changes[:]
+    table.learn('02:00:00:00:00:03', 2)
+    assert len(table) == 3
+    assert table.get('02:00:00:00:00:01') is None
+    assert [mac for mac, port in table.items()] == ['02:00:00:00:00:02', '02:00:00:00:00:00', '02:00:00:00:00:03']
+    assert make_table.changes == ['02:00:00:00:00:03', '02:00:00:00:00:01']
+    assert table.stats() == {'size': 3, 'capacity': 3, 'evictions': 1, 'moves': 0, 'aged': 0}
+
+
+def test_snapshot_restore(make_table):
+    table = make_table(capacity=3, aging_time=100)
+    table.learn('02:00:00:00:00:01', 1)
+    make_table.clock.now += 10
+    table.learn('02:00:00:00:00:02', 2)
+    make_table.clock.now += 10
+    table.learn('02:00:00:00:00:03', 3)
+    make_table.clock.now += 5
+    snapshot = table.snapshot()
+    assert snapshot == [('02:00:00:00:00:01', 1, 25), ('02:00:00:00:00:02', 2, 15), ('02:00:00:00:00:03', 3, 5)]
+
+    restored = make_table(capacity=2, aging_time=100)
+    restored.learn('02:00:00:00:00:03', 4)
+    del make_table.changes[:]
+    #too old, already known since and over the capacity: only the newest that fit come back
+    restored.restore(snapshot + [('02:00:00:00:00:04', 4, 101)])
+    assert restored.items() == [('02:00:00:00:00:02', 2), ('02:00:00:00:00:03', 4)]
+    assert make_table.changes == ['02:00:00:00:00:02']
+    assert restored.snapshot() == [('02:00:00:00:00:02', 2, 15), ('02:00:00:00:00:03', 4, 0)]
+    #they keep aging from where they were
+    make_table.clock.now += 86
+    assert restored.get('02:00:00:00:00:02') is None
+    assert restored.get('02:00:00:00:00:03') == 4
+
+
+def test_mac_tables():
+    changes = []
+    clock = Clock()
+    with pytest.raises(ValueError):
+        mac_table.MacTables(backend='list')
+    for backend in sorted(mac_table.BACKENDS):
+        tables = mac_table.MacTables(capacity=2, aging_time=10, clock=clock,
+                                     on_change=lambda dpid, mac: changes.append((dpid, mac)), backend=backend)
+        assert isinstance(tables.table(1), mac_table.BACKENDS[backend])
+        assert tables.get(2, '02:00:00:00:00:01') is None
+        assert tables.evict(2, '02:00:00:00:00:01') is None
+        assert tables.evict_port(2, 1) == []
+        assert tables.items(2) == []
+        del changes[:]
+        tables.learn(1, '02:00:00:00:00:01', 1)
+        tables.learn(2, '02:00:00:00:00:01', 2)
+        assert tables.get(1, '02:00:00:00:00:01') == 1
+        assert tables.get(2, '02:00:00:00:00:01') == 2
+        assert changes == [(1, '02:00:00:00:00:01'), (2, '02:00:00:00:00:01')]
+        assert tables.snapshot() == {1: [('02:00:00:00:00:01', 1, 0)], 2: [('02:00:00:00:00:01', 2, 0)]}
+        tables.restore(3, [('02:00:00:00:00:02', 5, 1)])
+        assert tables.items(3) == [('02:00:00:00:00:02', 5)]
+        assert tables.stats()[3]['size'] == 1
+
+
+OPERATIONS = ('learn', 'get', 'evict', 'evict_port', 'items', 'contains', 'snapshot', 'restore', 'tick')
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_compact_like_dict(seed):
+    rnd = random.Random(seed)
+    clock = Clock()
+    capacity = rnd.choice([1, 2, 5, 20])
+    aging_time = rnd.choice([1, 5, 50])
+    dict_changes = []
+    compact_changes = []
+    tables = (mac_table.MacTable(capacity, aging_time, clock, dict_changes.append),
+              mac_table.CompactMacTable(capacity, aging_time, clock, compact_changes.append))
+    macs = [eth_header.mac_to_str(rnd.getrandbits(48)) for i in range(30)]
+
+    for step in range(400):
+        operation = rnd.choice(OPERATIONS)
+        mac = rnd.choice(macs)
+        port = rnd.randint(1, 4)
+        if operation == 'tick':
+            clock.now += rnd.random() * aging_time
+            continue
+        if operation == 'restore':
+            #a snapshot has every mac once
+            entries = [(restored, rnd.randint(1, 4), rnd.random() * aging_time * 1.2)
+                       for restored in rnd.sample(macs, 5)]
+            for table in tables:
+                table.restore(entries)
+            results = (None, None)
+        elif operation == 'contains':
+            results = [mac in table for table in tables]
+        elif operation in ('learn', 'evict_port'):
+            results = [getattr(table, operation)(*((mac, port) if operation == 'learn' else (port,)))
+                       for table in tables]
+        elif operation in ('items', 'snapshot'):
+            results = [getattr(table, operation)() for table in tables]
+        else:
+            results = [getattr(table, operation)(mac) for table in tables]
+        assert results[0] == results[1], (step, operation)
+        assert dict_changes == compact_changes, (step, operation)
+        assert tables[0].stats() == tables[1].stats(), (step, operation)
+        assert len(tables[0]) == len(tables[1])
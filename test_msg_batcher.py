@@ -0,0 +1,111 @@
+#Tests of msg_batcher.py: messages queued per datapath go out as one write,
+#in order, and barrier replies are matched to their requests.
+
+import pytest
+
+pytest.importorskip('ryu')
+
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+import msg_batcher
+
+
+ofproto = ofproto_v1_3
+parser = ofproto_v1_3_parser
+
+
+class CountingDatapath(object):
+    """Wraps a Datapath to count the writes."""
+
+    def __init__(self, datapath):
+        self.datapath = datapath
+        self.writes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.datapath, name)
+
+    def send(self, buf, close_socket=False):
+        self.writes += 1
+        return self.datapath.send(buf)
+
+
+def echo(datapath, data):
+    return parser.OFPEchoRequest(datapath, data=data)
+
+
+def test_batching(datapath):
+    batcher = msg_batcher.MessageBatcher()
+    counting = CountingDatapath(datapath)
+    xids = [batcher.send_msg(counting, echo(counting, b'%d' % i)) for i in range(3)]
+    #nothing is written before the flush
+    assert counting.writes == 0
+    assert xids == [1, 2, 3]
+    batcher.flush_all()
+    assert counting.writes == 1
+    assert [(msg_type, xid, bytes(buf[8:])) for msg_type, xid, buf in datapath.take()] == \
+        [(ofproto.OFPT_ECHO_REQUEST, xid, b'%d' % i) for i, xid in enumerate(xids)]
+    assert batcher.counts == {datapath.id: {ofproto.OFPT_ECHO_REQUEST: 3}}
+    #nothing left
+    batcher.flush_all()
+    assert counting.writes == 1
+
+
+def test_max_bytes(datapath):
+    batcher = msg_batcher.MessageBatcher(max_bytes=100)
+    counting = CountingDatapath(datapath)
+    batcher.send_msg(counting, echo(counting, b'x' * 50))
+    assert counting.writes == 0
+    batcher.send_msg(counting, echo(counting, b'x' * 50))
+    assert counting.writes == 1
+    assert len(datapath.take()) == 2
+
+
+def test_send_raw(datapath):
+    batcher = msg_batcher.MessageBatcher()
+    batcher.send_msg(datapath, echo(datapath, b'a'))
+    msg = echo(datapath, b'b')
+    msg.set_xid(0)
+    msg.serialize()
+    buf = bytearray(msg.buf)
+    assert batcher.send_raw(datapath, buf, ofproto.OFPT_ECHO_REQUEST) == 2
+    batcher.flush_all()
+    assert [(xid, bytes(buf[8:])) for msg_type, xid, buf in datapath.take()] == [(1, b'a'), (2, b'b')]
+
+
+def test_hold(datapath):
+    batcher = msg_batcher.MessageBatcher()
+    batcher.hold(datapath)
+    first = echo(datapath, b'a')
+    #the xid is assigned while held
+    assert batcher.send_msg(datapath, first) == 1
+    batcher.barrier(datapath)
+    batcher.flush_all()
+    assert datapath.take() == []
+    held = batcher.take_held(datapath)
+    assert held[0] is first
+    assert isinstance(held[1], parser.OFPBarrierRequest)
+    assert batcher.take_held(datapath) == []
+
+    batcher.send_msg(datapath, echo(datapath, b'b'))
+    batcher.flush_all()
+    assert len(datapath.take()) == 1
+
+
+def test_barrier(datapath):
+    batcher = msg_batcher.MessageBatcher()
+    batcher.send_msg(datapath, echo(datapath, b'a'))
+    xid = batcher.barrier(datapath)
+    batcher.flush_all()
+    assert [(msg_type, sent_xid) for msg_type, sent_xid, buf in datapath.take()] == \
+        [(ofproto.OFPT_ECHO_REQUEST, 1), (ofproto.OFPT_BARRIER_REQUEST, xid)]
+    assert batcher.barriers == {datapath.id: set([xid])}
+
+    reply = parser.OFPBarrierReply(datapath)
+    reply.xid = xid + 1
+    assert not batcher.barrier_reply(reply)
+    reply.xid = xid
+    assert batcher.barrier_reply(reply)
+    assert batcher.barriers == {datapath.id: set()}
+    #answered already
+    assert not batcher.barrier_reply(reply)
@@ -0,0 +1,225 @@
+#Tests of the pre-serialized messages of msg_template.py: a message rendered
+#from a template has to be byte for byte the one the parser serializes, both
+#for the templates on their own and on the PacketIn path of VLAN.py.
+
+import struct
+
+import pytest
+
+pytest.importorskip('ryu')
+
+from ryu.controller import ofp_event
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+import flow_inventory
+import msg_template
+
+
+ofproto = ofproto_v1_3
+parser = ofproto_v1_3_parser
+
+BUFFERED = 7
+NO_BUFFER = ofproto.OFP_NO_BUFFER
+
+
+def wire(msg):
+    """msg serialized, without its xid."""
+    msg.set_xid(0)
+    msg.serialize()
+    return without_xid(msg.buf)
+
+
+def without_xid(buf):
+    return bytes(buf[:4]) + b'\x00' * 4 + bytes(buf[8:])
+
+
+def flow_mod(datapath, match, actions, buffer_id=NO_BUFFER):
+    #a learned flow, as VlanSwitch13 sends it
+    inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
+    return parser.OFPFlowMod(datapath=datapath, priority=1, match=match, instructions=inst,
+                             buffer_id=buffer_id, idle_timeout=flow_inventory.IDLE_TIMEOUT,
+                             hard_timeout=flow_inventory.HARD_TIMEOUT,
+                             flags=ofproto.OFPFF_SEND_FLOW_REM)
+
+
+def frame(src, dst, vid=None):
+    data = bytes.fromhex(dst.replace(':', '') + src.replace(':', ''))
+    if vid is not None:
+        data += struct.pack('!HH', 0x8100, vid)
+    return data + struct.pack('!H', 0x0800) + b'\x00' * 46
+
+
+#(match fields besides in_port and eth_dst, actions) of every unicast shape of VLAN.py
+FLOW_SHAPES = {
+    'untagged_access': ({}, lambda: [parser.OFPActionOutput(2)]),
+    'tagged_access': ({'vlan_vid': 0x1000 | 20},
+                      lambda: [parser.OFPActionPopVlan(), parser.OFPActionOutput(1)]),
+    'tagged_trunk': ({'vlan_vid': 0x1000 | 20}, lambda: [parser.OFPActionOutput(7)]),
+    'untagged_trunk': ({}, lambda: [parser.OFPActionPushVlan(0x8100),
+                                    parser.OFPActionSetField(vlan_vid=20),
+                                    parser.OFPActionOutput(4)]),
+}
+
+
+@pytest.mark.parametrize('shape', sorted(FLOW_SHAPES))
+@pytest.mark.parametrize('buffer_id', [NO_BUFFER, BUFFERED, 0])
+def test_flow_mod_template(datapath, shape, buffer_id):
+    fields, actions = FLOW_SHAPES[shape]
+    sample = flow_mod(datapath, parser.OFPMatch(in_port=1, eth_dst='02:00:00:00:00:01', **fields), actions())
+    template = msg_template.FlowModTemplate(sample, ('in_port', 'eth_dst'))
+
+    for in_port, dst in ((1, '02:00:00:00:00:01'), (3, '02:00:00:00:ab:cd'), (0xfffffff0, 'ff:ff:ff:ff:ff:fe')):
+        buf = template.render(buffer_id, template.values(in_port=in_port, eth_dst=dst))
+        expected = flow_mod(datapath, parser.OFPMatch(in_port=in_port, eth_dst=dst, **fields), actions(), buffer_id)
+        assert without_xid(buf) == wire(expected)
+
+
+def test_flow_mod_template_masked_field(datapath):
+    match = parser.OFPMatch(in_port=1, eth_dst=('01:00:00:00:00:00', '01:00:00:00:00:00'))
+    with pytest.raises(ValueError):
+        msg_template.FlowModTemplate(flow_mod(datapath, match, []), ('eth_dst',))
+
+
+PACKET_OUT_SHAPES = {
+    'output': lambda: [parser.OFPActionOutput(2)],
+    'trunk': lambda: [parser.OFPActionPushVlan(0x8100), parser.OFPActionSetField(vlan_vid=20),
+                      parser.OFPActionOutput(4)],
+    'flood': lambda: [parser.OFPActionOutput(2), parser.OFPActionOutput(3),
+                      parser.OFPActionPushVlan(0x8100), parser.OFPActionSetField(vlan_vid=20),
+                      parser.OFPActionOutput(4)],
+    'group_flood': lambda: [parser.OFPActionGroup(group_id=41)],
+    'drop': lambda: [],
+}
+
+
+#a frame without actions is only released by its buffer id, never sent back (see packet_in_guard.packet_out())
+PACKET_OUT_CASES = [(shape, buffer_id) for shape in sorted(PACKET_OUT_SHAPES) for buffer_id in (NO_BUFFER, BUFFERED)
+                    if shape != 'drop' or buffer_id != NO_BUFFER]
+
+
+@pytest.mark.parametrize('shape,buffer_id', PACKET_OUT_CASES)
+def test_packet_out_template(datapath, shape, buffer_id):
+    actions = PACKET_OUT_SHAPES[shape]
+    sample = parser.OFPPacketOut(datapath=datapath, buffer_id=NO_BUFFER, in_port=ofproto.OFPP_CONTROLLER,
+                                 actions=actions())
+    template = msg_template.PacketOutTemplate(sample)
+    assert template.actions == bool(actions())
+
+    data = None
+    if buffer_id == NO_BUFFER:
+        data = frame('02:00:00:00:00:01', '02:00:00:00:00:02')
+    buf = template.render(buffer_id, 5, data)
+    expected = parser.OFPPacketOut(datapath=datapath, buffer_id=buffer_id, in_port=5, actions=actions(),
+                                   data=data)
+    assert without_xid(buf) == wire(expected)
+
+
+def test_message_templates():
+    templates = msg_template.MessageTemplates()
+    assert templates.get(1, 'shape') is None
+    template = object()
+    assert templates.put(1, 'shape', template) is template
+    assert templates.get(1, 'shape') is template
+    templates.put(2, 'shape', object())
+    assert templates.stats() == {1: 1, 2: 1}
+    templates.forget(1)
+    assert templates.get(1, 'shape') is None
+    templates.clear()
+    assert templates.stats() == {}
+
+
+#hosts of the VLAN.py test switch: port 1 and 2 are access ports of vlan 20, 3 of vlan 30, 4 and 7 are
+#trunks of both and 5 and 6 native ports
+PORT_VLAN = {1: {1: [20], 2: [20], 3: [30], 4: [20, 30], 5: [" "], 6: [" "], 7: [20, 30]}}
+ACCESS = {1: [1, 2, 3, 5, 6]}
+TRUNK = {1: [4, 7]}
+
+HOSTS = {
+    'a': (1, None, '02:00:00:00:01:01'),
+    'b': (2, None, '02:00:00:00:02:01'),
+    't': (4, 20, '02:00:00:00:04:01'),
+    'u': (7, 20, '02:00:00:00:07:01'),
+    'n1': (5, None, '02:00:00:00:05:01'),
+    'n2': (6, None, '02:00:00:00:06:01'),
+}
+UNKNOWN = '02:00:00:00:ff:01'
+
+#(source host, destination host, match fields besides in_port and eth_dst, actions) of the learned flows
+UNICAST = {
+    'untagged_access': ('a', 'b', {}, lambda: [parser.OFPActionOutput(2)]),
+    'untagged_trunk': ('a', 't', {}, lambda: [parser.OFPActionPushVlan(0x8100),
+                                              parser.OFPActionSetField(vlan_vid=20),
+                                              parser.OFPActionOutput(4)]),
+    'tagged_access': ('t', 'a', {'vlan_vid': 0x1000 | 20},
+                      lambda: [parser.OFPActionPopVlan(), parser.OFPActionOutput(1)]),
+    'tagged_trunk': ('t', 'u', {'vlan_vid': 0x1000 | 20}, lambda: [parser.OFPActionOutput(7)]),
+    'native': ('n1', 'n2', {}, lambda: [parser.OFPActionOutput(6)]),
+}
+
+#source host and (vlan, tagged) of the flood plan of frames to an unknown destination
+FLOOD = {
+    'access': ('a', 20, 0),
+    'tagged': ('t', 20, 1),
+    'native': ('n1', 'NULL', 0),
+}
+
+
+@pytest.fixture(params=[True, False], ids=['group_flooding', 'packet_out_flooding'])
+def vlan_switch(request, vlan_switch13, datapath):
+    app = vlan_switch13(PORT_VLAN, ACCESS, TRUNK, group_flooding=request.param)
+    features = parser.OFPSwitchFeatures(datapath, datapath_id=datapath.id)
+    app.switch_features_handler(ofp_event.EventOFPSwitchFeatures(features))
+    #every host is known on its port
+    for port, vid, mac in HOSTS.values():
+        app.mac_to_port.learn(datapath.id, mac, port)
+    app.batcher.flush_all()
+    del datapath.sent[:]
+    return app, datapath
+
+
+def packet_in(app, datapath, in_port, data, buffer_id):
+    msg = parser.OFPPacketIn(datapath, buffer_id=buffer_id, total_len=len(data), reason=ofproto.OFPR_NO_MATCH,
+                             table_id=0, cookie=0, match=parser.OFPMatch(in_port=in_port), data=data)
+    msg.msg_len = len(data) + ofproto.OFP_PACKET_IN_SIZE
+    app._packet_in_handler(ofp_event.EventOFPPacketIn(msg))
+    app.batcher.flush_all()
+    sent = [without_xid(buf) for buf in datapath.sent]
+    del datapath.sent[:]
+    return sent
+
+
+@pytest.mark.parametrize('shape', sorted(UNICAST))
+def test_vlan_switch_unicast(vlan_switch, shape):
+    app, datapath = vlan_switch
+    src, dst, fields, actions = UNICAST[shape]
+    in_port, vid, src_mac = HOSTS[src]
+    dst_mac = HOSTS[dst][2]
+    data = frame(src_mac, dst_mac, vid)
+    match = parser.OFPMatch(in_port=in_port, eth_dst=dst_mac, **fields)
+
+    #the second packet of each kind takes the cached decision and its templates
+    for buffer_id in (BUFFERED, NO_BUFFER, NO_BUFFER, BUFFERED):
+        expected = [wire(flow_mod(datapath, match, actions(), buffer_id))]
+        if buffer_id == NO_BUFFER:
+            expected.append(wire(parser.OFPPacketOut(datapath=datapath, buffer_id=NO_BUFFER, in_port=in_port,
+                                                     actions=actions(), data=data)))
+        assert packet_in(app, datapath, in_port, data, buffer_id) == expected
+
+    key = flow_inventory.flow_key(0, 1, match)
+    assert key in app.flow_inventory.tables[datapath.id][0]
+
+
+@pytest.mark.parametrize('shape', sorted(FLOOD))
+def test_vlan_switch_flood(vlan_switch, shape):
+    app, datapath = vlan_switch
+    src, src_vlan, tagged = FLOOD[shape]
+    in_port, vid, src_mac = HOSTS[src]
+    data = frame(src_mac, UNKNOWN, vid)
+    actions = app.flood_plans[(datapath.id, in_port, src_vlan, tagged)]
+    assert actions
+
+    for buffer_id in (BUFFERED, NO_BUFFER, NO_BUFFER, BUFFERED):
+        expected = parser.OFPPacketOut(datapath=datapath, buffer_id=buffer_id, in_port=in_port,
+                                       actions=list(actions), data=data if buffer_id == NO_BUFFER else None)
+        assert packet_in(app, datapath, in_port, data, buffer_id) == [wire(expected)]
@@ -0,0 +1,137 @@
+#Tests of packet_in_guard.py: the token bucket, deferring, dropping and
+#replaying PacketIns over the admission limit, and the PacketOuts that
+#release the frames the switch buffered.
+
+import logging
+import struct
+
+import pytest
+
+pytest.importorskip('ryu')
+
+from ryu.controller import ofp_event
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+import msg_batcher
+import packet_in_guard
+
+
+ofproto = ofproto_v1_3
+parser = ofproto_v1_3_parser
+
+BUFFERED = 7
+DATA = b'\x02\x00\x00\x00\x00\x02\x02\x00\x00\x00\x00\x01\x08\x00' + b'\x00' * 46
+
+
+class Clock(object):
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def packet_in(datapath, buffer_id=ofproto.OFP_NO_BUFFER, data=DATA, total_len=None):
+    msg = parser.OFPPacketIn(datapath, buffer_id=buffer_id, total_len=total_len or len(data),
+                             reason=ofproto.OFPR_NO_MATCH, table_id=0, cookie=0,
+                             match=parser.OFPMatch(in_port=3), data=data)
+    return ofp_event.EventOFPPacketIn(msg)
+
+
+@pytest.fixture
+def guard(monkeypatch, datapath):
+    #the replay thread (and the flush of the batcher) is run by hand
+    spawned = []
+    monkeypatch.setattr(hub, 'spawn', lambda func, *args: spawned.append(func) or func)
+    monkeypatch.setattr(packet_in_guard, 'REPLAY_INTERVAL', 0)
+    monkeypatch.setattr(packet_in_guard, 'limits', {
+        datapath.id: packet_in_guard.DEFAULT_LIMITS._replace(rate=10, burst=2, defer=2)})
+    handled = []
+    clock = Clock()
+    guard = packet_in_guard.PacketInGuard(handled.append, logging.getLogger('test'), clock,
+                                          msg_batcher.MessageBatcher())
+    guard.handled = handled
+    guard.spawned = spawned
+    return guard
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = packet_in_guard.TokenBucket(10, 2, clock)
+    assert bucket.consume()
+    assert bucket.consume()
+    assert not bucket.consume()
+    clock.now += 0.05
+    assert not bucket.consume()
+    clock.now += 0.06
+    assert bucket.consume()
+    #never more than the burst
+    clock.now += 10
+    assert [bucket.consume() for i in range(3)] == [True, True, False]
+
+
+def test_packet_out(datapath):
+    actions = [parser.OFPActionOutput(2)]
+    out = packet_in_guard.packet_out(packet_in(datapath).msg, 3, actions)
+    assert (out.buffer_id, out.in_port, out.data) == (ofproto.OFP_NO_BUFFER, 3, DATA)
+    #a buffered frame is released by its id, without sending it back
+    out = packet_in_guard.packet_out(packet_in(datapath, BUFFERED, DATA[:14], len(DATA)).msg, 3, actions)
+    assert (out.buffer_id, out.data) == (BUFFERED, None)
+    out = packet_in_guard.packet_out(packet_in(datapath, BUFFERED).msg, 3, [])
+    assert (out.buffer_id, out.actions) == (BUFFERED, [])
+    #nothing to send: dropped and not buffered, or truncated without a buffer
+    assert packet_in_guard.packet_out(packet_in(datapath).msg, 3, []) is None
+    assert packet_in_guard.packet_out(packet_in(datapath, data=DATA[:14], total_len=len(DATA)).msg, 3,
+                                      actions) is None
+
+
+def test_no_limit(datapath):
+    guard = packet_in_guard.PacketInGuard(None, logging.getLogger('test'))
+    assert all(guard.admit(packet_in(datapath)) for i in range(1000))
+    assert guard.stats() == {datapath.id: {'admitted': 1000, 'deferred': 0, 'dropped': 0, 'released': 0,
+                                           'queued': 0}}
+
+
+def test_defer_drop_replay(guard, datapath):
+    events = [packet_in(datapath, buffer_id) for buffer_id in
+              (ofproto.OFP_NO_BUFFER, ofproto.OFP_NO_BUFFER, 1, 2, BUFFERED, ofproto.OFP_NO_BUFFER)]
+    #the burst, two deferred, then dropped
+    assert [guard.admit(ev) for ev in events] == [True, True, False, False, False, False]
+    assert guard.stats() == {datapath.id: {'admitted': 2, 'deferred': 2, 'dropped': 2, 'released': 1,
+                                           'queued': 2}}
+    assert guard.spawned.count(guard._replay) == 1
+
+    #the buffered frame that was dropped is freed on the switch
+    guard.batcher.flush_all()
+    sent = datapath.take()
+    assert len(sent) == 1
+    msg_type, xid, buf = sent[0]
+    #buffer id, in_port and no actions
+    assert msg_type == ofproto.OFPT_PACKET_OUT
+    assert struct.unpack_from('!IIH', buf, 8) == (BUFFERED, 3, 0)
+
+    #while events wait, new ones queue up behind them even with tokens
+    guard.clock.now += 1
+    assert not guard.admit(packet_in(datapath))
+    assert guard.stats()[datapath.id]['dropped'] == 3
+
+    #the deferred events are handed to the handler in order once tokens are there
+    guard._replay()
+    assert guard.handled == events[2:4]
+    assert guard.stats()[datapath.id]['queued'] == 0
+    assert guard.stats()[datapath.id]['admitted'] == 4
+    assert guard._replay_thread is None
+
+
+def test_replayed_event_is_admitted(guard, datapath):
+    #the handler calls admit() again for the event being replayed
+    guard.handler = lambda ev: guard.handled.append(guard.admit(ev))
+    for i in range(3):
+        guard.admit(packet_in(datapath))
+    guard.clock.now += 1
+    guard._replay()
+    assert guard.handled == [True]
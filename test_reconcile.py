@@ -0,0 +1,199 @@
+#Tests of reconcile.py: what a reconnecting switch is sent given the flows
+#and groups it already has.
+
+import logging
+import struct
+
+import pytest
+
+pytest.importorskip('ryu')
+
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+import flow_inventory
+import mac_table
+import msg_batcher
+import reconcile
+
+
+ofproto = ofproto_v1_3
+parser = ofproto_v1_3_parser
+
+HOST = '02:00:00:00:00:01'
+PEER = '02:00:00:00:00:02'
+
+
+@pytest.fixture
+def reconciler():
+    batcher = msg_batcher.MessageBatcher()
+    return reconcile.Reconciler(batcher, logging.getLogger('test'), mac_table.MacTables(),
+                                flow_inventory.FlowInventory(batcher, logging.getLogger('test')))
+
+
+def actions(*ports):
+    return [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, [parser.OFPActionOutput(port)
+                                                                       for port in ports])]
+
+
+def flow_add(datapath, priority, match, instructions, meter_id=None):
+    if meter_id is not None:
+        instructions = [parser.OFPInstructionMeter(meter_id)] + instructions
+    return parser.OFPFlowMod(datapath=datapath, priority=priority, match=match, instructions=instructions)
+
+
+def flow_stats(mod, cookie=reconcile.STATIC_COOKIE, packet_count=0):
+    return parser.OFPFlowStats(table_id=mod.table_id, priority=mod.priority, cookie=cookie, idle_timeout=0,
+                               hard_timeout=0, flags=0, duration_sec=1, duration_nsec=0,
+                               packet_count=packet_count, byte_count=0, match=mod.match,
+                               instructions=mod.instructions)
+
+
+def group_add(datapath, group_id, *ports):
+    buckets = [parser.OFPBucket(actions=[parser.OFPActionOutput(port)]) for port in ports]
+    return parser.OFPGroupMod(datapath, ofproto.OFPGC_ADD, ofproto.OFPGT_ALL, group_id, buckets)
+
+
+def group_stats(mod):
+    return parser.OFPGroupDescStats(mod.type, mod.group_id, mod.buckets)
+
+
+def start(reconciler, datapath, desired):
+    """Start reconciling, returns the xids of the flow and group dumps."""
+    reconciler.reconcile(datapath, desired)
+    reconciler.batcher.flush_all()
+    xids = {}
+    for msg_type, xid, buf in datapath.take():
+        assert msg_type == ofproto.OFPT_MULTIPART_REQUEST
+        xids[struct.unpack_from('!H', buf, 8)[0]] = xid
+    return xids.get(ofproto.OFPMP_FLOW), xids.get(ofproto.OFPMP_GROUP_DESC)
+
+
+def reply(reconciler, datapath, cls, xid, body, more=False):
+    msg = cls(datapath, body=body, flags=ofproto.OFPMPF_REPLY_MORE if more else 0)
+    msg.xid = xid
+    if cls is parser.OFPFlowStatsReply:
+        matched = reconciler.flow_stats_reply(msg)
+    else:
+        matched = reconciler.group_desc_reply(msg)
+    reconciler.batcher.flush_all()
+    return matched
+
+
+def sent(datapath):
+    """(type, command) of the flow and group mods sent, and the types of the rest."""
+    out = []
+    for msg_type, xid, buf in datapath.take():
+        if msg_type == ofproto.OFPT_FLOW_MOD:
+            out.append((msg_type, buf[25]))
+        elif msg_type == ofproto.OFPT_GROUP_MOD:
+            out.append((msg_type, struct.unpack_from('!H', buf, 8)[0]))
+        else:
+            out.append(msg_type)
+    return out
+
+
+def test_new_switch(reconciler, datapath):
+    miss = flow_add(datapath, 0, parser.OFPMatch(), actions(ofproto.OFPP_CONTROLLER))
+    desired = [miss, parser.OFPBarrierRequest(datapath)]
+    flow_xid, group_xid = start(reconciler, datapath, desired)
+    #no group mods, no group dump
+    assert group_xid is None
+    assert miss.cookie == reconcile.STATIC_COOKIE
+
+    assert reply(reconciler, datapath, parser.OFPFlowStatsReply, flow_xid, [])
+    assert sent(datapath) == [(ofproto.OFPT_FLOW_MOD, ofproto.OFPFC_ADD), ofproto.OFPT_BARRIER_REQUEST]
+    assert reconciler.dumps == {}
+    #answered already
+    assert not reply(reconciler, datapath, parser.OFPFlowStatsReply, flow_xid, [])
+
+
+def test_flows(reconciler, datapath):
+    same = flow_add(datapath, 0, parser.OFPMatch(), actions(ofproto.OFPP_CONTROLLER))
+    changed = flow_add(datapath, 10, parser.OFPMatch(eth_type=0x88cc), actions(ofproto.OFPP_CONTROLLER))
+    missing = flow_add(datapath, 10, parser.OFPMatch(eth_type=0x0806), actions(ofproto.OFPP_CONTROLLER))
+    unwanted = flow_add(datapath, 10, parser.OFPMatch(eth_type=0x86dd), actions(ofproto.OFPP_CONTROLLER))
+    flow_xid, group_xid = start(reconciler, datapath, [same, changed, missing])
+
+    installed = [flow_stats(same), flow_stats(flow_add(datapath, 10, changed.match, actions(3))),
+                 flow_stats(unwanted)]
+    #the dump comes in two parts
+    assert reply(reconciler, datapath, parser.OFPFlowStatsReply, flow_xid, installed[:1], more=True)
+    assert sent(datapath) == []
+    assert reply(reconciler, datapath, parser.OFPFlowStatsReply, flow_xid, installed[1:])
+    assert sent(datapath) == [(ofproto.OFPT_FLOW_MOD, ofproto.OFPFC_ADD), (ofproto.OFPT_FLOW_MOD, ofproto.OFPFC_ADD),
+                              (ofproto.OFPT_FLOW_MOD, ofproto.OFPFC_DELETE_STRICT)]
+
+
+def test_deleted_meter(reconciler, datapath):
+    #a meter that is deleted and added again takes its flows along
+    meter_del = parser.OFPMeterMod(datapath, ofproto.OFPMC_DELETE, meter_id=1)
+    meter_add = parser.OFPMeterMod(datapath, ofproto.OFPMC_ADD, ofproto.OFPMF_PKTPS, 1,
+                                   [parser.OFPMeterBandDrop(rate=100)])
+    miss = flow_add(datapath, 0, parser.OFPMatch(), actions(ofproto.OFPP_CONTROLLER), meter_id=1)
+    flow_xid, group_xid = start(reconciler, datapath, [meter_del, meter_add, miss])
+    assert reply(reconciler, datapath, parser.OFPFlowStatsReply, flow_xid, [flow_stats(miss)])
+    assert sent(datapath) == [ofproto.OFPT_METER_MOD, ofproto.OFPT_METER_MOD,
+                              (ofproto.OFPT_FLOW_MOD, ofproto.OFPFC_ADD)]
+
+
+def test_groups(reconciler, datapath):
+    same = group_add(datapath, 1, 1, 2)
+    changed = group_add(datapath, 2, 1, 2)
+    missing = group_add(datapath, 3, 1, 2)
+    flow_xid, group_xid = start(reconciler, datapath, [same, changed, missing])
+
+    assert reply(reconciler, datapath, parser.OFPFlowStatsReply, flow_xid, [])
+    #waits for the group dump
+    assert sent(datapath) == []
+    assert datapath.id in reconciler.dumps
+    installed = [group_stats(same), group_stats(group_add(datapath, 2, 1)), group_stats(group_add(datapath, 4, 3))]
+    assert reply(reconciler, datapath, parser.OFPGroupDescStatsReply, group_xid, installed)
+    assert sent(datapath) == [(ofproto.OFPT_GROUP_MOD, ofproto.OFPGC_MODIFY),
+                              (ofproto.OFPT_GROUP_MOD, ofproto.OFPGC_ADD),
+                              (ofproto.OFPT_GROUP_MOD, ofproto.OFPGC_DELETE)]
+    assert reconciler.dumps == {}
+
+
+def test_learned_flows(reconciler, datapath):
+    #flows learned before the disconnect are left alone, their hosts and the flows themselves are known again
+    miss = flow_add(datapath, 0, parser.OFPMatch(), actions(ofproto.OFPP_CONTROLLER))
+    unicast = flow_add(datapath, 1, parser.OFPMatch(in_port=1, eth_dst=PEER), actions(2))
+    source = flow_add(datapath, 1, parser.OFPMatch(in_port=1, eth_src=HOST), [])
+    flood = flow_add(datapath, 1, parser.OFPMatch(in_port=1, eth_dst='ff:ff:ff:ff:ff:ff'), actions(2, 3))
+    flow_xid, group_xid = start(reconciler, datapath, [miss])
+    learned = [flow_stats(mod, cookie=0, packet_count=5) for mod in (unicast, source, flood)]
+    assert reply(reconciler, datapath, parser.OFPFlowStatsReply, flow_xid, [flow_stats(miss)] + learned)
+
+    assert sent(datapath) == []
+    assert sorted(reconciler.mac_to_port.items(datapath.id)) == [(HOST, 1), (PEER, 2)]
+    table = reconciler.inventory.tables[datapath.id][0]
+    assert sorted(table) == sorted(flow_inventory.flow_key(0, 1, mod.match) for mod in (unicast, source, flood))
+    assert set(flow.packet_count for flow in table.values()) == set([5])
+
+
+def test_other_replies(reconciler, datapath):
+    flow_xid, group_xid = start(reconciler, datapath, [])
+    #not the dump, or not this switch
+    assert not reply(reconciler, datapath, parser.OFPFlowStatsReply, flow_xid + 1, [])
+    other = type(datapath)(2)
+    assert not reply(reconciler, other, parser.OFPFlowStatsReply, flow_xid, [])
+    assert not reply(reconciler, datapath, parser.OFPGroupDescStatsReply, flow_xid, [])
+    assert datapath.id in reconciler.dumps
+
+
+def test_timeout(reconciler, datapath):
+    miss = flow_add(datapath, 0, parser.OFPMatch(), actions(ofproto.OFPP_CONTROLLER))
+    start(reconciler, datapath, [miss])
+    dump = reconciler.dumps[datapath.id]
+    #a new connection replaced the dump
+    start(reconciler, datapath, [miss])
+    reconciler._timed_out(dump)
+    reconciler.batcher.flush_all()
+    assert sent(datapath) == []
+
+    #no answer: everything is installed as is
+    reconciler._timed_out(reconciler.dumps[datapath.id])
+    reconciler.batcher.flush_all()
+    assert sent(datapath) == [(ofproto.OFPT_FLOW_MOD, ofproto.OFPFC_ADD)]
+    assert reconciler.dumps == {}
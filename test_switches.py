@@ -0,0 +1,52 @@
+#Tests every switch app has to pass: PacketIns the apps do not forward still
+#free the frame the switch buffered for them.
+
+import struct
+
+import pytest
+
+pytest.importorskip('ryu')
+
+from ryu.controller import ofp_event
+from ryu.ofproto import ofproto_v1_3
+from ryu.ofproto import ofproto_v1_3_parser
+
+
+ofproto = ofproto_v1_3
+parser = ofproto_v1_3_parser
+
+BUFFERED = 7
+SRC = b'\x02\x00\x00\x00\x00\x01'
+#LLDP of some other device, not one of the probes of topology.py
+LLDP = b'\x01\x80\xc2\x00\x00\x0e' + SRC + b'\x88\xcc' + b'\x00' * 46
+
+
+@pytest.fixture(params=['VLAN', 'LearningSwitch', 'simple_switch_13', 'DumbSwitch'])
+def app(request, monkeypatch, vlan_switch13):
+    import metrics
+    monkeypatch.setattr(metrics, 'listen_port', 0)
+    if request.param == 'VLAN':
+        return vlan_switch13({1: {1: [20], 2: [20]}}, {1: [1, 2]}, {1: []})
+    if request.param == 'LearningSwitch':
+        import LearningSwitch
+        return LearningSwitch.VLANSwitch()
+    module = __import__(request.param)
+    return module.SimpleSwitch13()
+
+
+def packet_in(app, datapath, data, buffer_id, total_len=None):
+    msg = parser.OFPPacketIn(datapath, buffer_id=buffer_id, total_len=total_len or len(data),
+                             reason=ofproto.OFPR_NO_MATCH, table_id=0, cookie=0,
+                             match=parser.OFPMatch(in_port=1), data=data)
+    outcome = app.handle_packet_in(ofp_event.EventOFPPacketIn(msg))
+    app.batcher.flush_all()
+    #(type, buffer id, in_port, length of the actions) of what was sent
+    return outcome, [(msg_type,) + struct.unpack_from('!IIH', buf, 8) for msg_type, xid, buf in datapath.take()]
+
+
+@pytest.mark.parametrize('data,outcome', [(SRC * 2, 'invalid'), (LLDP, 'lldp')], ids=['invalid', 'lldp'])
+def test_not_forwarded(app, datapath, data, outcome):
+    #a buffered frame is freed with a PacketOut without actions
+    assert packet_in(app, datapath, data, BUFFERED, 60) == (outcome, [(ofproto.OFPT_PACKET_OUT, BUFFERED, 1, 0)])
+    #there is nothing to free otherwise
+    assert packet_in(app, datapath, data, ofproto.OFP_NO_BUFFER) == (outcome, [])
@@ -0,0 +1,149 @@
+#Tests of vlan_config.py: validation of the configuration file, diff() of
+#two configurations and the reload of VlanConfigWatcher.
+
+import json
+import logging
+import os
+
+import pytest
+
+pytest.importorskip('ryu')
+
+import vlan_config
+
+
+CONFIG = {
+    'vlan_groups': {'10': 110},
+    'switches': {
+        '1': {
+            'access': {'1': 10, '2': 10, '3': 20},
+            'trunk': {'4': [10, 20]},
+            'native': [5],
+        },
+    },
+    'links': [[1, 4, 2, 4]],
+}
+
+
+def changed(data, path, value):
+    #a copy of data with the value at path (a tuple of keys) replaced
+    data = json.loads(json.dumps(data))
+    inner = data
+    for key in path[:-1]:
+        inner = inner[key]
+    inner[path[-1]] = value
+    return data
+
+
+def test_from_dict():
+    config = vlan_config.VlanConfig.from_dict(CONFIG)
+    assert config.switches[1] == {
+        1: vlan_config.PortConfig('access', (10,)),
+        2: vlan_config.PortConfig('access', (10,)),
+        3: vlan_config.PortConfig('access', (20,)),
+        4: vlan_config.PortConfig('trunk', (10, 20)),
+        5: vlan_config.PortConfig('native', ()),
+    }
+    assert config.groups == {10: 110, 20: 20}
+    assert config.links == ((1, 4, 2, 4),)
+    #the shapes of the apps
+    assert config.port_vlan == {1: {1: [10], 2: [10], 3: [20], 4: [10, 20], 5: [' ']}}
+    assert config.access == {1: [1, 2, 3, 5]}
+    assert config.trunk == {1: [4]}
+    assert config.port_to_vlan == {1: {1: [10], 2: [10], 3: [20], 4: [10, 20]}}
+    assert config.vlan_members == {1: {10: [1, 2, 4], 20: [3, 4]}}
+
+
+def test_from_dict_optional():
+    config = vlan_config.VlanConfig.from_dict({'switches': {'1': {'access': {'1': 10}}}})
+    assert config.port_vlan == {1: {1: [10]}}
+    assert config.groups == {10: 10}
+    assert config.links == ()
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    {'switches': []},
+    changed(CONFIG, ('vlan_groups',), [10]),
+    changed(CONFIG, ('switches', '1'), [1, 2]),
+    changed(CONFIG, ('switches', '1', 'access'), [1, 2]),
+    changed(CONFIG, ('switches', '1', 'access', '1'), 4095),
+    changed(CONFIG, ('switches', '1', 'access', '1'), [10]),
+    changed(CONFIG, ('switches', '1', 'trunk'), [4]),
+    changed(CONFIG, ('switches', '1', 'trunk', '4'), 10),
+    changed(CONFIG, ('switches', '1', 'trunk', '4'), []),
+    changed(CONFIG, ('switches', '1', 'native'), 5),
+    changed(CONFIG, ('switches', '1', 'native'), [1]),
+    changed(CONFIG, ('links',), {'1': 4}),
+    changed(CONFIG, ('links',), [[1, 4, 2]]),
+    changed(CONFIG, ('links',), [[1, 4, 2, 4], [1, 4, 3, 1]]),
+], ids=['list', 'switches_list', 'vlan_groups_list', 'switch_list', 'access_list', 'access_vid', 'access_vid_list',
+        'trunk_list', 'trunk_scalar', 'trunk_empty', 'native_scalar', 'port_twice', 'links_mapping', 'link_short',
+        'port_linked_twice'])
+def test_from_dict_invalid(data):
+    with pytest.raises(vlan_config.VlanConfigError):
+        vlan_config.VlanConfig.from_dict(data)
+
+
+def test_from_port_vlan():
+    port_vlan = {1: {1: [10], 3: [20], 4: [10, 20], 5: [' ']}}
+    config = vlan_config.VlanConfig.from_port_vlan(port_vlan, {1: [1, 3, 5]}, {1: [4]})
+    assert config.port_vlan == port_vlan
+    assert config.access == {1: [1, 3, 5]}
+    assert config.trunk == {1: [4]}
+
+
+def test_diff():
+    old = vlan_config.VlanConfig.from_dict(CONFIG)
+    assert vlan_config.diff(old, old) == ({}, {})
+
+    #port 3 moves to vlan 10, port 5 is removed and the group of vlan 10 changes
+    data = changed(CONFIG, ('switches', '1', 'access', '3'), 10)
+    data = changed(data, ('switches', '1', 'native'), [])
+    new = vlan_config.VlanConfig.from_dict(data)
+    assert vlan_config.diff(old, new) == ({1: set([3, 5])}, {1: set([10, 20])})
+
+    new = vlan_config.VlanConfig.from_dict(changed(CONFIG, ('vlan_groups', '10'), 111))
+    assert vlan_config.diff(old, new) == ({}, {1: set([10])})
+
+    #a new switch
+    new = vlan_config.VlanConfig.from_dict(changed(CONFIG, ('switches', '2'), {'access': {'1': 20}}))
+    assert vlan_config.diff(old, new) == ({2: set([1])}, {2: set([20])})
+
+
+def test_watcher(tmpdir):
+    path = str(tmpdir.join('vlans.json'))
+    with open(path, 'w') as config_file:
+        json.dump(CONFIG, config_file)
+    configs = []
+    watcher = vlan_config.VlanConfigWatcher(path, configs.append, logging.getLogger('test'))
+
+    #unchanged
+    watcher.check()
+    assert configs == []
+
+    def write(data, mtime):
+        with open(path, 'w') as config_file:
+            config_file.write(data if isinstance(data, str) else json.dumps(data))
+        os.utime(path, (mtime, mtime))
+
+    write(changed(CONFIG, ('switches', '1', 'access', '3'), 10), 1000)
+    watcher.check()
+    assert len(configs) == 1
+    assert configs[0].port_vlan[1][3] == [10]
+
+    #a file that does not load or does not validate keeps the running configuration, and the watcher going
+    for mtime, data in enumerate(['{"switches": ', [], changed(CONFIG, ('switches', '1'), [1]),
+                                  changed(CONFIG, ('switches', '1', 'trunk', '4'), 10)]):
+        write(data, 2000 + mtime)
+        watcher.check()
+    os.remove(path)
+    watcher.check()
+    assert len(configs) == 1
+
+    #SIGHUP reloads even an unchanged file
+    write(CONFIG, 3000)
+    watcher.check()
+    watcher._on_signal(None, None)
+    watcher.check()
+    assert len(configs) == 3
@@ -0,0 +1,344 @@
+#Inter-switch links, shortest paths and per vlan flood trees.
+#
+#The apps learn hosts switch by switch, so a new flow across N switches used
+#to cost N PacketIns. With the links between the switches known, the switch a
+#host is attached to (its edge port) only has to be learned once and the
+#flows of the whole path can be installed on the first PacketIn. Paths are the
+#shortest ones in switch hops.
+#
+#Links are either configured (the "links" of the vlan configuration) or found
+#by LinkDiscovery, which sends an LLDP probe out of every port of every switch
+#each LLDP_INTERVAL seconds and records a link when the probe comes back in on
+#another switch. A link that has not been seen for LINK_TIMEOUT seconds, or
+#whose port goes down, is removed again.
+#
+#Flooding along every link of a topology with redundant trunks loops. blocked()
+#computes a spanning tree over the links a vlan can use (rooted at the lowest
+#dpid of each connected part) and returns the link ports that are not on it,
+#the apps leave those out of their flood actions and group buckets.
+
+import collections
+import struct
+import time
+
+from ryu.lib import hub
+from ryu.lib.packet import ethernet
+from ryu.lib.packet import ether_types
+from ryu.lib.packet import lldp
+from ryu.lib.packet import packet
+
+import sharding
+
+
+#seconds between two rounds of LLDP probes, and without a probe before a link is removed
+LLDP_INTERVAL = 5
+LINK_TIMEOUT = 3 * LLDP_INTERVAL
+
+#priority of the flow sending LLDP to the controller, above every flow of the apps
+LLDP_PRIORITY = 0xffff
+
+CHASSIS_ID_PREFIX = b'dpid:'
+
+
+def lldp_probe(dpid, port_no, hw_addr):
+    """The LLDP frame sent out of port_no of dpid."""
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(lldp.LLDP_MAC_NEAREST_BRIDGE, hw_addr, ether_types.ETH_TYPE_LLDP))
+    pkt.add_protocol(lldp.lldp((
+        lldp.ChassisID(subtype=lldp.ChassisID.SUB_LOCALLY_ASSIGNED,
+                       chassis_id=CHASSIS_ID_PREFIX + (b'%016x' % dpid)),
+        lldp.PortID(subtype=lldp.PortID.SUB_PORT_COMPONENT, port_id=struct.pack('!I', port_no)),
+        lldp.TTL(ttl=LINK_TIMEOUT),
+        lldp.End())))
+    pkt.serialize()
+    return bytes(pkt.data)
+
+
+def parse_lldp_probe(data):
+    """(dpid, port) an LLDP frame was sent from by lldp_probe(), or None for any other frame."""
+    try:
+        lldp_pkt = packet.Packet(data).get_protocol(lldp.lldp)
+    except Exception:
+        return None
+    if lldp_pkt is None or len(lldp_pkt.tlvs) < 2:
+        return None
+    chassis_id, port_id = lldp_pkt.tlvs[0], lldp_pkt.tlvs[1]
+    if (chassis_id.subtype != lldp.ChassisID.SUB_LOCALLY_ASSIGNED
+            or not chassis_id.chassis_id.startswith(CHASSIS_ID_PREFIX)
+            or port_id.subtype != lldp.PortID.SUB_PORT_COMPONENT or len(port_id.port_id) != 4):
+        return None
+    try:
+        dpid = int(chassis_id.chassis_id[len(CHASSIS_ID_PREFIX):], 16)
+    except ValueError:
+        return None
+    return dpid, struct.unpack('!I', port_id.port_id)[0]
+
+
+class Topology(object):
+    """
+    Undirected links between (dpid, port) pairs. The configured links are
+    replaced as a whole by set_links(), the discovered ones come and go one
+    by one through add_link()/remove_link(). links holds both.
+    """
+
+    def __init__(self):
+        #dpid -> port -> (peer dpid, peer port), configured / discovered / both
+        self.static = {}
+        self.discovered = {}
+        self.links = {}
+
+    def _rebuild(self):
+        links = dict((dpid, dict(ports)) for dpid, ports in self.discovered.items())
+        for dpid, ports in self.static.items():
+            links.setdefault(dpid, {}).update(ports)
+        self.links = links
+
+    def add_link(self, dpid, port, peer_dpid, peer_port):
+        """Record a discovered link. Returns True if it is new (or its other end changed)."""
+        if self.discovered.get(dpid, {}).get(port) == (peer_dpid, peer_port):
+            return False
+        #a port is cabled to one other port only
+        self.remove_link(dpid, port)
+        self.remove_link(peer_dpid, peer_port)
+        self.discovered.setdefault(dpid, {})[port] = (peer_dpid, peer_port)
+        self.discovered.setdefault(peer_dpid, {})[peer_port] = (dpid, port)
+        self._rebuild()
+        return True
+
+    def remove_link(self, dpid, port):
+        """Remove the discovered link on (dpid, port). Returns its other end, or None."""
+        peer = self.discovered.get(dpid, {}).pop(port, None)
+        if peer is not None:
+            self.discovered.get(peer[0], {}).pop(peer[1], None)
+            self._rebuild()
+        return peer
+
+    def set_links(self, links):
+        """Replace the configured links with links, a list of (dpid, port, peer dpid, peer port)."""
+        self.static = {}
+        for dpid, port, peer_dpid, peer_port in links:
+            self.static.setdefault(dpid, {})[port] = (peer_dpid, peer_port)
+            self.static.setdefault(peer_dpid, {})[peer_port] = (dpid, port)
+        self._rebuild()
+
+    def is_link(self, dpid, port):
+        return port in self.links.get(dpid, ())
+
+    def peer(self, dpid, port):
+        return self.links.get(dpid, {}).get(port)
+
+    def path(self, src, dst, usable=None):
+        """
+        Shortest path from switch src to switch dst as a list of (dpid,
+        out port), one per switch before dst. Only links whose ports pass
+        usable(dpid, port) (on both ends) are used. Returns [] if src is dst
+        and None if dst cannot be reached.
+        """
+        if src == dst:
+            return []
+        #dpid -> (previous dpid, out port on the previous dpid)
+        previous = {src: None}
+        queue = collections.deque([src])
+        while queue:
+            dpid = queue.popleft()
+            for port, (peer_dpid, peer_port) in sorted(self.links.get(dpid, {}).items()):
+                if peer_dpid in previous:
+                    continue
+                if usable is not None and not (usable(dpid, port) and usable(peer_dpid, peer_port)):
+                    continue
+                previous[peer_dpid] = (dpid, port)
+                if peer_dpid == dst:
+                    hops = []
+                    hop = previous[dst]
+                    while hop is not None:
+                        hops.append(hop)
+                        hop = previous[hop[0]]
+                    hops.reverse()
+                    return hops
+                queue.append(peer_dpid)
+        return None
+
+    def blocked(self, usable=None):
+        """
+        The (dpid, port) link ends that are not on the spanning tree of the
+        links passing usable(dpid, port) on both ends, as a frozenset. Each
+        connected part of the topology gets its own tree, grown breadth first
+        from its lowest dpid, so the result only changes where the links do.
+        """
+        usable_ends = set()
+        for dpid, ports in self.links.items():
+            for port, (peer_dpid, peer_port) in ports.items():
+                if usable is None or (usable(dpid, port) and usable(peer_dpid, peer_port)):
+                    usable_ends.add((dpid, port))
+
+        tree = set()
+        reached = set()
+        for root in sorted(self.links):
+            if root in reached:
+                continue
+            reached.add(root)
+            queue = collections.deque([root])
+            while queue:
+                dpid = queue.popleft()
+                for port, (peer_dpid, peer_port) in sorted(self.links.get(dpid, {}).items()):
+                    if peer_dpid in reached or (dpid, port) not in usable_ends:
+                        continue
+                    reached.add(peer_dpid)
+                    tree.add((dpid, port))
+                    tree.add((peer_dpid, peer_port))
+                    queue.append(peer_dpid)
+        return frozenset(usable_ends - tree)
+
+
+def blocked_changes(old, new):
+    """
+    Compare two vlan -> blocked() mappings. Returns dpid -> set of the vlans
+    whose blocked ports changed on that dpid.
+    """
+    changes = {}
+    for vid in set(old) | set(new):
+        for dpid, port in old.get(vid, frozenset()) ^ new.get(vid, frozenset()):
+            changes.setdefault(dpid, set()).add(vid)
+    return changes
+
+
+class LinkDiscovery(object):
+    """
+    LLDP link discovery for one app. The app adds every datapath once it is
+    set up, installs the LLDP flow (see LLDP_PRIORITY) and forwards the port
+    description replies, the port status messages and the LLDP PacketIns.
+    on_change(added, removed) is called with the lists of (dpid, port, peer
+    dpid, peer port) whenever links appear or go away.
+    """
+
+    def __init__(self, batcher, topology, logger, on_change, interval=LLDP_INTERVAL,
+                 timeout=LINK_TIMEOUT, clock=time.monotonic):
+        self.batcher = batcher
+        self.topology = topology
+        self.logger = logger
+        self.on_change = on_change
+        self.interval = interval
+        self.timeout = timeout
+        self.clock = clock
+        #dpid -> datapath
+        self.datapaths = {}
+        #dpid -> port -> hw address of the ports that are up
+        self.ports = {}
+        #(dpid, port) -> time the last probe came in on it
+        self.seen = {}
+        #(dpid, xid) of a port description request -> the ports of its replies so far
+        self._requests = {}
+        self._probes = {}
+        self._thread = None
+
+    def add_datapath(self, datapath):
+        #a worker of a sharded controller only sees the probes of its own switches, the links to the other
+        #shards would be missing from its trees (see sharding.py)
+        if sharding.worker_index() is not None:
+            return
+        parser = datapath.ofproto_parser
+        self.datapaths[datapath.id] = datapath
+        xid = self.batcher.send_msg(datapath, parser.OFPPortDescStatsRequest(datapath, 0))
+        self._requests[(datapath.id, xid)] = {}
+        if self._thread is None:
+            self._thread = hub.spawn(self._loop)
+
+    def remove_datapath(self, dpid):
+        self.datapaths.pop(dpid, None)
+        for port in list(self.ports.pop(dpid, {})):
+            self._remove(dpid, port)
+
+    def _loop(self):
+        try:
+            while self.datapaths:
+                for dpid, datapath in list(self.datapaths.items()):
+                    if not datapath.is_active:
+                        self.remove_datapath(dpid)
+                    else:
+                        self.probe(datapath)
+                self.expire()
+                hub.sleep(self.interval)
+        finally:
+            self._thread = None
+
+    def probe(self, datapath):
+        """Send an LLDP probe out of every port of datapath that is up."""
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        for port, hw_addr in sorted(self.ports.get(datapath.id, {}).items()):
+            data = self._probes.get((datapath.id, port))
+            if data is None:
+                data = self._probes[(datapath.id, port)] = lldp_probe(datapath.id, port, hw_addr)
+            out = parser.OFPPacketOut(datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER,
+                                      in_port=ofproto.OFPP_CONTROLLER,
+                                      actions=[parser.OFPActionOutput(port)], data=data)
+            self.batcher.send_msg(datapath, out)
+
+    def expire(self):
+        """Remove the links whose probes stopped coming in."""
+        deadline = self.clock() - self.timeout
+        for (dpid, port), seen in list(self.seen.items()):
+            if seen < deadline:
+                self._remove(dpid, port)
+
+    def _remove(self, dpid, port):
+        self.seen.pop((dpid, port), None)
+        peer = self.topology.remove_link(dpid, port)
+        if peer is None:
+            return
+        self.seen.pop(peer, None)
+        self.logger.info("link %s:%s - %s:%s down", dpid, port, peer[0], peer[1])
+        self.on_change([], [(dpid, port, peer[0], peer[1])])
+
+    def port_desc_reply(self, msg):
+        """Record the ports of a datapath. Returns True if msg answered one of our requests."""
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        ports = self._requests.get((datapath.id, msg.xid))
+        if ports is None:
+            return False
+        for port in msg.body:
+            if port.port_no <= ofproto.OFPP_MAX and not port.state & ofproto.OFPPS_LINK_DOWN:
+                ports[port.port_no] = port.hw_addr
+        if msg.flags & ofproto.OFPMPF_REPLY_MORE:
+            return True
+        del self._requests[(datapath.id, msg.xid)]
+        self.ports[datapath.id] = ports
+        #find the links of the new switch straight away
+        self.probe(datapath)
+        return True
+
+    def port_status(self, msg):
+        """Follow a port that was added, went up or down, or was removed."""
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        port = msg.desc
+        ports = self.ports.setdefault(datapath.id, {})
+        self._probes.pop((datapath.id, port.port_no), None)
+        if msg.reason == ofproto.OFPPR_DELETE or port.state & ofproto.OFPPS_LINK_DOWN:
+            ports.pop(port.port_no, None)
+            self._remove(datapath.id, port.port_no)
+        elif port.port_no <= ofproto.OFPP_MAX:
+            ports[port.port_no] = port.hw_addr
+
+    def packet_in(self, msg):
+        """
+        Record the link an LLDP PacketIn came over. Returns True if it was
+        one of our probes.
+        """
+        src = parse_lldp_probe(msg.data)
+        if src is None or src[0] not in self.datapaths:
+            return False
+        dpid = msg.datapath.id
+        in_port = msg.match['in_port']
+        if self.topology.discovered.get(dpid, {}).get(in_port) != src:
+            #recabled, the ports lose their old links first
+            self._remove(dpid, in_port)
+            self._remove(src[0], src[1])
+            self.topology.add_link(src[0], src[1], dpid, in_port)
+            self.logger.info("link %s:%s - %s:%s up", src[0], src[1], dpid, in_port)
+            self.on_change([(src[0], src[1], dpid, in_port)], [])
+        now = self.clock()
+        self.seen[(dpid, in_port)] = now
+        self.seen[src] = now
+        return True
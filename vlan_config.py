@@ -0,0 +1,335 @@
+#VLAN configuration loaded from a file, with hot reload.
+#
+#The apps used to carry their vlan membership in hard coded module globals
+#(port_to_vlan/vlan_members/vlan_to_group in LearningSwitch.py,
+#port_vlan/access/trunk in VLAN.py), so every change meant restarting the
+#controller. VlanConfig is a validated model of the same information that
+#can be read from a JSON or YAML file:
+#
+#   {
+#       "vlan_groups": {"10": 10, "20": 20},
+#       "switches": {
+#           "1": {
+#               "access": {"1": 10, "2": 10, "3": 20},
+#               "trunk": {"4": [10, 20]},
+#               "native": [5]
+#           }
+#       },
+#       "links": [[1, 4, 2, 4]]
+#   }
+#
+#access ports carry a single untagged vlan, trunk ports carry tagged frames
+#of the listed vlans (plus untagged native vlan traffic) and native ports are
+#plain untagged ports of a vlan aware switch. vlan_groups is optional, the
+#group table id of a vlan defaults to the vlan id. links is optional too and
+#lists the cables between the switches as [dpid, port, peer dpid, peer port].
+#
+#VlanConfigWatcher reloads the file when it changes or when the controller
+#gets SIGHUP, and diff() tells the apps which ports and vlans are affected so
+#they only have to reprogram those.
+
+import collections
+import json
+import os
+import signal
+
+from ryu.lib import hub
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+ACCESS = 'access'
+TRUNK = 'trunk'
+NATIVE = 'native'
+
+#the untagged placeholder VLAN.py uses in port_vlan for native ports
+NATIVE_VLAN = " "
+
+#seconds between two checks of the configuration file
+DEFAULT_POLL_INTERVAL = 2
+
+PortConfig = collections.namedtuple('PortConfig', ['mode', 'vlans'])
+
+
+class VlanConfigError(ValueError):
+    pass
+
+
+def _to_int(value, what):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise VlanConfigError("%s must be an integer, got %r" % (what, value))
+
+
+def _vid(value, what):
+    vid = _to_int(value, what)
+    if not 1 <= vid <= 4094:
+        raise VlanConfigError("%s must be a vlan id between 1 and 4094, got %r" % (what, value))
+    return vid
+
+
+def _mapping(value, what):
+    #an optional mapping of the file, missing or empty is {}
+    if not value:
+        return {}
+    if not isinstance(value, dict):
+        raise VlanConfigError("%s must be a mapping, got %r" % (what, value))
+    return value
+
+
+def _list(value, what):
+    #an optional list of the file, missing or empty is []
+    if not value:
+        return []
+    if not isinstance(value, (list, tuple)):
+        raise VlanConfigError("%s must be a list, got %r" % (what, value))
+    return value
+
+
+class VlanConfig(object):
+    """
+    Immutable, validated vlan configuration. switches maps dpid -> port ->
+    PortConfig, groups maps vlan id -> group table id and links is a tuple of
+    (dpid, port, peer dpid, peer port). The legacy dict shapes the apps work
+    with are built once here, see the properties below.
+    """
+
+    def __init__(self, switches, groups=None, links=()):
+        self.switches = switches
+        self.groups = dict(groups or {})
+        self.links = tuple(links)
+        for ports in switches.values():
+            for port_config in ports.values():
+                for vid in port_config.vlans:
+                    self.groups.setdefault(vid, vid)
+
+        self._port_to_vlan = {}
+        self._vlan_members = {}
+        self._port_vlan = {}
+        self._access = {}
+        self._trunk = {}
+        for dpid, ports in switches.items():
+            port_to_vlan = self._port_to_vlan[dpid] = {}
+            vlan_members = self._vlan_members[dpid] = {}
+            port_vlan = self._port_vlan[dpid] = {}
+            access = self._access[dpid] = []
+            trunk = self._trunk[dpid] = []
+            for port in sorted(ports):
+                port_config = ports[port]
+                if port_config.mode == NATIVE:
+                    port_vlan[port] = [NATIVE_VLAN]
+                else:
+                    port_vlan[port] = list(port_config.vlans)
+                    port_to_vlan[port] = list(port_config.vlans)
+                for vid in port_config.vlans:
+                    vlan_members.setdefault(vid, []).append(port)
+                if port_config.mode == TRUNK:
+                    trunk.append(port)
+                else:
+                    access.append(port)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build and validate a configuration from the parsed file contents."""
+        if not isinstance(data, dict) or not isinstance(data.get('switches'), dict):
+            raise VlanConfigError("configuration needs a 'switches' mapping")
+
+        groups = {}
+        for vid, group_id in _mapping(data.get('vlan_groups'), "vlan_groups").items():
+            groups[_vid(vid, "vlan_groups key")] = _to_int(group_id, "group id of vlan %s" % vid)
+
+        switches = {}
+        for dpid, switch in data['switches'].items():
+            dpid = _to_int(dpid, "dpid")
+            if not isinstance(switch, dict):
+                raise VlanConfigError("configuration of dpid %s must be a mapping" % dpid)
+            ports = switches[dpid] = {}
+
+            def add(port, port_config):
+                port = _to_int(port, "port of dpid %s" % dpid)
+                if port in ports:
+                    raise VlanConfigError("port %s of dpid %s is configured twice" % (port, dpid))
+                ports[port] = port_config
+
+            for port, vid in _mapping(switch.get(ACCESS), "access ports of dpid %s" % dpid).items():
+                add(port, PortConfig(ACCESS, (_vid(vid, "access vlan of port %s" % port),)))
+            for port, vids in _mapping(switch.get(TRUNK), "trunk ports of dpid %s" % dpid).items():
+                vids = _list(vids, "vlans of trunk port %s of dpid %s" % (port, dpid))
+                if not vids:
+                    raise VlanConfigError("trunk port %s of dpid %s carries no vlan" % (port, dpid))
+                vids = tuple(_vid(vid, "trunk vlan of port %s" % port) for vid in vids)
+                add(port, PortConfig(TRUNK, vids))
+            for port in _list(switch.get(NATIVE), "native ports of dpid %s" % dpid):
+                add(port, PortConfig(NATIVE, ()))
+
+        links = []
+        linked = set()
+        for link in _list(data.get('links'), "links"):
+            if not isinstance(link, (list, tuple)) or len(link) != 4:
+                raise VlanConfigError("link %r must be [dpid, port, peer dpid, peer port]" % (link,))
+            dpid, port, peer_dpid, peer_port = [_to_int(value, "link %r" % (link,)) for value in link]
+            for end in ((dpid, port), (peer_dpid, peer_port)):
+                if end in linked:
+                    raise VlanConfigError("port %s of dpid %s has more than one link" % (end[1], end[0]))
+                linked.add(end)
+            links.append((dpid, port, peer_dpid, peer_port))
+
+        return cls(switches, groups, links)
+
+    @classmethod
+    def from_port_to_vlan(cls, port_to_vlan, vlan_to_group=None):
+        """Build a configuration from LearningSwitch.py style globals (access ports only)."""
+        switches = {}
+        for dpid, ports in port_to_vlan.items():
+            switches[dpid] = dict((port, PortConfig(ACCESS, (vids[0],)))
+                                  for port, vids in ports.items())
+        return cls(switches, vlan_to_group)
+
+    @classmethod
+    def from_port_vlan(cls, port_vlan, access, trunk, links=()):
+        """Build a configuration from VLAN.py style globals."""
+        switches = {}
+        for dpid, ports in port_vlan.items():
+            switch = switches[dpid] = {}
+            for port, vids in ports.items():
+                if port in trunk.get(dpid, []):
+                    switch[port] = PortConfig(TRUNK, tuple(vid for vid in vids if vid != NATIVE_VLAN))
+                elif vids[0] == NATIVE_VLAN:
+                    switch[port] = PortConfig(NATIVE, ())
+                else:
+                    switch[port] = PortConfig(ACCESS, (vids[0],))
+        return cls(switches, links=links)
+
+    def check_access_only(self):
+        """Raise VlanConfigError for trunk and native ports, LearningSwitch.py only has access ports."""
+        for dpid, ports in sorted(self.switches.items()):
+            for port, port_config in sorted(ports.items()):
+                if port_config.mode != ACCESS:
+                    raise VlanConfigError("%s port %s of dpid %s is not supported, only access ports are"
+                                          % (port_config.mode, port, dpid))
+
+    #LearningSwitch.py shapes
+    @property
+    def port_to_vlan(self):
+        return self._port_to_vlan
+
+    @property
+    def vlan_members(self):
+        return self._vlan_members
+
+    @property
+    def vlan_to_group(self):
+        return self.groups
+
+    #VLAN.py shapes
+    @property
+    def port_vlan(self):
+        return self._port_vlan
+
+    @property
+    def access(self):
+        return self._access
+
+    @property
+    def trunk(self):
+        return self._trunk
+
+
+def load(path):
+    """Read and validate the configuration file at path (JSON, or YAML by extension)."""
+    with open(path) as config_file:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise VlanConfigError("PyYAML is needed to read %s" % path)
+            try:
+                data = yaml.safe_load(config_file)
+            except yaml.YAMLError as e:
+                raise VlanConfigError("cannot parse %s: %s" % (path, e))
+        else:
+            data = json.load(config_file)
+    return VlanConfig.from_dict(data)
+
+
+def diff(old, new):
+    """
+    Compare two configurations. Returns (changed_ports, changed_vlans), both
+    dpid -> set: the ports whose mode or vlans changed (including ports that
+    were added or removed) and the vlans whose member ports or group id
+    changed on that dpid. Datapaths without any change are left out.
+    """
+    changed_ports = {}
+    changed_vlans = {}
+    for dpid in set(old.switches) | set(new.switches):
+        old_ports = old.switches.get(dpid, {})
+        new_ports = new.switches.get(dpid, {})
+        ports = set(port for port in set(old_ports) | set(new_ports)
+                    if old_ports.get(port) != new_ports.get(port))
+        if ports:
+            changed_ports[dpid] = ports
+
+        old_members = old.vlan_members.get(dpid, {})
+        new_members = new.vlan_members.get(dpid, {})
+        vlans = set(vid for vid in set(old_members) | set(new_members)
+                    if old_members.get(vid) != new_members.get(vid)
+                    or old.groups.get(vid) != new.groups.get(vid))
+        if vlans:
+            changed_vlans[dpid] = vlans
+    return changed_ports, changed_vlans
+
+
+class VlanConfigWatcher(object):
+    """
+    Polls the configuration file for changes (and reloads on SIGHUP) and
+    hands every successfully validated new configuration to on_change. A
+    file that fails to load is logged and the running configuration is kept.
+    """
+
+    def __init__(self, path, on_change, logger, interval=DEFAULT_POLL_INTERVAL):
+        self.path = path
+        self.on_change = on_change
+        self.logger = logger
+        self.interval = interval
+        self._mtime = self._stat()
+        self._reload_requested = False
+        self._thread = None
+
+    def start(self):
+        try:
+            signal.signal(signal.SIGHUP, self._on_signal)
+        except ValueError:
+            #signals can only be set up from the main thread
+            self.logger.warning("SIGHUP reload of %s not available", self.path)
+        self._thread = hub.spawn(self._loop)
+
+    def _on_signal(self, signum, frame):
+        #only flag it, the reload itself happens in the watcher thread
+        self._reload_requested = True
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _loop(self):
+        while True:
+            hub.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        mtime = self._stat()
+        if mtime == self._mtime and not self._reload_requested:
+            return
+        self._mtime = mtime
+        self._reload_requested = False
+        try:
+            config = load(self.path)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.error("not reloading vlan configuration %s: %s", self.path, e)
+            return
+        self.logger.info("reloading vlan configuration %s", self.path)
+        self.on_change(config)